@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import functools
 import time
-import resource  # Unix-specific; consider psutil for Windows compatibility
-import psutil  # To track child processes
 import os
+import shutil
+import threading
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from graphlib import TopologicalSorter
 
 from utils.run_motion_outliers import main as run_motion_outliers_main
 from utils.run_synthstrip import main as run_synthstrip_main
@@ -12,8 +17,12 @@ from utils.extract_parameters import main as extract_parameters_main
 from utils.generate_design_files import main as generate_design_files_main
 from utils.generate_higher_level_feat_files import main as generate_higher_level_feat_files_main
 from utils.run_feat import main as run_feat_main
-from utils.command import append_log, create_instance_log_file
+from utils.run_feat import write_feat_commands, write_slurm_array_script
+from utils.command import LogBuffer, append_log, available_cpus, create_instance_log_file, process_pool_context, run_cmd
 from utils.subjects import parse_subjects_arg
+from utils.bids import discover_bids_files
+from utils.find_dummy import config_paths as dummy_config_paths
+from utils import step_cache
 
 
 def _parse_runs(run_args):
@@ -27,122 +36,330 @@ def _parse_runs(run_args):
     if not run_args:
         raise ValueError("--run is required")
 
-    normalized = [str(r).strip().lower() for r in run_args]
-    if "none" in normalized:
-        if len(normalized) != 1:
-            raise ValueError("--run none cannot be combined with numeric runs")
-        return [None]
-
     runs = []
-    for r in normalized:
+    seen_none = False
+    for r in run_args:
+        token = str(r).strip().lower()
+        if token == "none":
+            seen_none = True
+            continue
         try:
-            runs.append(int(r))
+            runs.append(int(token))
         except ValueError as e:
             raise ValueError(f"Invalid --run value: {r}") from e
+
+    if seen_none:
+        if runs:
+            raise ValueError("--run none cannot be combined with numeric runs")
+        return [None]
     return runs
 
-def get_total_memory_usage():
-    """Get peak memory usage including child processes."""
-    process = psutil.Process()
-    mem_usage = process.memory_info().rss  # Resident Set Size (bytes)
-    for child in process.children(recursive=True):
-        mem_usage += child.memory_info().rss
-    return mem_usage / (1024 * 1024)  # Convert to MB
-
-def get_total_cpu_time():
-    """Get CPU time usage including child processes."""
-    process = psutil.Process()
-    cpu_time = process.cpu_times().user + process.cpu_times().system
-    for child in process.children(recursive=True):
-        cpu_time += child.cpu_times().user + child.cpu_times().system
-    return cpu_time
+class ResourceTracker:
+    """Track runtime, CPU time and peak memory of the pipeline and its child processes.
 
-def main():
-    parser = argparse.ArgumentParser(description="Wrapper script to run all FSL Task Pipeline steps.")
+    A background thread samples the resident set size of this process and all of
+    its descendants every ``sleep_time`` seconds, so the reported peak reflects
+    the whole run rather than the moment tracking stopped. CPU time is taken
+    from ``os.times()``, which already accumulates every reaped child process.
+    """
 
-    # Core arguments
-    parser.add_argument("--input_directory", required=True, help="Input BIDS directory.")
-    parser.add_argument("--output_directory", required=True, help="Output directory.")
-    parser.add_argument("--fsf_template", required=True, help="Path to the .fsf template file.")
-    parser.add_argument("--task", nargs='+', required=True, help="One or more task names (e.g., --task hand language).")
-    parser.add_argument(
-        "--run",
-        nargs='+',
-        required=True,
-        help=(
-            "Run numbers to process (e.g., --run 1 2). Use '--run none' when the BOLD filename does not "
-            "contain a run label (e.g., sub-XXX_ses-YYY_task-T_bold.nii.gz)."
-        ),
+    def __init__(self, sleep_time=0.5):
+        # Deferred so psutil is only loaded when --track_resources is used.
+        import psutil
+
+        self._psutil = psutil
+        self.sleep_time = sleep_time
+        self.peak_rss = 0
+        self.runtime = 0.0
+        self.cpu_time_used = 0.0
+        self._root = psutil.Process()
+        self._procs = {}  # child pid -> psutil.Process, reused across samples
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _cpu_seconds():
+        t = os.times()
+        return t.user + t.system + t.children_user + t.children_system
+
+    def _sample(self):
+        try:
+            rss = self._root.memory_info().rss
+            children = self._root.children(recursive=True)
+        except self._psutil.Error:
+            return
+        alive = set()
+        for child in children:
+            proc = self._procs.setdefault(child.pid, child)
+            alive.add(proc.pid)
+            try:
+                rss += proc.memory_info().rss
+            except self._psutil.Error:
+                continue
+        # Drop handles of processes that have exited.
+        for pid in set(self._procs) - alive:
+            del self._procs[pid]
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.sleep_time):
+            self._sample()
+
+    @property
+    def peak_memory_mb(self):
+        return self.peak_rss / (1024 * 1024)
+
+    def __enter__(self):
+        self._start_time = time.monotonic()
+        self._start_cpu = self._cpu_seconds()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, name="resource-tracker", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        self.runtime = time.monotonic() - self._start_time
+        self.cpu_time_used = self._cpu_seconds() - self._start_cpu
+        return False
+
+def _run_cached_step(step, subject, inputs_fingerprint, args, run_log_file, func, *func_args, **func_kwargs):
+    """Run one preprocessing step unless its manifest shows the inputs are unchanged.
+
+    ``func`` returns the output paths it is responsible for; they are recorded in
+    the manifest so a later run redoes the step if any of them was removed.
+    """
+    if not args.force and step_cache.is_done(args.output_directory, subject, step, inputs_fingerprint):
+        append_log(run_log_file, f"Skipping {step} for {subject}: inputs unchanged and outputs present")
+        return
+    outputs = func(*func_args, **func_kwargs)
+    if not args.dry_run:
+        step_cache.mark_done(args.output_directory, subject, step, inputs_fingerprint, outputs or ())
+
+def _read_templates(args):
+    """Read the first- and higher-level FSF templates once for the whole run."""
+    templates = {"fsf": None, "higher_level": None}
+    for key, path in (("fsf", args.fsf_template), ("higher_level", args.higher_level_fsf_template)):
+        if path:
+            with open(path, "r") as f:
+                templates[key] = f.read()
+    return templates
+
+@functools.lru_cache(maxsize=None)
+def _feat_roots(output_directory):
+    """Return the FEAT output root and its higher-level design/output roots."""
+    feat_root = os.path.join(output_directory, "fsl_feat_v6.0.7.4")
+    return (
+        feat_root,
+        os.path.join(feat_root, "higher_level_designs"),
+        os.path.join(feat_root, "higher_level_outputs"),
     )
-    parser.add_argument("--subjects", nargs="+", required=False, help=("One or more subject IDs (e.g., sub-001 sub-002) OR a path to a text file containing subjects (comma/newline-separated). If omitted, process all subjects found in the input directory."))
-    parser.add_argument("--custom_block", nargs='*', default=[], help="Custom block inputs (optional).")
-    parser.add_argument("--write_commands", required=False, help="Instead of running commands locally, write all commands to a text file for HPC execution.")
-    parser.add_argument("--max_workers", type=int, default=10, help="Maximum number of parallel workers.")
-    parser.add_argument("--higher_level_fsf_template", required=False, help="Path to the higher-level .fsf template file.")
-    parser.add_argument("--dry_run", action="store_true", help="Print/log commands but do not execute external tools")
-    parser.add_argument("--force", action="store_true", help="Re-run steps even if outputs already exist")
 
-    # New flag to track resources
-    parser.add_argument("--track_resources", action="store_true", help="Track system resources and runtime usage.")
+def _seed_ignore(subject):
+    """``shutil.copytree`` ignore callable that keeps only ``subject``'s outputs."""
+    def ignore(directory, names):
+        if subject in Path(directory).parts:
+            return []
+        own_prefix = f"{subject}_"
+        return [
+            name for name in names
+            if (name.startswith("sub-") and name != subject and not name.startswith(own_prefix))
+            or (not name.startswith(own_prefix) and not os.path.isdir(os.path.join(directory, name)))
+        ]
+    return ignore
 
-    args = parser.parse_args()
+def _rewrite_fsf_paths(root, old, new, *, keep_mtime=False):
+    """Replace the ``old`` directory prefix with ``new`` in every .fsf file under root.
 
-    runs = _parse_runs(args.run)
+    Generated designs and FEAT's copied design.fsf embed absolute output paths.
+    With ``keep_mtime`` the files keep their timestamps, so up-to-date checks
+    against their inputs are unaffected.
+    """
+    old_prefix, new_prefix = os.fsencode(os.path.join(old, "")), os.fsencode(os.path.join(new, ""))
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.endswith(".fsf"):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            if old_prefix not in data:
+                continue
+            st = os.stat(path)
+            with open(path, "wb") as f:
+                f.write(data.replace(old_prefix, new_prefix))
+            if keep_mtime:
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
 
-    subjects_list = parse_subjects_arg(args.subjects)
+@contextlib.contextmanager
+def _local_scratch(subject, output_directory, log_file):
+    """Yield a node-local output directory for one subject.
 
-    # Determine subjects to process.
-    if subjects_list is not None:
-        subject_iter = subjects_list
-    else:
-        # Default: process every subject directory under input_directory.
-        subject_iter = sorted(
-            [d for d in os.listdir(args.input_directory) if d.startswith("sub-") and os.path.isdir(os.path.join(args.input_directory, d))]
-        )
+    The subject's existing outputs (and step manifests) are first copied from
+    ``output_directory``, so re-runs skip finished work exactly as without
+    scratch. Every step writes under the scratch tree; when the subject
+    completes, the tree is merged into ``output_directory`` (rsync when
+    available) and the scratch copy is removed, so shared storage sees one bulk
+    copy instead of many small writes. Paths in .fsf files are rewritten in both
+    directions; other FEAT outputs (e.g. report logs) keep the scratch paths.
+
+    If a step or the copy-back fails, the scratch tree is kept for inspection
+    and its location logged.
+    """
+    output_directory = output_directory.rstrip("/")
+    job = os.environ.get("SLURM_JOB_ID") or str(os.getpid())
+    job_dir = os.path.join(os.environ.get("TMPDIR", "/tmp"), f"fsl_{job}")
+    local_out = os.path.join(job_dir, subject)
+    os.makedirs(local_out, exist_ok=True)
+    if os.path.isdir(output_directory):
+        append_log(log_file, f"Seeding {local_out} from {output_directory}")
+        if shutil.which("rsync"):
+            run_cmd(
+                [
+                    "rsync", "-a", "-m",
+                    f"--include={subject}/***", f"--include={subject}_*",
+                    "--exclude=sub-*/", "--include=*/", "--exclude=*",
+                    output_directory + "/", local_out + "/",
+                ],
+                log_file=log_file,
+            )
+        else:
+            shutil.copytree(output_directory, local_out, ignore=_seed_ignore(subject), dirs_exist_ok=True)
+        _rewrite_fsf_paths(local_out, output_directory, local_out, keep_mtime=True)
+    try:
+        yield local_out
+        _rewrite_fsf_paths(local_out, local_out, output_directory)
+        append_log(log_file, f"Syncing {local_out} -> {output_directory}")
+        if shutil.which("rsync"):
+            run_cmd(["rsync", "-a", local_out + "/", output_directory + "/"], log_file=log_file)
+        else:
+            shutil.copytree(local_out, output_directory, dirs_exist_ok=True)
+    except BaseException:
+        append_log(log_file, f"Subject {subject} did not complete; keeping scratch outputs in {local_out}")
+        raise
+    shutil.rmtree(local_out, ignore_errors=True)
+    # Other subjects of this job may still be using the job directory.
+    with contextlib.suppress(OSError):
+        os.rmdir(job_dir)
 
+def _run_step_graph(steps, after_step=None):
+    """Run ``{name: (func, dependencies)}`` steps as soon as their dependencies finish.
 
-    if args.track_resources:
-        start_time = time.time()
-        start_cpu_time = get_total_cpu_time()
+    Steps run on a private thread pool sized to the widest possible fan-out; the
+    steps themselves hand their external-tool jobs to the shared step executor.
+    The first failing step's exception is re-raised once running steps finish,
+    and no further steps are started after a failure. ``after_step``, if given,
+    is called with each step's name once it has succeeded.
+    """
+    sorter = TopologicalSorter({name: deps for name, (_, deps) in steps.items()})
+    sorter.prepare()
+    with ThreadPoolExecutor(max_workers=len(steps)) as ex:
+        running = {}
+        while sorter.is_active():
+            for name in sorter.get_ready():
+                running[ex.submit(steps[name][0])] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                fut.result()
+                name = running.pop(fut)
+                sorter.done(name)
+                if after_step is not None:
+                    after_step(name)
 
-    # Run pipeline steps
-    # Preprocessing steps should run once, even if multiple tasks are requested.
+def _process_subject(subject, args, runs, run_log_file, max_workers, executor=None, templates=None):
+    """Run every pipeline step for a single subject.
 
-    run_log_file = create_instance_log_file(args.output_directory)
-    append_log(run_log_file, "=== Begin pipeline run ===")
+    Log lines are buffered and appended to the run log in blocks after each
+    step (and when the subject finishes), so concurrently processed subjects
+    interleave only at step boundaries.
 
-    for subject in subject_iter:
+    ``executor``, when given, is the pipeline-wide pool shared by the steps
+    that launch external tools. ``templates`` holds the FSF template sources
+    read once by ``main()`` (see ``_read_templates``).
+
+    Returns ``(first_level_fsfs, higher_level_fsfs)`` generated for the subject.
+    """
+    if templates is None:
+        templates = _read_templates(args)
+    with LogBuffer(run_log_file) as subject_log, contextlib.ExitStack() as stack:
         subject_arg = subject
-        append_log(run_log_file, f"=== Begin subject {subject_arg} ===")
-        # Preprocessing runs once per subject (not once per task).
-        run_motion_outliers_main(
-            args.input_directory,
-            args.output_directory,
-            subject_arg,
-            args.max_workers,
-            args.task,
-            runs,
-            log_file=run_log_file,
-            dry_run=args.dry_run,
-            force=args.force,
-        )
-        run_synthstrip_main(
-            args.input_directory,
-            args.output_directory,
-            subject_arg,
-            args.max_workers,
-            args.task,
-            runs,
-            log_file=run_log_file,
-            dry_run=args.dry_run,
-            force=args.force,
+        if args.use_local_scratch:
+            local_out = stack.enter_context(_local_scratch(subject_arg, args.output_directory, subject_log))
+            args = argparse.Namespace(**{**vars(args), "output_directory": local_out})
+        append_log(subject_log, f"=== Begin subject {subject_arg} ===")
+        # Discover the subject's BIDS files once and share the index with every step.
+        file_index = discover_bids_files(args.input_directory, [subject_arg])
+        # The dummy-scan settings decide DISCARD_FRAMES and --dummy, so editing
+        # (or adding) them invalidates the cached preprocessing steps too.
+        inputs_fingerprint = step_cache.fingerprint_inputs(
+            [f.path for f in file_index] + [p for p in dummy_config_paths() if os.path.exists(p)],
+            extra=(tuple(args.task), tuple(runs)),
         )
-        extract_parameters_main(args.input_directory, args.output_directory, subject_arg, args.task, runs)
-    
+        def motion_outliers():
+            _run_cached_step(
+                "motion_outliers",
+                subject_arg,
+                inputs_fingerprint,
+                args,
+                subject_log,
+                run_motion_outliers_main,
+                args.input_directory,
+                args.output_directory,
+                subject_arg,
+                max_workers,
+                args.task,
+                runs,
+                log_file=subject_log,
+                dry_run=args.dry_run,
+                force=args.force,
+                file_index=file_index,
+                executor=executor,
+            )
+
+        def synthstrip():
+            run_synthstrip_main(
+                args.input_directory,
+                args.output_directory,
+                subject_arg,
+                max_workers,
+                args.task,
+                runs,
+                log_file=subject_log,
+                dry_run=args.dry_run,
+                force=args.force,
+                file_index=file_index,
+                executor=executor,
+            )
+
+        def extract_parameters():
+            _run_cached_step(
+                "extract_parameters",
+                subject_arg,
+                inputs_fingerprint,
+                args,
+                subject_log,
+                extract_parameters_main,
+                args.input_directory,
+                args.output_directory,
+                subject_arg,
+                args.task,
+                runs,
+                file_index=file_index,
+                max_workers=max_workers,
+            )
+
         first_level_fsfs = []
-        for task in args.task:
-            first_level_fsfs.extend(
-                generate_design_files_main(
+        # One first-level FEAT batch per task, started as soon as that task's
+        # designs are written rather than after every task has rendered.
+        feat_batches = []
+        if not args.write_commands:
+            feat_pool = stack.enter_context(ThreadPoolExecutor(max_workers=len(args.task)))
+
+        def design_files():
+            def render_task(task):
+                fsfs = generate_design_files_main(
                     fsf_template=args.fsf_template,
                     output_directory=args.output_directory,
                     input_directory=args.input_directory,
@@ -150,45 +367,58 @@ def main():
                     custom_block=args.custom_block,
                     subjects=subject_arg,
                     runs=runs,
+                    file_index=file_index,
+                    fsf_template_src=templates["fsf"],
+                    force=args.force,
+                    max_workers=max_workers,
                 )
-            )
-    
-        # Run FEAT or emit FEAT commands for first level.
-        run_feat_main(
-            first_level_fsfs,
-            max_workers=args.max_workers,
-            write_commands=args.write_commands,
-            log_file=run_log_file,
-            dry_run=args.dry_run,
-            force=args.force,
-        )
-        if args.higher_level_fsf_template:
+                # With --write_commands, commands for all subjects are written together by main().
+                if not args.write_commands:
+                    feat_batches.append(
+                        feat_pool.submit(
+                            run_feat_main,
+                            fsfs,
+                            max_workers=max_workers,
+                            log_file=subject_log,
+                            dry_run=args.dry_run,
+                            force=args.force,
+                            executor=executor,
+                        )
+                    )
+                return fsfs
+
+            # Tasks write disjoint FSFs, so they are generated concurrently;
+            # map() keeps the FSF list in --task order.
+            if len(args.task) > 1:
+                with ThreadPoolExecutor(max_workers=len(args.task)) as task_pool:
+                    per_task = list(task_pool.map(render_task, args.task))
+            else:
+                per_task = [render_task(task) for task in args.task]
+            for fsfs in per_task:
+                first_level_fsfs.extend(fsfs)
+
+        def first_level_feat():
+            # Wait for every task's batch; the first failure is re-raised.
+            for batch in feat_batches:
+                batch.result()
+
+        higher_level_fsfs_all = []
+
+        def higher_level():
+            if not args.higher_level_fsf_template:
+                return
             analysis_blocks = args.custom_block if args.custom_block else ["standard"]
-    
+
             # Pair whichever runs were passed. If more than two, pair the first two.
             # Higher-level analysis is only meaningful for numeric runs.
             numeric_runs = [r for r in runs if r is not None]
             run_pair = tuple(numeric_runs[:2]) if len(numeric_runs) >= 2 else None
-    
-            higher_level_fsfs_all = []
+
+            feat_root, designs_root, outputs_root = _feat_roots(args.output_directory)
             for block in analysis_blocks:
-                first_level_root = os.path.join(
-                    args.output_directory,
-                    "fsl_feat_v6.0.7.4",
-                    block,
-                )
-                higher_level_design_dir = os.path.join(
-                    args.output_directory,
-                    "fsl_feat_v6.0.7.4",
-                    "higher_level_designs",
-                    block,
-                )
-                higher_level_output_dir = os.path.join(
-                    args.output_directory,
-                    "fsl_feat_v6.0.7.4",
-                    "higher_level_outputs",
-                    block,
-                )
+                first_level_root = os.path.join(feat_root, block)
+                higher_level_design_dir = os.path.join(designs_root, block)
+                higher_level_output_dir = os.path.join(outputs_root, block)
                 higher_level_fsfs = []
                 if run_pair is not None:
                     higher_level_fsfs = generate_higher_level_feat_files_main(
@@ -199,40 +429,224 @@ def main():
                         run_pair=run_pair,
                         subjects=subject_arg,
                         task_filters=args.task,
+                        template_src=templates["higher_level"],
                     )
-    
+
                 if higher_level_fsfs:
                     higher_level_fsfs_all.extend(higher_level_fsfs)
-    
-            # Run FEAT or emit FEAT commands for higher level.
-            run_feat_main(
-                higher_level_fsfs_all,
-                max_workers=args.max_workers,
-                write_commands=args.write_commands,
-                log_file=run_log_file,
-                dry_run=args.dry_run,
-                force=args.force,
-            )
 
-        append_log(run_log_file, f"=== End subject {subject_arg} ===")
-    
-    append_log(run_log_file, "=== End pipeline run ===")
+            # Run FEAT for higher level (collected by main() with --write_commands).
+            if not args.write_commands:
+                run_feat_main(
+                    higher_level_fsfs_all,
+                    max_workers=max_workers,
+                    log_file=subject_log,
+                    dry_run=args.dry_run,
+                    force=args.force,
+                    executor=executor,
+                )
+
+        # Preprocessing runs once per subject (not once per task). The three
+        # preprocessing steps only read raw inputs, so they run concurrently;
+        # design generation needs the confound and skull-stripped files they write.
+        _run_step_graph(
+            {
+                "motion_outliers": (motion_outliers, ()),
+                "synthstrip": (synthstrip, ()),
+                "extract_parameters": (extract_parameters, ()),
+                "design_files": (design_files, ("motion_outliers", "synthstrip", "extract_parameters")),
+                "first_level_feat": (first_level_feat, ("design_files",)),
+                "higher_level": (higher_level, ("first_level_feat",)),
+            },
+            after_step=lambda _name: subject_log.flush(),
+        )
+
+        append_log(subject_log, f"=== End subject {subject_arg} ===")
+        return first_level_fsfs, higher_level_fsfs_all
 
-    if args.track_resources:
-        end_time = time.time()
-        end_cpu_time = get_total_cpu_time()
-        peak_memory = get_total_memory_usage()
+def _write_hpc_commands(commands_file, results):
+    """Write FEAT commands for all subjects at once, plus SLURM array scripts.
+
+    First-level commands go to ``commands_file``; higher-level commands go to a
+    sibling ``<name>_higher_level<ext>`` file. Submit the higher-level array
+    with ``--dependency=afterok:<first-level job id>``.
+    """
+    first_level = [fsf for first, _ in results for fsf in first]
+    higher_level = [fsf for _, higher in results for fsf in higher]
+
+    stem, ext = os.path.splitext(commands_file)
+    for fsfs, path in ((first_level, commands_file), (higher_level, f"{stem}_higher_level{ext}")):
+        if not fsfs:
+            continue
+        write_feat_commands(fsfs, output_file=path, append=False)
+        script = f"{os.path.splitext(path)[0]}_submit.sh"
+        write_slurm_array_script(path, script, len(fsfs))
+        print(f"Wrote {len(fsfs)} FEAT command(s) to {path}; submit with: sbatch {script}")
+
+# Command-line interface: (flag, add_argument kwargs), in --help order.
+_ARGS = [
+    # Core arguments
+    ("--input_directory", dict(required=True, help="Input BIDS directory.")),
+    ("--output_directory", dict(required=True, help="Output directory.")),
+    ("--fsf_template", dict(required=True, help="Path to the .fsf template file.")),
+    ("--task", dict(nargs='+', required=True, help="One or more task names (e.g., --task hand language).")),
+    (
+        "--run",
+        dict(
+            nargs='+',
+            required=True,
+            help=(
+                "Run numbers to process (e.g., --run 1 2). Use '--run none' when the BOLD filename does not "
+                "contain a run label (e.g., sub-XXX_ses-YYY_task-T_bold.nii.gz)."
+            ),
+        ),
+    ),
+    ("--subjects", dict(nargs="+", required=False, help=("One or more subject IDs (e.g., sub-001 sub-002) OR a path to a text file containing subjects (comma/newline-separated). If omitted, process all subjects found in the input directory."))),
+    ("--custom_block", dict(nargs='*', default=[], help="Custom block inputs (optional).")),
+    ("--write_commands", dict(required=False, help="Instead of running FEAT locally, write all FEAT commands to this text file (plus a SLURM array submit script) for HPC execution.")),
+    ("--max_workers", dict(type=int, default=None, help="Maximum number of parallel workers (default: the CPUs this job may use, at most one per scan).")),
+    (
+        "--subject_workers",
+        dict(
+            type=int,
+            default=1,
+            help=(
+                "Number of subjects to process concurrently. The --max_workers budget is divided between them "
+                "(each subject's steps get max_workers // subject_workers workers)."
+            ),
+        ),
+    ),
+    (
+        "--subject_processes",
+        dict(
+            action="store_true",
+            help=(
+                "Run the concurrent subjects (--subject_workers) in separate worker processes instead of threads. "
+                "Each process runs its steps on its own pool of max_workers // subject_workers workers."
+            ),
+        ),
+    ),
+    ("--higher_level_fsf_template", dict(required=False, help="Path to the higher-level .fsf template file.")),
+    ("--dry_run", dict(action="store_true", help="Print/log commands but do not execute external tools")),
+    (
+        "--use_local_scratch",
+        dict(
+            action="store_true",
+            help=(
+                "Write each subject's outputs to node-local $TMPDIR first and copy them to --output_directory "
+                "when the subject finishes. The subject's existing outputs are copied in first so finished steps "
+                "are still skipped; if the subject fails, its scratch copy is kept (and its path logged)."
+            ),
+        ),
+    ),
+    ("--force", dict(action="store_true", help="Re-run steps even if outputs or completion manifests (output_directory/.cache) already exist")),
+    # New flag to track resources
+    ("--track_resources", dict(action="store_true", help="Track system resources and runtime usage.")),
+]
+
+@functools.lru_cache(maxsize=None)
+def _build_parser():
+    parser = argparse.ArgumentParser(description="Wrapper script to run all FSL Task Pipeline steps.")
+    for name, kwargs in _ARGS:
+        parser.add_argument(name, **kwargs)
+    return parser
+
+def main():
+    args = _build_parser().parse_args()
+
+    if args.use_local_scratch and args.write_commands:
+        _build_parser().error("--use_local_scratch cannot be combined with --write_commands (FSFs would point at scratch)")
+
+    # Fail before any subject is processed rather than deep into the run.
+    for flag, path in (("--fsf_template", args.fsf_template), ("--higher_level_fsf_template", args.higher_level_fsf_template)):
+        if path and not os.path.isfile(path):
+            _build_parser().error(f"{flag} not found: {path}")
+    templates = _read_templates(args)
+
+    runs = _parse_runs(args.run)
+
+    subjects_list = parse_subjects_arg(args.subjects)
+
+    # Determine subjects to process.
+    if subjects_list is not None:
+        subject_iter = subjects_list
+    else:
+        # Default: process every subject directory under input_directory.
+        # DirEntry.is_dir() uses the d_type from the directory listing, so only
+        # symlinked entries need a stat.
+        with os.scandir(args.input_directory) as it:
+            subject_iter = sorted(e.name for e in it if e.name.startswith("sub-") and e.is_dir())
+
+
+    tracker = ResourceTracker() if args.track_resources else contextlib.nullcontext()
+    with tracker:
+        # Run pipeline steps
+        # Preprocessing steps should run once, even if multiple tasks are requested.
+
+        run_log_file = create_instance_log_file(args.output_directory)
+        append_log(run_log_file, "=== Begin pipeline run ===")
+
+        # FEAT and fsl_motion_outliers are single-threaded and CPU-bound, so one
+        # tool process per allocated CPU keeps the node busy without thrashing it;
+        # there is no point in more workers than scans to process.
+        max_workers = args.max_workers or max(
+            1, min(available_cpus(), len(subject_iter) * len(args.task) * len(runs))
+        )
+        append_log(run_log_file, f"Using {max_workers} workers")
+
+        # Split the worker budget between concurrent subjects and the per-step pools
+        # so running several subjects at once does not oversubscribe the node.
+        subject_workers = max(1, min(args.subject_workers, len(subject_iter) or 1))
+        step_workers = max(1, max_workers // subject_workers)
+
+        if subject_workers > 1 and args.subject_processes:
+            # A thread pool cannot cross process boundaries, so each worker
+            # builds its own step pool (executor=None) from its step_workers share.
+            with ProcessPoolExecutor(max_workers=subject_workers, mp_context=process_pool_context()) as ex:
+                futures = [
+                    ex.submit(_process_subject, subject, args, runs, run_log_file, step_workers, None, templates)
+                    for subject in subject_iter
+                ]
+                results = [fut.result() for fut in futures]
+        else:
+            # One pool for every external-tool step of every subject: created once,
+            # and it caps the total number of concurrent tool processes at --max_workers.
+            with ThreadPoolExecutor(max_workers=max_workers) as step_executor:
+                if subject_workers == 1:
+                    results = [
+                        _process_subject(subject, args, runs, run_log_file, step_workers, step_executor, templates)
+                        for subject in subject_iter
+                    ]
+                else:
+                    # Threads are usually sufficient: every heavy step shells out to an external tool.
+                    with ThreadPoolExecutor(max_workers=subject_workers) as ex:
+                        futures = [
+                            ex.submit(
+                                _process_subject, subject, args, runs, run_log_file, step_workers, step_executor, templates
+                            )
+                            for subject in subject_iter
+                        ]
+                        results = [fut.result() for fut in futures]
+
+        if args.write_commands:
+            _write_hpc_commands(args.write_commands, results)
 
-        runtime = end_time - start_time
-        cpu_time_used = end_cpu_time - start_cpu_time
-        # Get resource usage for the current process.
-        usage = resource.getrusage(resource.RUSAGE_SELF)
+        append_log(run_log_file, "=== End pipeline run ===")
+
+    if args.track_resources:
+        try:
+            import resource  # Unix-specific
+        except ImportError:
+            resource = None
 
         print("\n--- Resource Usage Summary ---")
-        print(f"Total runtime: {runtime:.2f} seconds")
-        print(f"Total CPU time used: {cpu_time_used:.2f} seconds")
-        print(f"Peak memory usage: {peak_memory:.2f} MB")
-        print(f"Maximum resident set size (main process): {usage.ru_maxrss / 1024:.2f} MB")  # Convert KB to MB
+        print(f"Total runtime: {tracker.runtime:.2f} seconds")
+        print(f"Total CPU time used: {tracker.cpu_time_used:.2f} seconds")
+        print(f"Peak memory usage: {tracker.peak_memory_mb:.2f} MB")
+        if resource is not None:
+            # Get resource usage for the current process.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            print(f"Maximum resident set size (main process): {usage.ru_maxrss / 1024:.2f} MB")  # Convert KB to MB
         print("--------------------------------")
 
     print(f"Run log saved to: {run_log_file}")
@@ -1,8 +1,70 @@
 import os
 import sys
 
+import pytest
+
 
 # Ensure repo root is importable so tests can import `run_pipeline` and `utils`.
 REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 if REPO_ROOT not in sys.path:
     sys.path.insert(0, REPO_ROOT)
+
+
+@pytest.fixture(autouse=True)
+def _no_user_jinja_cache(monkeypatch):
+    # Keep the opt-in Jinja2 bytecode cache (see utils.templates) off unless a test enables it.
+    monkeypatch.delenv("FSL_PIPELINE_JINJA_CACHE", raising=False)
+
+
+@pytest.fixture(scope="session")
+def _shared_bids_trees(tmp_path_factory):
+    # relpaths -> input directory, built once per test session.
+    return {}
+
+
+@pytest.fixture
+def make_bids_tree(tmp_path, tmp_path_factory, _shared_bids_trees):
+    """Return a factory that writes dummy input files and an output path.
+
+    Takes paths relative to the input directory and returns
+    ``(input_dir, output_dir)`` as strings; output_dir is a fresh, uncreated
+    path under the test's tmp_path. By default the input tree is built once per
+    session and shared by every test asking for the same layout, so tests must
+    not modify it; pass ``shared=False`` for a private copy under tmp_path.
+    """
+    def _write(input_dir, relpaths):
+        for rel in relpaths:
+            path = input_dir / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("dummy data")
+
+    def _make(*relpaths, shared=True):
+        if shared:
+            input_dir = _shared_bids_trees.get(relpaths)
+            if input_dir is None:
+                input_dir = tmp_path_factory.mktemp("bids") / "input"
+                _write(input_dir, relpaths)
+                _shared_bids_trees[relpaths] = input_dir
+        else:
+            input_dir = tmp_path / "input"
+            _write(input_dir, relpaths)
+        return str(input_dir), str(tmp_path / "output")
+
+    return _make
+
+
+@pytest.fixture
+def fake_popen():
+    """Patch the Popen used by ``run_cmd(stream=True)`` with a successful, silent process.
+
+    Set ``fake_popen.output`` (a list of lines) or ``fake_popen.returncode``
+    before the call to change what the process produces.
+    """
+    from unittest.mock import MagicMock, patch
+
+    with patch("utils.command.subprocess.Popen") as popen:
+        popen.output, popen.returncode = [], 0
+        proc = popen.return_value.__enter__.return_value
+        proc.stdout.__iter__.side_effect = lambda: iter(popen.output)
+        proc.wait.side_effect = lambda: popen.returncode
+        yield popen
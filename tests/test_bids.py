@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+
+from utils.bids import discover_bids_files, iter_session_dirs, list_session_dirs, match_filters, parse_bids_entities
+
+
+def test_discover_bids_files_supports_session_and_sessionless_layouts(tmp_path):
+    (tmp_path / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    (tmp_path / "sub-001" / "ses-001" / "anat").mkdir(parents=True)
+    (tmp_path / "sub-002" / "func").mkdir(parents=True)
+    (tmp_path / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("x")
+    (tmp_path / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-hand_run-01_bold.json").write_text("{}")
+    (tmp_path / "sub-001" / "ses-001" / "anat" / "sub-001_ses-001_T1w.nii.gz").write_text("x")
+    (tmp_path / "sub-002" / "func" / "sub-002_task-rest_bold.nii.gz").write_text("x")
+
+    index = discover_bids_files(tmp_path)
+
+    assert [(f.subject, f.session, f.datatype) for f in index] == [
+        ("sub-001", "ses-001", "anat"),
+        ("sub-001", "ses-001", "func"),
+        ("sub-002", None, "func"),
+    ]
+    assert index[1].path == str(tmp_path / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-hand_run-01_bold.nii.gz")
+
+
+def test_discover_bids_files_filters_subjects_and_handles_missing_root(tmp_path):
+    (tmp_path / "sub-001" / "func").mkdir(parents=True)
+    (tmp_path / "sub-002" / "func").mkdir(parents=True)
+    (tmp_path / "sub-001" / "func" / "sub-001_task-rest_bold.nii.gz").write_text("x")
+    (tmp_path / "sub-002" / "func" / "sub-002_task-rest_bold.nii.gz").write_text("x")
+
+    assert [f.subject for f in discover_bids_files(tmp_path, ["sub-002"])] == ["sub-002"]
+    assert discover_bids_files(tmp_path / "missing") == ()
+
+
+def test_parse_bids_entities_from_path_tokens():
+    ents = parse_bids_entities("/data/sub-001/ses-pre/func/sub-001_ses-pre_task-hand_run-02_bold.nii.gz")
+    assert ents == {"subject": "001", "session": "pre", "task": "hand", "run": 2}
+
+    # Entities must be whole '_'/'/'-delimited tokens with alphanumeric values.
+    assert parse_bids_entities("sub-01_task-rest.nii.gz") == {"subject": "01", "session": None, "task": None, "run": None}
+    assert parse_bids_entities("xsub-01_run-x_run-3")["subject"] is None
+    assert parse_bids_entities("xsub-01_run-x_run-3")["run"] == 3
+
+
+def test_importing_bids_does_not_import_step_modules():
+    code = "import sys, utils.bids; print(sorted(m for m in sys.modules if m.startswith('utils.')))"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert out.stdout.strip() == "['utils.bids']"
+
+
+def test_parse_bids_entities_returns_independent_dicts():
+    name = "sub-001_ses-002_task-hand_run-03_bold.nii.gz"
+    first = parse_bids_entities(name)
+    first["run"] = 99
+
+    assert parse_bids_entities(name) == {"subject": "001", "session": "002", "task": "hand", "run": 3}
+
+
+def test_match_filters_runs_and_tasks():
+    run1 = {"subject": "001", "session": None, "task": "hand", "run": 1}
+    no_run = dict(run1, run=None)
+
+    assert match_filters(run1, task_filters=["hand", "rest"], run_filters=[1, 2])
+    assert not match_filters(run1, task_filters=["rest"])
+    assert not match_filters(run1, run_filters=[None])
+    assert match_filters(no_run, run_filters=[None])
+    assert not match_filters(no_run, run_filters=[1])
+    assert match_filters(no_run, run_filters=[])
+
+
+def test_iter_session_dirs_yields_sorted_session_directories(tmp_path):
+    for rel in ("sub-002/ses-001", "sub-001/ses-002", "sub-001/ses-001", "sub-003/anat"):
+        (tmp_path / rel).mkdir(parents=True)
+    (tmp_path / "sub-001" / "ses-notes.txt").write_text("not a session")
+    (tmp_path / "participants.tsv").write_text("")
+
+    assert list(iter_session_dirs(tmp_path)) == [
+        str(tmp_path / "sub-001" / "ses-001"),
+        str(tmp_path / "sub-001" / "ses-002"),
+        str(tmp_path / "sub-002" / "ses-001"),
+    ]
+    assert list_session_dirs(tmp_path / "sub-003") == []
@@ -0,0 +1,164 @@
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+
+from utils import command
+from utils.command import LogBuffer, append_log, create_instance_log_file, ensure_dir, run_cmd
+
+
+def test_append_log_writes_timestamped_line(tmp_path):
+    log_file = tmp_path / "logs" / "run.log"
+    append_log(str(log_file), "hello\n")
+
+    content = log_file.read_text()
+    assert content.startswith("[")
+    assert content.endswith("] hello\n")
+
+
+def test_append_log_opens_each_log_file_once(tmp_path):
+    log_file = tmp_path / "logs" / "reuse.log"
+
+    with patch("builtins.open", wraps=open) as mock_open:
+        for i in range(3):
+            append_log(str(log_file), f"line {i}")
+
+    assert mock_open.call_count == 1
+    # Line-buffered, so every line is on disk without an explicit flush.
+    assert [l.split("] ", 1)[1] for l in log_file.read_text().splitlines()] == ["line 0", "line 1", "line 2"]
+
+
+def test_log_buffer_flushes_once_on_exit(tmp_path):
+    log_file = tmp_path / "run.log"
+    with LogBuffer(str(log_file)) as buf:
+        append_log(buf, "first")
+        append_log(buf, "second")
+        assert log_file.read_text() == ""
+
+    lines = log_file.read_text().splitlines()
+    assert [line.split("] ", 1)[1] for line in lines] == ["first", "second"]
+
+
+def test_log_buffer_flushes_past_threshold_and_fsyncs_outside_log_lock(tmp_path):
+    log_file = tmp_path / "run.log"
+    locked_at_fsync = []
+
+    def fsync(fd):
+        locked_at_fsync.append(command._LOG_LOCK.locked())
+
+    with patch("utils.command.os.fsync", side_effect=fsync):
+        with LogBuffer(str(log_file), flush_bytes=1) as buf:
+            append_log(buf, "first")
+            assert log_file.read_text().endswith("] first\n")
+            append_log(buf, "second")
+
+    assert [l.split("] ", 1)[1] for l in log_file.read_text().splitlines()] == ["first", "second"]
+    assert locked_at_fsync == [False, False]
+
+
+def test_run_cmd_resolves_executable_without_shell(tmp_path):
+    tool = tmp_path / "fake_tool"
+    tool.write_text("#!/bin/sh\necho \"$@\"\n")
+    tool.chmod(0o755)
+
+    with patch("utils.command.subprocess.run") as mock_run:
+        run_cmd(["fake_tool", "-i", "in.nii.gz"], env={"PATH": str(tmp_path)})
+
+    args, kwargs = mock_run.call_args
+    assert args[0] == ["fake_tool", "-i", "in.nii.gz"]
+    assert kwargs["executable"] == str(tool)
+    assert kwargs["close_fds"] is False
+    assert kwargs["stdin"] is subprocess.DEVNULL
+    assert "shell" not in kwargs and "preexec_fn" not in kwargs
+
+
+def test_run_cmd_resolves_tools_installed_after_a_failed_lookup(tmp_path):
+    env = {"PATH": str(tmp_path)}
+    with patch("utils.command.subprocess.run") as mock_run:
+        run_cmd(["late_tool"], env=env)
+        assert mock_run.call_args.kwargs["executable"] is None
+
+        tool = tmp_path / "late_tool"
+        tool.write_text("#!/bin/sh\n")
+        tool.chmod(0o755)
+        run_cmd(["late_tool"], env=env)
+
+    assert mock_run.call_args.kwargs["executable"] == str(tool)
+
+
+def test_ensure_dir_creates_each_directory_once(tmp_path):
+    created = set()
+    target = tmp_path / "designs"
+
+    with patch("utils.command.os.makedirs", wraps=os.makedirs) as mock_makedirs:
+        ensure_dir(target, created)
+        ensure_dir(target, created)
+
+    assert target.is_dir()
+    assert mock_makedirs.call_count == 1
+
+
+def test_run_cmd_stream_logs_output_lines(tmp_path):
+    tool = tmp_path / "noisy_tool"
+    tool.write_text("#!/bin/sh\necho progress 1\necho progress 2 >&2\nexit 3\n")
+    tool.chmod(0o755)
+    log_file = tmp_path / "run.log"
+
+    with pytest.raises(subprocess.CalledProcessError):
+        run_cmd([str(tool)], log_file=str(log_file), stream=True)
+
+    lines = [l.split("] ", 1)[1] for l in log_file.read_text().splitlines()]
+    assert lines == [f"$ {tool}", "output (last 2 lines):", "progress 1", "progress 2"]
+
+
+def test_run_cmd_stream_keeps_only_output_tail_and_logs_nothing_on_success(tmp_path):
+    tool = tmp_path / "chatty_tool"
+    tool.write_text("#!/bin/sh\nseq 1 5\nexit \"$1\"\n")
+    tool.chmod(0o755)
+    log_file = tmp_path / "run.log"
+
+    with patch("utils.command._STREAM_TAIL_LINES", 2):
+        run_cmd([str(tool), "0"], log_file=str(log_file), stream=True)
+        with pytest.raises(subprocess.CalledProcessError):
+            run_cmd([str(tool), "1"], log_file=str(log_file), stream=True)
+
+    lines = [l.split("] ", 1)[1] for l in log_file.read_text().splitlines()]
+    assert lines == [f"$ {tool} 0", f"$ {tool} 1", "output (last 2 lines):", "4", "5"]
+
+
+def test_log_timestamp_matches_isoformat_seconds():
+    from datetime import datetime
+
+    before = datetime.now().replace(microsecond=0)
+    line = command._format_log_line("hello")
+    ts = line[1:line.index("]")]
+
+    assert ts == datetime.fromisoformat(ts).isoformat(timespec="seconds")
+    assert before <= datetime.fromisoformat(ts) <= datetime.now()
+    assert line.endswith("] hello\n")
+
+
+def test_run_cmd_logs_shell_quoted_command(tmp_path):
+    log_file = tmp_path / "run.log"
+    run_cmd(["feat", "my design.fsf", "it's"], log_file=str(log_file), dry_run=True)
+
+    assert log_file.read_text().endswith("""] $ feat 'my design.fsf' 'it'"'"'s'\n""")
+
+
+def test_run_cmd_skips_quoting_without_log_file():
+    with patch("utils.command.shlex.join") as mock_join:
+        run_cmd(["feat", "design.fsf"], dry_run=True)
+
+    mock_join.assert_not_called()
+
+
+def test_instance_log_file_is_created_with_the_handle_append_log_uses(tmp_path):
+    with patch("builtins.open", wraps=open) as mock_open:
+        log_file = create_instance_log_file(tmp_path / "out")
+        append_log(log_file, "=== Begin pipeline run ===")
+
+    assert mock_open.call_count == 1
+    assert os.path.dirname(log_file) == str(tmp_path / "out" / "logs")
+    assert log_file.endswith(f"_{os.getpid()}.log")
+    assert open(log_file).read().endswith("] === Begin pipeline run ===\n")
@@ -1,32 +1,36 @@
 import os
+import re
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock
 from utils import extract_parameters  # Update based on your directory structure
 
-# Fixture to create a mock directory structure
-@pytest.fixture
-def mock_file_structure(tmp_path):
-    base_dir = tmp_path / "input"
-    output_dir = tmp_path / "output"
+_CONFIG_RE = re.compile(
+    r"TOTAL_REPETITION_TIME = 2\.5\nTOTAL_FRAMES = 200\nDISCARD_FRAMES = 2\n"
+)
 
-    os.makedirs(base_dir / "sub-001" / "ses-001" / "func", exist_ok=True)
-    os.makedirs(base_dir / "sub-002" / "ses-002" / "func", exist_ok=True)
 
-    # Create dummy .nii.gz files
-    (base_dir / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-rest_run-01_bold.nii.gz").write_text("dummy data")
-    (base_dir / "sub-002" / "ses-002" / "func" / "sub-002_ses-002_task-rest_run-01_bold.nii.gz").write_text("dummy data")
+# One mocked NIfTI image (TR 2.5 s, 200 frames) shared by every test in the module.
+@pytest.fixture(scope="module")
+def mock_nifti():
+    nifti = MagicMock()
+    nifti.header.get_zooms.return_value = (2.0, 2.0, 2.0, 2.5)  # Dummy TR
+    nifti.header.get_data_shape.return_value = (64, 64, 33, 200)  # Dummy shape with 200 frames
+    type(nifti).shape = PropertyMock(side_effect=AssertionError("image shape read instead of header"))
+    return nifti
 
-    return str(base_dir), str(output_dir)
+# Fixture to create a mock directory structure
+@pytest.fixture
+def mock_file_structure(make_bids_tree):
+    return make_bids_tree(
+        "sub-001/ses-001/func/sub-001_ses-001_task-rest_run-01_bold.nii.gz",
+        "sub-002/ses-002/func/sub-002_ses-002_task-rest_run-01_bold.nii.gz",
+        shared=False,  # test_non_nifti_files adds a file to the input tree
+    )
 
 # Test the extract_and_write_scan_info function
-def test_extract_and_write_scan_info(mock_file_structure):
+def test_extract_and_write_scan_info(mock_file_structure, mock_nifti):
     base_dir, output_dir = mock_file_structure
 
-    # Mock nibabel's nib.load and header properties
-    mock_nifti = MagicMock()
-    mock_nifti.header.get_zooms.return_value = (2.0, 2.0, 2.0, 2.5)  # Dummy TR
-    mock_nifti.shape = (64, 64, 33, 200)  # Dummy shape with 200 frames
-
     with patch.object(extract_parameters.nib, "load", return_value=mock_nifti):
         extract_parameters.extract_and_write_scan_info(base_dir, output_dir)
 
@@ -53,10 +57,7 @@ def test_extract_and_write_scan_info(mock_file_structure):
 
     # Verify contents of one configuration file
     with open(sub_001_config, "r") as config_file:
-        config_content = config_file.read()
-        assert "TOTAL_REPETITION_TIME = 2.5" in config_content
-        assert "TOTAL_FRAMES = 200" in config_content
-        assert "DISCARD_FRAMES = 2" in config_content
+        assert _CONFIG_RE.search(config_file.read())
 
 # Test skipping existing configurations
 def test_skip_existing_configuration(mock_file_structure):
@@ -97,7 +98,7 @@ def test_non_nifti_files(mock_file_structure):
     assert len(os.listdir(config_dir)) == 1  # Only the valid .nii.gz file's config exists
 
 
-def test_run_none_filters_only_no_run_files(tmp_path):
+def test_run_none_filters_only_no_run_files(tmp_path, mock_nifti):
     base_dir = tmp_path / "input"
     output_dir = tmp_path / "output"
     os.makedirs(base_dir / "sub-001" / "ses-001" / "func", exist_ok=True)
@@ -106,10 +107,6 @@ def test_run_none_filters_only_no_run_files(tmp_path):
     (base_dir / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-rest_run-01_bold.nii.gz").write_text("dummy")
     (base_dir / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-rest_bold.nii.gz").write_text("dummy")
 
-    mock_nifti = MagicMock()
-    mock_nifti.header.get_zooms.return_value = (2.0, 2.0, 2.0, 2.5)
-    mock_nifti.shape = (64, 64, 33, 200)
-
     with patch.object(extract_parameters.nib, "load", return_value=mock_nifti):
         extract_parameters.extract_and_write_scan_info(
             str(base_dir),
@@ -138,3 +135,69 @@ def test_extract_and_write_scan_info_raises_when_file_fails(mock_file_structure)
     with patch.object(extract_parameters.nib, "load", side_effect=RuntimeError("bad nifti")):
         with pytest.raises(RuntimeError, match="Failed processing"):
             extract_parameters.extract_and_write_scan_info(base_dir, output_dir)
+
+
+def test_non_bold_files_skip_entity_parsing(mock_file_structure, mock_nifti):
+    base_dir, output_dir = mock_file_structure
+    sidecar = os.path.join(base_dir, "sub-001", "ses-001", "func", "sub-001_ses-001_task-rest_run-01_bold.json")
+    with open(sidecar, "w") as f:
+        f.write("{}")
+
+    with patch.object(extract_parameters.nib, "load", return_value=mock_nifti), \
+         patch("utils.extract_parameters.parse_bids_entities", wraps=extract_parameters.parse_bids_entities) as parse:
+        extract_parameters.extract_and_write_scan_info(base_dir, output_dir)
+
+    parsed = [c.args[0] for c in parse.call_args_list]
+    assert parsed and all(name.endswith("_bold.nii.gz") for name in parsed)
+
+
+def test_iter_func_files_lists_tree_without_stat_per_entry(mock_file_structure):
+    base_dir, _ = mock_file_structure
+    open(os.path.join(base_dir, "participants.tsv"), "w").close()
+
+    with patch("os.path.isdir", side_effect=AssertionError("isdir called")):
+        found = list(extract_parameters._iter_func_files(base_dir))
+
+    assert [(sub, ses, name) for sub, ses, name, _ in found] == [
+        ("sub-001", "ses-001", "sub-001_ses-001_task-rest_run-01_bold.nii.gz"),
+        ("sub-002", "ses-002", "sub-002_ses-002_task-rest_run-01_bold.nii.gz"),
+    ]
+
+
+def test_rerun_skips_directory_creation_for_existing_configs(mock_file_structure, mock_nifti):
+    base_dir, output_dir = mock_file_structure
+    with patch.object(extract_parameters.nib, "load", return_value=mock_nifti):
+        extract_parameters.extract_and_write_scan_info(base_dir, output_dir)
+
+    with patch.object(extract_parameters.nib, "load") as mock_load, \
+         patch("utils.extract_parameters.ensure_dir") as mock_ensure_dir:
+        extract_parameters.extract_and_write_scan_info(base_dir, output_dir)
+
+    mock_load.assert_not_called()
+    mock_ensure_dir.assert_not_called()
+
+
+def test_iter_func_files_filters_subjects_from_one_listing(mock_file_structure):
+    base_dir, _ = mock_file_structure
+
+    found = list(extract_parameters._iter_func_files(base_dir, ["sub-002", "sub-404"]))
+
+    assert [(sub, ses) for sub, ses, _, _ in found] == [("sub-002", "ses-002")]
+
+
+def test_headers_are_read_concurrently(mock_file_structure, mock_nifti):
+    import threading
+
+    base_dir, output_dir = mock_file_structure
+    # Both header reads must be in flight at once to get past the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def load(path):
+        barrier.wait()
+        return mock_nifti
+
+    with patch.object(extract_parameters.nib, "load", side_effect=load):
+        extract_parameters.extract_and_write_scan_info(base_dir, output_dir, max_workers=2)
+
+    configs = os.path.join(output_dir, "fsl_feat_v6.0.7.4", "configurations")
+    assert sorted(os.listdir(configs)) == ["sub-001", "sub-002"]
@@ -1,5 +1,7 @@
 import os
 
+import pytest
+
 from utils import generate_design_files
 
 
@@ -34,18 +36,20 @@ def test_main_generates_fsf(tmp_path):
     input_dir = tmp_path / "input"
     output_dir = tmp_path / "output"
     template_path = tmp_path / "templates" / "standard_design_template.fsf"
-    os.makedirs(input_dir / "sub-001" / "ses-001" / "func", exist_ok=True)
+    func_dir = input_dir / "sub-001" / "ses-001" / "func"
+    func_dir.mkdir(parents=True, exist_ok=True)
+    input_dir_s, output_dir_s, template_s = map(str, (input_dir, output_dir, template_path))
 
-    (input_dir / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
+    (func_dir / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
 
     config_path = output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001" / "sub-001_ses-001_task-hand_run-01_configuration.md"
     write_config(config_path)
     write_template(template_path)
 
     generated = generate_design_files.main(
-            fsf_template=str(template_path),
-            output_directory=str(output_dir),
-            input_directory=str(input_dir),
+            fsf_template=template_s,
+            output_directory=output_dir_s,
+            input_directory=input_dir_s,
             task="hand",
             custom_block=[],
             subjects=None,
@@ -61,15 +65,17 @@ def test_main_skips_missing_config(tmp_path):
     input_dir = tmp_path / "input"
     output_dir = tmp_path / "output"
     template_path = tmp_path / "templates" / "standard_design_template.fsf"
-    os.makedirs(input_dir / "sub-001" / "ses-001" / "func", exist_ok=True)
+    func_dir = input_dir / "sub-001" / "ses-001" / "func"
+    func_dir.mkdir(parents=True, exist_ok=True)
+    input_dir_s, output_dir_s, template_s = map(str, (input_dir, output_dir, template_path))
 
-    (input_dir / "sub-001" / "ses-001" / "func" / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
+    (func_dir / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
     write_template(template_path)
 
     generated = generate_design_files.main(
-            fsf_template=str(template_path),
-            output_directory=str(output_dir),
-            input_directory=str(input_dir),
+            fsf_template=template_s,
+            output_directory=output_dir_s,
+            input_directory=input_dir_s,
             task="hand",
             custom_block=[],
             subjects=None,
@@ -86,3 +92,201 @@ def test_parse_config_file_supports_equals_in_value(tmp_path):
 
     assert parsed["A"] == "simple"
     assert parsed["B"] == "value=with=equals"
+
+
+def test_load_template_compiles_each_template_once(tmp_path):
+    template_path = str(tmp_path / "templates" / "standard_design_template.fsf")
+    write_template(template_path)
+
+    first = generate_design_files.load_template(template_path)
+    assert generate_design_files.load_template(template_path) is first
+    assert "set fmri(tr) 2.5" in first.render(TOTAL_REPETITION_TIME=2.5)
+
+    with open(template_path) as f:
+        src = f.read()
+    from_src = generate_design_files.load_template(template_path, src)
+    assert generate_design_files.load_template(template_path, src) is from_src
+
+
+def test_parse_config_file_reparses_after_rewrite(tmp_path):
+    config_path = tmp_path / "cfg.md"
+    config_path.write_text("TOTAL_FRAMES = 150\n")
+    first = generate_design_files.parse_config_file(str(config_path))
+    first["TOTAL_FRAMES"] = "mutated"
+
+    assert generate_design_files.parse_config_file(str(config_path)) == {"TOTAL_FRAMES": "150"}
+
+    config_path.write_text("TOTAL_FRAMES = 200\n")
+    os.utime(config_path, ns=(0, 10**18))
+    assert generate_design_files.parse_config_file(str(config_path)) == {"TOTAL_FRAMES": "200"}
+
+
+@pytest.mark.parametrize("process_pool_min_scans", [50, 2])
+def test_main_renders_scans_concurrently_in_order(tmp_path, monkeypatch, process_pool_min_scans):
+    # 2 forces the worker-process path for the three scans below.
+    monkeypatch.setattr(generate_design_files, "_PROCESS_POOL_MIN_SCANS", process_pool_min_scans)
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    template_path = tmp_path / "templates" / "standard_design_template.fsf"
+    (input_dir / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    write_template(str(template_path))
+    config_dir = output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001"
+    for run in (1, 2, 3):
+        write_config(str(config_dir / f"sub-001_ses-001_task-hand_run-{run:02d}_configuration.md"))
+
+    generated = generate_design_files.main(
+        fsf_template=str(template_path),
+        output_directory=str(output_dir),
+        input_directory=str(input_dir),
+        task="hand",
+        custom_block=[],
+        subjects=None,
+        runs=[1, 2, 3],
+        max_workers=3,
+    )
+
+    design_dir = output_dir / "fsl_feat_v6.0.7.4" / "subject_designs"
+    assert generated == [str(design_dir / f"sub-001_ses-001_task-hand_run-{run:02d}.fsf") for run in (1, 2, 3)]
+
+
+def test_main_detects_confounds_from_directory_listing(tmp_path):
+    output_dir = tmp_path / "output"
+    template_path = tmp_path / "templates" / "standard_design_template.fsf"
+    (tmp_path / "input" / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    template_path.parent.mkdir(parents=True)
+    template_path.write_text("{{ fmri_confoundevs }} {{ FULL_CONFOUND_PATH }}\n")
+    for run in (1, 2):
+        write_config(
+            output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001"
+            / f"sub-001_ses-001_task-hand_run-{run:02d}_configuration.md"
+        )
+    motion_func = output_dir / "fsl_motion-outliers_v6.0.7.4" / "sub-001" / "ses-001" / "func"
+    motion_func.mkdir(parents=True)
+    confounds = motion_func / "sub-001_ses-001_task-hand_run-01_confounds.txt"
+    confounds.write_text("")
+
+    run1, run2 = generate_design_files.main(
+        fsf_template=str(template_path),
+        output_directory=str(output_dir),
+        input_directory=str(tmp_path / "input"),
+        task="hand",
+        custom_block=[],
+        subjects=None,
+        runs=[1, 2],
+        max_workers=1,
+    )
+
+    assert open(run1).read() == f"1 {confounds}"
+    assert open(run2).read() == "0 None"
+
+
+def test_main_checks_custom_design_files_once(tmp_path, capsys):
+    output_dir = tmp_path / "output"
+    template_path = tmp_path / "templates" / "standard_design_template.fsf"
+    (tmp_path / "input" / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    write_template(template_path)
+    (tmp_path / "templates" / "motor.txt").write_text("")
+    for run in (1, 2):
+        write_config(
+            output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001"
+            / f"sub-001_ses-001_task-hand_run-{run:02d}_configuration.md"
+        )
+
+    generated = generate_design_files.main(
+        fsf_template=str(template_path),
+        output_directory=str(output_dir),
+        input_directory=str(tmp_path / "input"),
+        task="hand",
+        custom_block=["standard", "motor"],
+        subjects=None,
+        runs=[1, 2],
+        max_workers=1,
+    )
+
+    assert len(generated) == 4
+    assert capsys.readouterr().out.count("Custom design file not found") == 1
+    motor = [p for p in generated if p.endswith("_motor.fsf")]
+    assert all(f"custom) {tmp_path / 'templates' / 'motor.txt'}" in open(p).read() for p in motor)
+
+
+def test_main_skips_up_to_date_designs(tmp_path, monkeypatch):
+    output_dir = tmp_path / "output"
+    template_path = tmp_path / "templates" / "standard_design_template.fsf"
+    (tmp_path / "input" / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    write_template(template_path)
+    config_path = (
+        output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001"
+        / "sub-001_ses-001_task-hand_run-01_configuration.md"
+    )
+    write_config(config_path)
+    kwargs = dict(
+        fsf_template=str(template_path),
+        output_directory=str(output_dir),
+        input_directory=str(tmp_path / "input"),
+        task="hand",
+        custom_block=[],
+        subjects=None,
+        runs=[1],
+    )
+    first = generate_design_files.main(**kwargs)
+
+    rendered = []
+    real_generate_fsf = generate_design_files.generate_fsf
+    monkeypatch.setattr(
+        generate_design_files, "generate_fsf", lambda **job: rendered.append(job) or real_generate_fsf(**job)
+    )
+    assert generate_design_files.main(**kwargs) == first
+    assert rendered == []
+
+    assert generate_design_files.main(**kwargs, force=True) == first
+    assert len(rendered) == 1
+
+    # A newer configuration makes the design stale again.
+    fsf_mtime = os.stat(first[0]).st_mtime_ns
+    os.utime(config_path, ns=(fsf_mtime + 10**9, fsf_mtime + 10**9))
+    assert generate_design_files.main(**kwargs) == first
+    assert len(rendered) == 2
+
+
+def test_main_rerenders_when_confounds_or_directories_change(tmp_path, monkeypatch):
+    output_dir = tmp_path / "output"
+    template_path = tmp_path / "templates" / "standard_design_template.fsf"
+    for root in ("input", "input2"):
+        (tmp_path / root / "sub-001" / "ses-001" / "func").mkdir(parents=True)
+    write_template(template_path)
+    write_config(
+        output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "ses-001"
+        / "sub-001_ses-001_task-hand_run-01_configuration.md"
+    )
+    confounds = (
+        output_dir / "fsl_motion-outliers_v6.0.7.4" / "sub-001" / "ses-001" / "func"
+        / "sub-001_ses-001_task-hand_run-01_confounds.txt"
+    )
+    confounds.parent.mkdir(parents=True)
+    confounds.write_text("0\n")
+    kwargs = dict(
+        fsf_template=str(template_path),
+        output_directory=str(output_dir),
+        input_directory=str(tmp_path / "input"),
+        task="hand",
+        custom_block=[],
+        subjects=None,
+        runs=[1],
+    )
+    generate_design_files.main(**kwargs)
+
+    rendered = []
+    real_generate_fsf = generate_design_files.generate_fsf
+    monkeypatch.setattr(
+        generate_design_files, "generate_fsf", lambda **job: rendered.append(job) or real_generate_fsf(**job)
+    )
+    generate_design_files.main(**kwargs)
+    assert rendered == []
+
+    # Deleting the confounds leaves every mtime alone but changes the inputs.
+    confounds.unlink()
+    generate_design_files.main(**kwargs)
+    assert len(rendered) == 1
+
+    generate_design_files.main(**{**kwargs, "input_directory": str(tmp_path / "input2")})
+    assert len(rendered) == 2
@@ -97,3 +97,16 @@ def test_higher_level_filters_subjects_and_tasks(tmp_path):
     expected_fsf_sub2 = design_output_dir / "sub-002" / "ses-001" / "sub-002_ses-001_task-rest_runs-01-02.fsf"
     assert expected_fsf_sub1.exists()
     assert not expected_fsf_sub2.exists()
+
+
+def test_collect_feat_dirs_skips_feat_contents_and_other_subjects(tmp_path):
+    input_dir = tmp_path / "first_level"
+    wanted = input_dir / "sub-001" / "ses-001" / "sub-001_ses-001_task-hand_run-01.feat"
+    # Directories nested inside a FEAT dir or under an excluded subject are never reported.
+    os.makedirs(wanted / "stats" / "sub-001_ses-001_task-hand_run-09", exist_ok=True)
+    os.makedirs(input_dir / "sub-002" / "ses-001" / "sub-002_ses-001_task-hand_run-01.feat", exist_ok=True)
+
+    entries = generate_higher_level_feat_files.collect_feat_dirs(str(input_dir), subjects=["sub-001"])
+
+    assert [e["path"] for e in entries] == [str(wanted)]
+    assert entries[0]["run"] == 1
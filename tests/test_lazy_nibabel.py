@@ -0,0 +1,24 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from utils.lazy_nibabel import LazyNibabel
+
+
+def test_lazy_nibabel_imports_on_first_use():
+    fake = MagicMock()
+    nib = LazyNibabel()
+    with patch("utils.lazy_nibabel.importlib.import_module", return_value=fake) as mock_import:
+        assert nib.load is fake.load
+        assert nib.save is fake.save
+
+    mock_import.assert_called_once_with("nibabel")
+
+
+def test_lazy_nibabel_missing_module_raises_on_call():
+    nib = LazyNibabel()
+    with patch("utils.lazy_nibabel.importlib.import_module", side_effect=ModuleNotFoundError("nibabel")):
+        load = nib.load
+
+    with pytest.raises(ModuleNotFoundError, match="pip install nibabel"):
+        load("x.nii.gz")
@@ -1,24 +1,22 @@
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 from utils import run_motion_outliers
+from utils.bids import discover_bids_files
 
 
 @pytest.fixture
-def mock_file_structure(tmp_path):
-    input_dir = tmp_path / "input"
-    output_dir = tmp_path / "output"
-    os.makedirs(input_dir / "sub-001" / "func", exist_ok=True)
-    os.makedirs(input_dir / "sub-002" / "func", exist_ok=True)
-
-    # Create dummy .nii.gz files
-    (input_dir / "sub-001" / "func" / "sub-001_task-rest_bold.nii.gz").write_text("dummy data")
-    (input_dir / "sub-002" / "func" / "sub-002_task-rest_bold.nii.gz").write_text("dummy data")
-
-    return str(input_dir), str(output_dir)
+def mock_file_structure(make_bids_tree):
+    return make_bids_tree(
+        "sub-001/func/sub-001_task-rest_bold.nii.gz",
+        "sub-002/func/sub-002_task-rest_bold.nii.gz",
+    )
 
 
-def test_process_file(mock_file_structure):
+def test_process_file(mock_file_structure, fake_popen):
     input_dir, output_dir = mock_file_structure
     input_file = os.path.join(input_dir, "sub-001", "func", "sub-001_task-rest_bold.nii.gz")
     output_file = os.path.join(
@@ -30,23 +28,22 @@ def test_process_file(mock_file_structure):
     )
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    # run_cmd delegates to utils.command.subprocess.run
-    with patch("utils.command.subprocess.run") as mock_run:
-        mock_run.return_value = MagicMock()
-        run_motion_outliers.process_file(input_file, output_file, {"dummy_scan_rules": [], "default_dummy": 2})
-        mock_run.assert_called_once()
-        args, kwargs = mock_run.call_args
-        assert args[0] == [
-            "fsl_motion_outliers",
-            "-i",
-            input_file,
-            "-o",
-            output_file,
-            "--dummy=2",
-            "-v",
-            "--dvars",
-        ]
-        assert kwargs.get("check") is True
+    # The tool's output is streamed through utils.command.subprocess.Popen
+    run_motion_outliers.process_file(input_file, output_file, {"dummy_scan_rules": [], "default_dummy": 2})
+    fake_popen.assert_called_once()
+    args, kwargs = fake_popen.call_args
+    assert args[0] == [
+        "fsl_motion_outliers",
+        "-i",
+        input_file,
+        "-o",
+        output_file,
+        "--dummy=2",
+        "-v",
+        "--dvars",
+    ]
+    assert kwargs["stderr"] is subprocess.STDOUT
+    assert not kwargs.get("shell")  # argv list, no /bin/sh in between
 
 def test_main(mock_file_structure):
     input_dir, output_dir = mock_file_structure
@@ -72,9 +69,9 @@ def test_skip_existing_output(mock_file_structure):
     with open(output_file, "w") as f:
         f.write("existing output")
 
-    with patch("utils.command.subprocess.run") as mock_run:
+    with patch("utils.command.subprocess.Popen") as mock_popen:
         run_motion_outliers.process_file(input_file, output_file, {"dummy_scan_rules": [], "default_dummy": 2})
-        mock_run.assert_not_called()  # Should skip since the output exists
+        mock_popen.assert_not_called()  # Should skip since the output exists
 
 
 def test_main_propagates_worker_exceptions(mock_file_structure):
@@ -83,3 +80,112 @@ def test_main_propagates_worker_exceptions(mock_file_structure):
     with patch("utils.run_motion_outliers.process_file", side_effect=RuntimeError("boom")):
         with pytest.raises(RuntimeError, match="boom"):
             run_motion_outliers.main(input_dir, output_dir, None, max_workers=2)
+
+
+def test_main_uses_file_index(mock_file_structure):
+    input_dir, output_dir = mock_file_structure
+    file_index = discover_bids_files(input_dir, ["sub-002"])
+
+    with patch("utils.run_motion_outliers.process_file") as mock_process:
+        run_motion_outliers.main(input_dir, output_dir, None, max_workers=2, file_index=file_index)
+        assert mock_process.call_count == 1
+        assert mock_process.call_args.args[0].endswith("sub-002_task-rest_bold.nii.gz")
+
+
+def test_main_uses_shared_executor_without_shutting_it_down(mock_file_structure):
+    input_dir, output_dir = mock_file_structure
+
+    with ThreadPoolExecutor(max_workers=2) as shared, \
+         patch("utils.run_motion_outliers.process_file") as mock_process:
+        run_motion_outliers.main(input_dir, output_dir, None, executor=shared)
+        assert mock_process.call_count == 2
+        # The shared pool is still usable by later steps.
+        assert shared.submit(lambda: "ok").result() == "ok"
+
+
+def test_process_batch_attempts_every_file_before_raising():
+    calls = []
+
+    def fake_process_file(input_path, output_path, config, **kwargs):
+        calls.append(input_path)
+        if input_path == "a.nii.gz":
+            raise RuntimeError("boom")
+
+    with patch("utils.run_motion_outliers.process_file", side_effect=fake_process_file):
+        with pytest.raises(RuntimeError, match="boom"):
+            run_motion_outliers.process_batch([("a.nii.gz", "a.txt"), ("b.nii.gz", "b.txt")], {})
+
+    assert calls == ["a.nii.gz", "b.nii.gz"]
+
+
+def test_main_skips_existing_outputs_from_directory_listing(mock_file_structure):
+    input_dir, output_dir = mock_file_structure
+    existing = os.path.join(output_dir, "fsl_motion-outliers_v6.0.7.4", "sub-001", "func", "sub-001_task-rest_bold_confounds.txt")
+    os.makedirs(os.path.dirname(existing))
+    with open(existing, "w") as f:
+        f.write("0\n")
+
+    with patch("utils.run_motion_outliers.process_file") as mock_process:
+        run_motion_outliers.main(input_dir, output_dir, None, max_workers=2)
+
+    # Existence comes from one listing per output directory, not a stat per output.
+    assert mock_process.call_count == 2
+    assert {c.kwargs["existing_outputs"] for c in mock_process.call_args_list} == {frozenset({existing})}
+
+
+def test_get_dummy_scans_uses_rule_index_with_first_match():
+    from utils.find_dummy import _index_rules, get_dummy_scans
+
+    config = {
+        "dummy_scan_rules": [{"frames": 39, "dummy": 9}, {"frames": 39, "dummy": 1}, {"frames": 114}],
+        "default_dummy": 3,
+    }
+    assert get_dummy_scans(39, config) == 9
+    assert get_dummy_scans(114, config) == 3
+    assert get_dummy_scans(200, config) == 3
+
+    config["_rule_index"] = _index_rules(config)
+    config["dummy_scan_rules"] = []
+    assert get_dummy_scans(39, config) == 9
+
+
+def test_load_config_reads_settings_once():
+    from utils import find_dummy
+
+    find_dummy.load_config.cache_clear()
+    with patch("utils.find_dummy._try_load", wraps=find_dummy._try_load) as try_load:
+        first = find_dummy.load_config()
+        assert find_dummy.load_config() is first
+    assert try_load.call_count <= 2
+    find_dummy.load_config.cache_clear()
+
+
+def test_motion_input_walk_skips_other_modalities(tmp_path):
+    sub = tmp_path / "sub-001"
+    for d in ("ses-001/func", "ses-001/anat", "ses-001/fmap"):
+        (sub / d).mkdir(parents=True)
+    bold = sub / "ses-001" / "func" / "sub-001_ses-001_task-rest_bold.nii.gz"
+    bold.write_bytes(b"")
+
+    with patch("utils.run_motion_outliers.os.scandir", wraps=os.scandir) as scandir:
+        files = list(run_motion_outliers._iter_func_files([str(sub)]))
+
+    assert files == [str(bold)]
+    listed = {c.args[0] for c in scandir.call_args_list}
+    assert str(sub / "ses-001" / "anat") not in listed
+    assert str(sub / "ses-001" / "fmap") not in listed
+
+
+def test_process_file_dry_run_does_not_load_nibabel(tmp_path, fake_popen, capsys):
+    input_file = tmp_path / "sub-001_task-rest_bold.nii.gz"
+    input_file.write_bytes(b"not a nifti header")
+
+    with patch("utils.run_motion_outliers.nib") as nib:
+        run_motion_outliers.process_file(
+            str(input_file), str(tmp_path / "confounds.txt"), {"default_dummy": 3}, dry_run=True
+        )
+
+    nib.load.assert_not_called()
+    fake_popen.assert_not_called()
+    # Falling back to the default dummy count is expected in a preview, not an error.
+    assert "Error loading" not in capsys.readouterr().out
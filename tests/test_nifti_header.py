@@ -0,0 +1,35 @@
+import gzip
+import struct
+
+import pytest
+
+from utils.nifti_header import read_nifti1_shape
+
+
+def nifti1_header(dims, endian="<"):
+    header = bytearray(348)
+    struct.pack_into(f"{endian}i", header, 0, 348)
+    struct.pack_into(f"{endian}8h", header, 40, len(dims), *dims, *([1] * (7 - len(dims))))
+    return bytes(header)
+
+
+def test_read_nifti1_shape_from_gzipped_file(tmp_path):
+    path = tmp_path / "sub-001_task-rest_bold.nii.gz"
+    path.write_bytes(gzip.compress(nifti1_header((64, 64, 30, 184)) + b"\0" * 1024))
+
+    assert read_nifti1_shape(str(path)) == (64, 64, 30, 184)
+
+
+def test_read_nifti1_shape_big_endian_uncompressed(tmp_path):
+    path = tmp_path / "sub-001_T1w.nii"
+    path.write_bytes(nifti1_header((176, 256, 256), endian=">"))
+
+    assert read_nifti1_shape(str(path)) == (176, 256, 256)
+
+
+def test_read_nifti1_shape_rejects_non_nifti1(tmp_path):
+    path = tmp_path / "not_nifti.nii.gz"
+    path.write_bytes(gzip.compress(b"\0" * 540))
+
+    with pytest.raises(ValueError):
+        read_nifti1_shape(str(path))
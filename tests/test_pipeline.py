@@ -1,4 +1,7 @@
+import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 import pytest
@@ -19,12 +22,13 @@ def test_run_pipeline_multiple_subjects_multiple_tasks(tmp_path):
         "--subjects", "sub-001", "sub-002",
     ]
 
-    def fake_generate_design_files_main(*, fsf_template, output_directory, input_directory, task, custom_block, subjects, runs):
+    def fake_generate_design_files_main(*, fsf_template, output_directory, input_directory, task, custom_block, subjects, runs, file_index=None, fsf_template_src=None, force=False, max_workers=10):
+        assert "{{" in fsf_template_src  # template is read once by run_pipeline
         # subjects is a single subject id (string) per sequential processing
         assert subjects in {"sub-001", "sub-002"}
         return [f"/tmp/{subjects}_ses-001_task-{task}_runs-01-02.fsf"]
 
-    def fake_generate_higher_level_feat_files_main(*, input_directory, template_file, design_output_dir, feat_output_dir, run_pair, subjects, task_filters):
+    def fake_generate_higher_level_feat_files_main(*, input_directory, template_file, design_output_dir, feat_output_dir, run_pair, subjects, task_filters, template_src=None):
         # subjects is passed through so higher-level can filter
         assert subjects in {"sub-001", "sub-002"}
         assert set(task_filters) == {"hand", "language", "rest"}
@@ -45,24 +49,51 @@ def test_run_pipeline_multiple_subjects_multiple_tasks(tmp_path):
         # Design generation should run per subject * per task
         assert mock_design.call_count == 2 * 3
 
-        # First-level FEAT should be invoked once per subject with that subject's FSFs
-        assert mock_run_feat.call_count == 4  # 1x first-level + 1x higher-level per subject
-        first_level_calls = [mock_run_feat.call_args_list[0], mock_run_feat.call_args_list[2]]
-        assert first_level_calls[0].args[0] == [
-            "/tmp/sub-001_ses-001_task-hand_runs-01-02.fsf",
-            "/tmp/sub-001_ses-001_task-language_runs-01-02.fsf",
-            "/tmp/sub-001_ses-001_task-rest_runs-01-02.fsf",
-        ]
-        assert first_level_calls[1].args[0] == [
-            "/tmp/sub-002_ses-001_task-hand_runs-01-02.fsf",
-            "/tmp/sub-002_ses-001_task-language_runs-01-02.fsf",
-            "/tmp/sub-002_ses-001_task-rest_runs-01-02.fsf",
-        ]
+        # First-level FEAT is started once per task, as soon as that task's FSFs exist
+        assert mock_run_feat.call_count == 8  # 3x first-level + 1x higher-level per subject
+        fsf_batches = sorted(fsf for c in mock_run_feat.call_args_list for fsf in c.args[0])
+        assert fsf_batches == sorted(
+            [f"/tmp/{sub}_ses-001_task-{task}_runs-01-02.fsf" for sub in ("sub-001", "sub-002") for task in ("hand", "language", "rest")]
+            + ["/tmp/higher_sub-001_runs-01-02.fsf", "/tmp/higher_sub-002_runs-01-02.fsf"]
+        )
+        assert all(len(c.args[0]) == 1 for c in mock_run_feat.call_args_list)
 
         # Higher-level generation should be invoked once per subject
         assert mock_higher.call_count == 2
 
 
+def test_run_pipeline_generates_task_designs_concurrently(tmp_path):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand", "language",
+        "--run", "1",
+        "--subjects", "sub-001",
+    ]
+    # Both tasks must be in flight at once to get past the barrier.
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fake_design(*, task, **kwargs):
+        barrier.wait()
+        return [f"/tmp/sub-001_task-{task}.fsf"]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", side_effect=fake_design), \
+         patch("run_pipeline.run_feat_main") as mock_run_feat:
+
+        run_pipeline.main()
+
+    assert sorted(c.args[0] for c in mock_run_feat.call_args_list) == [
+        ["/tmp/sub-001_task-hand.fsf"],
+        ["/tmp/sub-001_task-language.fsf"],
+    ]
+
+
 def test_run_pipeline_creates_instance_log_file(tmp_path):
     input_dir = tmp_path / "input"
     output_dir = tmp_path / "output"
@@ -94,9 +125,10 @@ def test_run_pipeline_creates_instance_log_file(tmp_path):
     synthstrip_log_file = mock_synthstrip.call_args.kwargs["log_file"]
     feat_log_file = mock_run_feat.call_args.kwargs["log_file"]
 
-    assert motion_log_file == str(log_files[0])
-    assert synthstrip_log_file == str(log_files[0])
-    assert feat_log_file == str(log_files[0])
+    # Steps log through the subject's LogBuffer, which flushes into the run log.
+    assert motion_log_file.log_file == str(log_files[0])
+    assert synthstrip_log_file is motion_log_file
+    assert feat_log_file is motion_log_file
 
     content = log_files[0].read_text()
     assert "=== Begin pipeline run ===" in content
@@ -105,7 +137,515 @@ def test_run_pipeline_creates_instance_log_file(tmp_path):
     assert "=== End pipeline run ===" in content
 
 
+def test_run_pipeline_rejects_missing_template_before_processing(tmp_path):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", str(tmp_path / "missing.fsf"),
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion:
+        with pytest.raises(SystemExit):
+            run_pipeline.main()
+
+    mock_motion.assert_not_called()
+
+
 def test_run_pipeline_missing_args():
     with patch.object(sys, "argv", ["run_pipeline.py"]):
         with pytest.raises(SystemExit):
             run_pipeline.main()
+
+
+def test_run_pipeline_subject_workers_splits_worker_budget(tmp_path):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001", "sub-002",
+        "--max_workers", "8",
+        "--subject_workers", "2",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main") as mock_synthstrip, \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]) as mock_design, \
+         patch("run_pipeline.run_feat_main") as mock_run_feat:
+
+        run_pipeline.main()
+
+    assert sorted(c.args[2] for c in mock_motion.call_args_list) == ["sub-001", "sub-002"]
+    assert sorted(c.args[2] for c in mock_synthstrip.call_args_list) == ["sub-001", "sub-002"]
+    # Each concurrently processed subject gets half of the --max_workers budget.
+    assert {c.args[3] for c in mock_motion.call_args_list} == {4}
+    assert {c.kwargs["max_workers"] for c in mock_run_feat.call_args_list} == {4}
+    assert {c.kwargs["max_workers"] for c in mock_design.call_args_list} == {4}
+
+
+def test_run_pipeline_subject_processes_use_process_pool(tmp_path):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001", "sub-002",
+        "--max_workers", "8",
+        "--subject_workers", "2",
+        "--subject_processes",
+    ]
+    pools = []
+
+    def thread_backed_pool(max_workers, mp_context):
+        # Patched step mains do not survive into real worker processes.
+        pools.append((max_workers, mp_context))
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.ProcessPoolExecutor", side_effect=thread_backed_pool), \
+         patch("run_pipeline.ThreadPoolExecutor", wraps=ThreadPoolExecutor) as thread_pools, \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    assert [workers for workers, _ in pools] == [2]
+    assert sorted(c.args[2] for c in mock_motion.call_args_list) == ["sub-001", "sub-002"]
+    # Worker processes build their own step pools instead of sharing the parent's.
+    assert {c.kwargs["executor"] for c in mock_motion.call_args_list} == {None}
+    assert {c.args[3] for c in mock_motion.call_args_list} == {4}
+    # ...so the parent never creates the shared --max_workers step pool.
+    assert all(c.kwargs.get("max_workers") != 8 for c in thread_pools.call_args_list)
+
+
+def test_resource_tracker_reports_usage():
+    with run_pipeline.ResourceTracker(sleep_time=0.01) as tracker:
+        sum(range(100000))
+
+    assert tracker.runtime > 0
+    assert tracker.cpu_time_used >= 0
+    assert tracker.peak_memory_mb > 0
+
+
+def test_run_pipeline_skips_unchanged_preprocessing_on_rerun(tmp_path):
+    input_dir = tmp_path / "input"
+    func_dir = input_dir / "sub-001" / "ses-001" / "func"
+    func_dir.mkdir(parents=True)
+    (func_dir / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
+
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(input_dir),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main") as mock_synthstrip, \
+         patch("run_pipeline.extract_parameters_main") as mock_extract, \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+        run_pipeline.main()
+
+    assert mock_motion.call_count == 1
+    assert mock_extract.call_count == 1
+    # SynthStrip logs (rather than raises) per-file failures, so it always re-checks its outputs.
+    assert mock_synthstrip.call_count == 2
+
+
+def test_run_pipeline_reruns_preprocessing_when_outputs_or_dummy_config_change(tmp_path):
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    func_dir = input_dir / "sub-001" / "ses-001" / "func"
+    func_dir.mkdir(parents=True)
+    (func_dir / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
+    confounds = output_dir / "fsl_motion-outliers_v6.0.7.4" / "sub-001_ses-001_task-hand_run-01_bold_confounds.txt"
+    dummy_config = tmp_path / "dummy_scan_settings.json"
+    dummy_config.write_text('{"default_dummy": 2}')
+
+    def fake_motion(*args, **kwargs):
+        confounds.parent.mkdir(parents=True, exist_ok=True)
+        confounds.write_text("1\n")
+        return [str(confounds)]
+
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(input_dir),
+        "--output_directory", str(output_dir),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.dummy_config_paths", return_value=(str(dummy_config), str(tmp_path / "legacy.json"))), \
+         patch("run_pipeline.run_motion_outliers_main", side_effect=fake_motion) as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main", return_value=[]) as mock_extract, \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+        run_pipeline.main()
+        assert mock_motion.call_count == 1
+
+        # A deleted output re-runs only the step that produced it.
+        confounds.unlink()
+        run_pipeline.main()
+        assert mock_motion.call_count == 2
+        assert mock_extract.call_count == 1
+
+        # Editing the dummy-scan settings invalidates both steps that use them.
+        dummy_config.write_text('{"default_dummy": 3, "dummy_scan_rules": []}')
+        run_pipeline.main()
+        assert mock_motion.call_count == 3
+        assert mock_extract.call_count == 2
+
+
+def test_run_pipeline_track_resources_prints_summary(tmp_path, capsys):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001",
+        "--track_resources",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    out = capsys.readouterr().out
+    assert "--- Resource Usage Summary ---" in out
+    assert "Peak memory usage:" in out
+
+
+def test_run_pipeline_write_commands_emits_slurm_array(tmp_path):
+    commands_file = tmp_path / "feat_commands.txt"
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001", "sub-002", "sub-003",
+        "--write_commands", str(commands_file),
+    ]
+
+    def fake_generate_design_files_main(*, subjects, **kwargs):
+        return [f"/tmp/{subjects}_task-hand.fsf"]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", side_effect=fake_generate_design_files_main), \
+         patch("run_pipeline.run_feat_main") as mock_run_feat:
+
+        run_pipeline.main()
+
+    mock_run_feat.assert_not_called()
+    assert commands_file.read_text().splitlines() == [
+        "feat /tmp/sub-001_task-hand.fsf",
+        "feat /tmp/sub-002_task-hand.fsf",
+        "feat /tmp/sub-003_task-hand.fsf",
+    ]
+    script = (tmp_path / "feat_commands_submit.sh").read_text()
+    assert "#SBATCH --array=1-3%20" in script
+    assert 'sed -n "${SLURM_ARRAY_TASK_ID}p"' in script
+    # No higher-level template, so no higher-level command file.
+    assert not (tmp_path / "feat_commands_higher_level.txt").exists()
+
+
+def test_run_step_graph_overlaps_independent_steps_and_respects_dependencies():
+    barrier = threading.Barrier(3, timeout=5)
+    order = []
+
+    def independent(name):
+        def step():
+            barrier.wait()  # only passes if all three run at the same time
+            order.append(name)
+        return step
+
+    run_pipeline._run_step_graph(
+        {
+            "a": (independent("a"), ()),
+            "b": (independent("b"), ()),
+            "c": (independent("c"), ()),
+            "d": (lambda: order.append("d"), ("a", "b", "c")),
+        }
+    )
+
+    assert sorted(order[:3]) == ["a", "b", "c"]
+    assert order[3] == "d"
+
+
+def test_run_step_graph_stops_after_failure():
+    ran = []
+
+    def boom():
+        raise RuntimeError("step failed")
+
+    with pytest.raises(RuntimeError, match="step failed"):
+        run_pipeline._run_step_graph(
+            {
+                "a": (boom, ()),
+                "b": (lambda: ran.append("b"), ("a",)),
+            },
+            after_step=ran.append,
+        )
+
+    assert ran == []
+
+
+def test_run_step_graph_calls_after_step_once_each_step_finishes():
+    events = []
+
+    run_pipeline._run_step_graph(
+        {
+            "a": (lambda: events.append("run a"), ()),
+            "b": (lambda: events.append("run b"), ("a",)),
+        },
+        after_step=lambda name: events.append(f"done {name}"),
+    )
+
+    assert events == ["run a", "done a", "run b", "done b"]
+
+
+def test_parse_runs():
+    assert run_pipeline._parse_runs(["1", " 02 "]) == [1, 2]
+    assert run_pipeline._parse_runs(["None"]) == [None]
+    with pytest.raises(ValueError, match="cannot be combined"):
+        run_pipeline._parse_runs(["1", "none"])
+    with pytest.raises(ValueError, match="Invalid --run value: x"):
+        run_pipeline._parse_runs(["x"])
+
+
+def test_run_pipeline_discovers_subject_directories(tmp_path):
+    input_dir = tmp_path / "input"
+    for name in ("sub-002", "sub-001", "derivatives"):
+        (input_dir / name).mkdir(parents=True)
+    (input_dir / "sub-003").write_text("not a directory")
+
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(input_dir),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main") as mock_synthstrip, \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    assert [c.args[2] for c in mock_synthstrip.call_args_list] == ["sub-001", "sub-002"]
+
+
+def test_run_pipeline_local_scratch_copies_outputs_back(tmp_path, monkeypatch):
+    scratch = tmp_path / "scratch"
+    output_dir = tmp_path / "output"
+    monkeypatch.setenv("TMPDIR", str(scratch))
+    monkeypatch.setenv("SLURM_JOB_ID", "42")
+
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(output_dir),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+        "--subjects", "sub-001",
+        "--use_local_scratch",
+    ]
+    seen_output_dirs = []
+
+    def fake_extract_parameters_main(input_directory, output_directory, *args, **kwargs):
+        seen_output_dirs.append(output_directory)
+        config = os.path.join(output_directory, "fsl_feat_v6.0.7.4", "configurations", "sub-001", "cfg.md")
+        os.makedirs(os.path.dirname(config))
+        with open(config, "w") as f:
+            f.write("TOTAL_FRAMES = 200\n")
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main", side_effect=fake_extract_parameters_main), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    assert seen_output_dirs == [str(scratch / "fsl_42" / "sub-001")]
+    assert (output_dir / "fsl_feat_v6.0.7.4" / "configurations" / "sub-001" / "cfg.md").read_text() == "TOTAL_FRAMES = 200\n"
+    assert not (scratch / "fsl_42" / "sub-001").exists()
+
+
+def test_local_scratch_seeds_subject_outputs_and_rewrites_fsf_paths(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "scratch"))
+    monkeypatch.setenv("SLURM_JOB_ID", "42")
+    output_dir = tmp_path / "output"
+    feat_root = output_dir / "fsl_feat_v6.0.7.4"
+    confounds = output_dir / "fsl_motion-outliers_v6.0.7.4" / "sub-001" / "ses-001" / "func" / "c.txt"
+    confounds.parent.mkdir(parents=True)
+    confounds.write_text("1\n")
+    (output_dir / "fsl_motion-outliers_v6.0.7.4" / "sub-002").mkdir()
+    design = feat_root / "subject_designs" / "sub-001_ses-001_task-hand_run-01.fsf"
+    design.parent.mkdir(parents=True)
+    design.write_text(f'set fmri(outputdir) "{feat_root}/standard/sub-001"\n')
+    (feat_root / "subject_designs" / "sub-002_ses-001_task-hand_run-01.fsf").write_text("")
+
+    with patch("run_pipeline.shutil.which", return_value=None), \
+         run_pipeline._local_scratch("sub-001", str(output_dir), None) as local_out:
+        local_design = os.path.join(local_out, "fsl_feat_v6.0.7.4", "subject_designs", design.name)
+        # Only this subject's outputs are copied in, with .fsf paths pointing at scratch.
+        assert os.path.exists(os.path.join(local_out, "fsl_motion-outliers_v6.0.7.4", "sub-001", "ses-001", "func", "c.txt"))
+        assert not os.path.exists(os.path.join(local_out, "fsl_motion-outliers_v6.0.7.4", "sub-002"))
+        assert not os.path.exists(os.path.join(os.path.dirname(local_design), "sub-002_ses-001_task-hand_run-01.fsf"))
+        with open(local_design) as f:
+            assert f"{local_out}/fsl_feat_v6.0.7.4/standard/sub-001" in f.read()
+
+    # Synced back with the shared paths restored; the job directory is gone.
+    assert design.read_text() == f'set fmri(outputdir) "{feat_root}/standard/sub-001"\n'
+    assert not (tmp_path / "scratch" / "fsl_42").exists()
+
+
+def test_local_scratch_keeps_outputs_when_subject_fails(tmp_path, monkeypatch):
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "scratch"))
+    monkeypatch.setenv("SLURM_JOB_ID", "42")
+    output_dir = tmp_path / "output"
+
+    with pytest.raises(RuntimeError):
+        with patch("run_pipeline.shutil.which", return_value=None), \
+             run_pipeline._local_scratch("sub-001", str(output_dir), None) as local_out:
+            with open(os.path.join(local_out, "partial.txt"), "w") as f:
+                f.write("partial")
+            raise RuntimeError("step failed")
+
+    assert (tmp_path / "scratch" / "fsl_42" / "sub-001" / "partial.txt").exists()
+    assert not (output_dir / "partial.txt").exists()
+
+
+def test_run_pipeline_shares_one_file_index_across_stages(tmp_path):
+    input_dir = tmp_path / "input"
+    func_dir = input_dir / "sub-001" / "ses-001" / "func"
+    func_dir.mkdir(parents=True)
+    (func_dir / "sub-001_ses-001_task-hand_run-01_bold.nii.gz").write_text("dummy")
+
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(input_dir),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", "1",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main") as mock_synthstrip, \
+         patch("run_pipeline.extract_parameters_main") as mock_extract, \
+         patch("run_pipeline.generate_design_files_main", return_value=[]) as mock_design, \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    indexes = [m.call_args.kwargs["file_index"] for m in (mock_motion, mock_synthstrip, mock_extract, mock_design)]
+    # The subject's tree is listed once and the same index is handed to every stage.
+    assert all(index is indexes[0] for index in indexes)
+    assert [f.subject for f in indexes[0]] == ["sub-001"]
+
+
+def test_run_pipeline_starts_feat_before_all_tasks_render(tmp_path):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand", "language",
+        "--run", "1",
+        "--subjects", "sub-001",
+    ]
+    hand_feat_started = threading.Event()
+
+    def fake_design(*, task, **kwargs):
+        if task == "language":
+            assert hand_feat_started.wait(timeout=5)
+        return [f"/tmp/sub-001_task-{task}.fsf"]
+
+    def fake_run_feat(fsfs, **kwargs):
+        if fsfs == ["/tmp/sub-001_task-hand.fsf"]:
+            hand_feat_started.set()
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("run_pipeline.run_motion_outliers_main"), \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", side_effect=fake_design), \
+         patch("run_pipeline.run_feat_main", side_effect=fake_run_feat):
+
+        run_pipeline.main()
+
+    assert hand_feat_started.is_set()
+
+
+@pytest.mark.parametrize("runs, expected", [(["1", "2", "3", "4"], 4), (["1", "2"], 2)])
+def test_run_pipeline_defaults_max_workers_to_allocated_cpus_capped_at_scans(tmp_path, runs, expected):
+    mock_args = [
+        "run_pipeline.py",
+        "--input_directory", str(tmp_path / "input"),
+        "--output_directory", str(tmp_path / "output"),
+        "--fsf_template", "configuration_templates/standard_design_template.fsf",
+        "--task", "hand",
+        "--run", *runs,
+        "--subjects", "sub-001",
+    ]
+
+    with patch.object(sys, "argv", mock_args), \
+         patch("utils.command.os.sched_getaffinity", return_value={0, 1, 2, 3}, create=True), \
+         patch("utils.command.os.cpu_count", return_value=64), \
+         patch("run_pipeline.run_motion_outliers_main") as mock_motion, \
+         patch("run_pipeline.run_synthstrip_main"), \
+         patch("run_pipeline.extract_parameters_main"), \
+         patch("run_pipeline.generate_design_files_main", return_value=[]), \
+         patch("run_pipeline.run_feat_main"):
+
+        run_pipeline.main()
+
+    assert mock_motion.call_args.args[3] == expected
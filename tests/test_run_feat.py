@@ -0,0 +1,48 @@
+from utils.run_feat import feat_is_complete, feat_outputdir_from_fsf
+
+
+def test_feat_outputdir_from_fsf(tmp_path):
+    fsf = tmp_path / "design.fsf"
+    fsf.write_text(
+        "# FEAT version number\n"
+        "set fmri(version) 6.00\n"
+        'set fmri(outputdir) "/data/out/sub-001_task-hand_run-01"\n'
+        "set feat_files(1) \"/data/in/bold\"\n"
+    )
+
+    assert feat_outputdir_from_fsf(str(fsf)) == "/data/out/sub-001_task-hand_run-01"
+    assert feat_outputdir_from_fsf(str(tmp_path / "missing.fsf")) is None
+
+
+def test_feat_jobs_dedupes_outputdirs_and_skips_complete(tmp_path):
+    from utils.run_feat import _feat_jobs
+
+    done = tmp_path / "done"
+    (done / "stats").mkdir(parents=True)
+    (done / "design.fsf").write_text("")
+    (done / "report.html").write_text("")
+
+    def fsf(name, outdir):
+        path = tmp_path / name
+        path.write_text(f'set fmri(outputdir) "{outdir}"\n')
+        return str(path)
+
+    a = fsf("a.fsf", tmp_path / "todo")
+    a_again = fsf("a_again.fsf", tmp_path / "todo")
+    finished = fsf("finished.fsf", done)
+
+    assert _feat_jobs([a, "", a_again, finished]) == [a]
+    assert _feat_jobs([finished], force=True) == [finished]
+
+
+def test_feat_is_complete(tmp_path):
+    outdir = tmp_path / "sub-001_task-hand_run-01.feat"
+    assert not feat_is_complete(str(outdir))
+
+    (outdir / "stats").mkdir(parents=True)
+    (outdir / "design.fsf").write_text("")
+    assert not feat_is_complete(str(outdir))
+
+    (outdir / "filtered_func_data.nii.gz").write_bytes(b"")
+    assert feat_is_complete(str(outdir))
+    assert not feat_is_complete(str(outdir / "design.fsf"))
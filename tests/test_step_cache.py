@@ -0,0 +1,39 @@
+import os
+
+from utils import step_cache
+
+
+def test_mark_done_then_is_done(tmp_path):
+    src = tmp_path / "in.nii.gz"
+    src.write_text("x")
+    fp = step_cache.fingerprint_inputs([str(src)], extra=(("hand",), (1,)))
+
+    assert not step_cache.is_done(tmp_path, "sub-001", "motion_outliers", fp)
+    step_cache.mark_done(tmp_path, "sub-001", "motion_outliers", fp)
+    assert step_cache.is_done(tmp_path, "sub-001", "motion_outliers", fp)
+    assert os.path.exists(tmp_path / ".cache" / "sub-001" / "motion_outliers.json")
+
+
+def test_fingerprint_changes_with_inputs_and_parameters(tmp_path):
+    src = tmp_path / "in.nii.gz"
+    src.write_text("x")
+    fp = step_cache.fingerprint_inputs([str(src)], extra=(("hand",),))
+
+    assert fp != step_cache.fingerprint_inputs([str(src)], extra=(("rest",),))
+    src.write_text("longer content")
+    assert fp != step_cache.fingerprint_inputs([str(src)], extra=(("hand",),))
+
+
+def test_is_done_requires_recorded_outputs(tmp_path):
+    src = tmp_path / "in.nii.gz"
+    src.write_text("x")
+    out = tmp_path / "fsl_motion-outliers_v6.0.7.4" / "sub-001_task-hand_run-01_bold_confounds.txt"
+    out.parent.mkdir()
+    out.write_text("1\n")
+    fp = step_cache.fingerprint_inputs([str(src)])
+
+    step_cache.mark_done(tmp_path, "sub-001", "motion_outliers", fp, [str(out)])
+    assert step_cache.is_done(tmp_path, "sub-001", "motion_outliers", fp)
+
+    out.unlink()
+    assert not step_cache.is_done(tmp_path, "sub-001", "motion_outliers", fp)
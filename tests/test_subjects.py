@@ -19,3 +19,25 @@ def test_parse_subjects_arg_from_file(tmp_path):
 def test_parse_subjects_arg_empty_returns_none():
     assert parse_subjects_arg(None) is None
     assert parse_subjects_arg([]) is None
+
+
+def test_parse_subjects_arg_file_accepts_whitespace_separators(tmp_path):
+    f = tmp_path / "subjects.txt"
+    f.write_text("sub-001 sub-002\r\n\tsub-003,\n")
+
+    assert parse_subjects_arg(str(f)) == ["sub-001", "sub-002", "sub-003"]
+
+
+def test_parse_subjects_arg_prefers_existing_files_named_like_ids(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "sub-list").write_text("sub-001\nsub-002\n")
+    (tmp_path / "cohort,a.txt").write_text("sub-003\n")
+
+    assert parse_subjects_arg("sub-list") == ["sub-001", "sub-002"]
+    assert parse_subjects_arg(str(tmp_path / "cohort,a.txt")) == ["sub-003"]
+    # Without such a file the token is still a subject ID.
+    assert parse_subjects_arg("sub-001") == ["sub-001"]
+
+
+def test_parse_subjects_arg_drops_repeated_ids():
+    assert parse_subjects_arg("sub-002, sub-001,sub-002") == ["sub-002", "sub-001"]
@@ -1,35 +1,34 @@
 import os
+import subprocess
+
 import pytest
 from unittest.mock import patch, MagicMock
 from utils import run_synthstrip  # Updated for the project's directory structure
 
 # Helper function to create a mock directory structure
 @pytest.fixture
-def mock_file_structure(tmp_path):
-    input_dir = tmp_path / "input"
-    output_dir = tmp_path / "output"
-    os.makedirs(input_dir / "sub-001" / "ses-001" / "anat", exist_ok=True)
-    os.makedirs(input_dir / "sub-002" / "ses-001" / "anat", exist_ok=True)
-
-    # Create dummy .nii.gz files
-    (input_dir / "sub-001" / "ses-001" / "anat" / "sub-001_ses-001_T1w.nii.gz").write_text("dummy data")
-    (input_dir / "sub-002" / "ses-001" / "anat" / "sub-002_ses-001_T1w.nii.gz").write_text("dummy data")
-
-    return str(input_dir), str(output_dir)
+def mock_file_structure(make_bids_tree):
+    return make_bids_tree(
+        "sub-001/ses-001/anat/sub-001_ses-001_T1w.nii.gz",
+        "sub-002/ses-001/anat/sub-002_ses-001_T1w.nii.gz",
+    )
 
 # Test the check_dependencies function
 def test_check_dependencies():
+    run_synthstrip.check_dependencies.cache_clear()
+    with patch("shutil.which", return_value=None):
+        with pytest.raises(RuntimeError):
+            run_synthstrip.check_dependencies()
+
     with patch("shutil.which") as mock_which:
         mock_which.return_value = "/path/to/mri_synthstrip"
         run_synthstrip.check_dependencies()
+        run_synthstrip.check_dependencies()  # cached after the first success
         mock_which.assert_called_once_with("mri_synthstrip")
-
-    with patch("shutil.which", return_value=None):
-        with pytest.raises(RuntimeError):
-            run_synthstrip.check_dependencies()
+    run_synthstrip.check_dependencies.cache_clear()
 
 # Test the process_file function
-def test_process_file(mock_file_structure):
+def test_process_file(mock_file_structure, fake_popen):
     input_dir, output_dir = mock_file_structure
     input_file = os.path.join(input_dir, "sub-001", "ses-001", "anat", "sub-001_ses-001_T1w.nii.gz")
     output_file = os.path.join(
@@ -42,17 +41,16 @@ def test_process_file(mock_file_structure):
     )
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    with patch("utils.command.subprocess.run") as mock_run, \
-         patch("utils.run_synthstrip.nib.load") as mock_load:
+    with patch("utils.run_synthstrip.nib.load") as mock_load:
         mock_img = MagicMock()
         mock_img.shape = (64, 64, 33)
         mock_load.return_value = mock_img
-        mock_run.return_value = MagicMock()
         run_synthstrip.process_file(input_file, input_dir, output_dir)
-        mock_run.assert_called_once()
-        args, kwargs = mock_run.call_args
+        fake_popen.assert_called_once()
+        args, kwargs = fake_popen.call_args
         assert args[0] == ["mri_synthstrip", "-i", input_file, "-o", output_file]
-        assert kwargs.get("check") is True
+        assert kwargs["stderr"] is subprocess.STDOUT
+        assert not kwargs.get("shell")  # argv list, no /bin/sh in between
 
 # Test the gather_nifti_files function
 def test_gather_nifti_files(mock_file_structure):
@@ -73,6 +71,24 @@ def test_main(mock_file_structure):
         run_synthstrip.main(input_dir, output_dir, None, max_workers=2)
         assert mock_process.call_count == 2  # Two input files
         mock_check.assert_called_once()
+        # Workers get the output path main() already resolved for de-duplication.
+        for c in mock_process.call_args_list:
+            expected = os.path.join(
+                output_dir, "freesurfer_synthstrip_v8.1.0", os.path.relpath(c.args[0], input_dir)
+            ).replace(".nii.gz", "_synthstrip.nii.gz")
+            assert c.kwargs["output_path"] == expected
+
+
+def test_main_logs_progress_per_file(mock_file_structure, caplog):
+    input_dir, output_dir = mock_file_structure
+
+    with patch("utils.run_synthstrip.process_file"), \
+         patch("utils.run_synthstrip.check_dependencies"), \
+         caplog.at_level("INFO"):
+        run_synthstrip.main(input_dir, output_dir, None, max_workers=2)
+
+    progress = [r.getMessage() for r in caplog.records if r.getMessage().startswith("SynthStrip progress")]
+    assert progress == ["SynthStrip progress: 1/2 files", "SynthStrip progress: 2/2 files"]
 
 # Test skipping existing output
 def test_skip_existing_output(mock_file_structure):
@@ -91,12 +107,12 @@ def test_skip_existing_output(mock_file_structure):
     with open(output_file, "w") as f:
         f.write("existing output")
 
-    with patch("utils.command.subprocess.run") as mock_run:
+    with patch("utils.command.subprocess.Popen") as mock_popen:
         run_synthstrip.process_file(input_file, input_dir, output_dir)
-        mock_run.assert_not_called()  # Should skip since the output exists
+        mock_popen.assert_not_called()  # Should skip since the output exists
 
 
-def test_synthstrip_deduplicates_same_output(tmp_path):
+def test_synthstrip_deduplicates_same_output(tmp_path, fake_popen):
     input_dir = tmp_path / "input"
     output_dir = tmp_path / "output"
     os.makedirs(input_dir / "sub-001" / "ses-001" / "anat", exist_ok=True)
@@ -105,7 +121,7 @@ def test_synthstrip_deduplicates_same_output(tmp_path):
 
     # Force gather_nifti_files to return the same file twice (this can happen if upstream callers
     # accidentally include it multiple times when multiple tasks are specified).
-    with patch("utils.run_synthstrip.check_dependencies"),          patch("utils.run_synthstrip.gather_nifti_files", return_value=[str(t1), str(t1)]),          patch("utils.run_synthstrip.nib.load") as mock_load,          patch("utils.command.subprocess.run") as mock_run:
+    with patch("utils.run_synthstrip.check_dependencies"),          patch("utils.run_synthstrip.gather_nifti_files", return_value=[str(t1), str(t1)]),          patch("utils.run_synthstrip.nib.load") as mock_load:
 
         # Mock nibabel load to look 3D
         mock_img = MagicMock()
@@ -115,4 +131,61 @@ def test_synthstrip_deduplicates_same_output(tmp_path):
         run_synthstrip.main(str(input_dir), str(output_dir), subjects=["sub-001"], max_workers=2, task_filters=["hand"], run_filters=[1])
 
         # Only one synthstrip invocation should occur for the intended output path.
-        assert mock_run.call_count == 1
+        assert fake_popen.call_count == 1
+
+
+def test_synthstrip_main_skips_outputs_found_in_directory_listing(tmp_path, fake_popen):
+    input_dir = tmp_path / "input"
+    output_dir = tmp_path / "output"
+    anat = input_dir / "sub-001" / "ses-001" / "anat"
+    anat.mkdir(parents=True)
+    done, todo = anat / "sub-001_ses-001_T1w.nii.gz", anat / "sub-001_ses-001_acq-x_T1w.nii.gz"
+    done.write_text("dummy")
+    todo.write_text("dummy")
+    out_anat = output_dir / "freesurfer_synthstrip_v8.1.0" / "sub-001" / "ses-001" / "anat"
+    out_anat.mkdir(parents=True)
+    (out_anat / "sub-001_ses-001_T1w_synthstrip.nii.gz").write_text("existing output")
+
+    with patch("utils.run_synthstrip.check_dependencies"), \
+         patch("utils.run_synthstrip.nib.load") as mock_load:
+        mock_load.return_value.shape = (10, 10, 10)
+        run_synthstrip.main(str(input_dir), str(output_dir), subjects=None, max_workers=2)
+
+    assert fake_popen.call_count == 1
+    assert fake_popen.call_args.args[0][2] == str(todo)
+
+
+def test_synthstrip_main_does_not_submit_existing_outputs(tmp_path):
+    anat = tmp_path / "input" / "sub-001" / "ses-001" / "anat"
+    anat.mkdir(parents=True)
+    (anat / "sub-001_ses-001_T1w.nii.gz").write_text("dummy")
+    out_anat = tmp_path / "output" / "freesurfer_synthstrip_v8.1.0" / "sub-001" / "ses-001" / "anat"
+    out_anat.mkdir(parents=True)
+    (out_anat / "sub-001_ses-001_T1w_synthstrip.nii.gz").write_text("existing output")
+
+    with patch("utils.run_synthstrip.check_dependencies"), \
+         patch("utils.run_synthstrip.process_file") as mock_process:
+        run_synthstrip.main(str(tmp_path / "input"), str(tmp_path / "output"), None, max_workers=2)
+        mock_process.assert_not_called()
+
+        run_synthstrip.main(str(tmp_path / "input"), str(tmp_path / "output"), None, max_workers=2, force=True)
+        assert mock_process.call_count == 1
+
+
+def test_process_file_reads_3d_shape_from_header_only(tmp_path, fake_popen):
+    import gzip
+    import struct
+
+    header = bytearray(348)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, 3, 176, 256, 256, 1, 1, 1, 1)
+    anat = tmp_path / "input" / "sub-001" / "ses-001" / "anat"
+    anat.mkdir(parents=True)
+    t1 = anat / "sub-001_ses-001_T1w.nii.gz"
+    t1.write_bytes(gzip.compress(bytes(header)))
+
+    with patch("utils.run_synthstrip.nib") as nib:
+        run_synthstrip.process_file(str(t1), str(tmp_path / "input"), str(tmp_path / "output"))
+
+    nib.load.assert_not_called()
+    assert fake_popen.call_args.args[0][2] == str(t1)
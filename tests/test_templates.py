@@ -0,0 +1,113 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+from utils import generate_design_files, generate_higher_level_feat_files, templates
+
+
+def _clear_template_caches():
+    templates.load_template.cache_clear()
+    templates.get_environment.cache_clear()
+    templates._bytecode_cache.cache_clear()
+
+
+@pytest.fixture
+def jinja_cache(tmp_path, monkeypatch):
+    """Enable the bytecode cache in a per-test directory and return that directory."""
+    cache_dir = tmp_path / "jinja_cache"
+    monkeypatch.setenv("FSL_PIPELINE_JINJA_CACHE", str(cache_dir))
+    _clear_template_caches()
+    yield cache_dir
+    _clear_template_caches()
+
+
+def test_generators_share_one_environment(tmp_path):
+    template_path = tmp_path / "design.fsf"
+    template_path.write_text("set fmri(outputdir) {{ OUTPUT_DIRECTORY }}\n")
+
+    assert generate_design_files.load_template is templates.load_template
+    assert generate_higher_level_feat_files.load_template is templates.load_template
+
+    rendered = generate_higher_level_feat_files.render_fsf(str(template_path), "/out", "/a", "/b")
+    assert rendered == "set fmri(outputdir) /out"
+    assert templates.load_template(str(template_path)).environment is templates.get_environment(str(tmp_path))
+
+
+def test_templates_are_written_to_bytecode_cache(tmp_path, jinja_cache):
+    template_path = tmp_path / "cached.fsf"
+    template_path.write_text("{{ OUTPUT_DIRECTORY }}\n")
+
+    templates.load_template(str(template_path))
+
+    assert any(name.startswith("__jinja2_") for name in os.listdir(jinja_cache))
+
+
+def test_template_source_reuses_bytecode_cache(tmp_path, jinja_cache):
+    template_path = str(tmp_path / "from_src.fsf")
+    src = "set fmri(tr) {{ TOTAL_REPETITION_TIME }}\n"
+
+    templates.load_template(template_path, src)
+    templates.load_template.cache_clear()
+    env = templates.get_environment(str(tmp_path))
+    with patch.object(env, "compile", side_effect=AssertionError("recompiled")):
+        template = templates.load_template(template_path, src)
+
+    assert template.render(TOTAL_REPETITION_TIME=2) == "set fmri(tr) 2"
+
+
+def test_stream_fsf_writes_same_content_as_render(tmp_path):
+    template_path = tmp_path / "higher.fsf"
+    template_path.write_text("set fmri(outputdir) {{ OUTPUT_DIRECTORY }}\nset fmri(input1) {{ FEAT_DIRECTORY_RUN_1 }}\n")
+    output_fsf = tmp_path / "designs" / "out.fsf"
+
+    generate_higher_level_feat_files.stream_fsf(str(output_fsf), str(template_path), "/out", "/a", "/b")
+
+    assert output_fsf.read_text() == generate_higher_level_feat_files.render_fsf(str(template_path), "/out", "/a", "/b")
+
+
+def test_dump_render_writes_utf8(tmp_path):
+    out = tmp_path / "design.fsf"
+    template = templates.get_environment(str(tmp_path)).from_string("set fmri(outputdir) {{ d }}\n")
+    templates.dump_render(template, str(out), {"d": "/data/µ"})
+    assert out.read_bytes() == template.render(d="/data/µ").encode("utf-8")
+
+
+def test_dump_render_raises_template_errors(tmp_path):
+    template = templates.get_environment(str(tmp_path)).from_string("{{ d.missing() }}")
+    with pytest.raises(Exception, match="missing"):
+        templates.dump_render(template, str(tmp_path / "design.fsf"), {"d": {}})
+    assert not (tmp_path / "design.fsf").exists()
+
+
+def test_write_if_changed_skips_identical_content(tmp_path):
+    out = tmp_path / "design.fsf"
+    assert templates.write_if_changed(str(out), b"set fmri(tr) 2\n") is True
+    os.utime(out, ns=(0, 0))
+
+    assert templates.write_if_changed(str(out), b"set fmri(tr) 2\n") is False
+    assert out.stat().st_mtime_ns > 0  # touched, not rewritten
+
+    assert templates.write_if_changed(str(out), b"set fmri(tr) 2") is True
+    assert out.read_bytes() == b"set fmri(tr) 2"
+
+
+def test_bytecode_cache_is_opt_in(monkeypatch):
+    monkeypatch.delenv("FSL_PIPELINE_JINJA_CACHE", raising=False)
+    templates._bytecode_cache.cache_clear()
+    try:
+        assert templates._bytecode_cache() is None
+    finally:
+        templates._bytecode_cache.cache_clear()
+
+
+def test_template_loader_is_rooted_at_the_template_directory(tmp_path):
+    from jinja2 import TemplateNotFound
+
+    (tmp_path / "outside.txt").write_text("outside")
+    template_path = tmp_path / "templates" / "design.fsf"
+    template_path.parent.mkdir()
+    template_path.write_text('{% include "../outside.txt" %}')
+
+    with pytest.raises(TemplateNotFound):
+        templates.load_template(str(template_path)).render()
@@ -1,8 +1,24 @@
 """Utility modules for the FSL Task Pipeline."""
 
-from . import run_synthstrip  # noqa: F401
-from . import run_motion_outliers  # noqa: F401
-from . import extract_parameters  # noqa: F401
-from . import generate_design_files  # noqa: F401
-from . import generate_higher_level_feat_files  # noqa: F401
-from . import run_feat  # noqa: F401
+import importlib
+
+__all__ = [
+    "run_synthstrip",
+    "run_motion_outliers",
+    "extract_parameters",
+    "generate_design_files",
+    "generate_higher_level_feat_files",
+    "run_feat",
+]
+
+
+def __getattr__(name):
+    # Step modules are imported on first access, so importing one utility
+    # (e.g. ``utils.bids``) does not pull in every other step.
+    if name in __all__:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,40 +1,52 @@
 from __future__ import annotations
 
-import re
+import functools
+import os
 from pathlib import Path
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 
-# Match entities delimited by start-of-string, '/', or '_' (common in BIDS filenames).
-_ENTITY_PATTERNS = {
-    "subject": re.compile(r"(?:^|[/_])sub-([A-Za-z0-9]+)(?=$|[/_])"),
-    "session": re.compile(r"(?:^|[/_])ses-([A-Za-z0-9]+)(?=$|[/_])"),
-    "task": re.compile(r"(?:^|[/_])task-([A-Za-z0-9]+)(?=$|[/_])"),
-    "run": re.compile(r"(?:^|[/_])run-([0-9]+)(?=$|[/_])"),
-}
+# Entity prefixes, matched against tokens delimited by '/' or '_' (common in
+# BIDS filenames). Values are ASCII alphanumeric (digits only for run).
+_ENTITY_PREFIXES = (
+    ("sub-", "subject"),
+    ("ses-", "session"),
+    ("task-", "task"),
+    ("run-", "run"),
+)
+
+
+_ENTITY_KEYS = tuple(key for _, key in _ENTITY_PREFIXES)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_entities(path: str) -> Tuple[Any, ...]:
+    # Motion outliers, SynthStrip and extract_parameters each parse the same
+    # filenames; results are cached as immutable tuples.
+    out: Dict[str, Any] = dict.fromkeys(_ENTITY_KEYS)
+    # One C-level split instead of a regex search per entity.
+    for token in path.replace("/", "_").split("_"):
+        for prefix, key in _ENTITY_PREFIXES:
+            if not token.startswith(prefix):
+                continue
+            if out[key] is None:
+                val = token[len(prefix):]
+                if key == "run":
+                    if val.isascii() and val.isdigit():
+                        out[key] = int(val)
+                elif val.isascii() and val.isalnum():
+                    out[key] = val
+            break
+    return tuple(out.values())
 
 
 def parse_bids_entities(path: Union[str, Path]) -> Dict[str, Any]:
     """Extract common BIDS entities from a path or filename.
 
     Returns keys: subject, session, task, run (run is int if present).
-    Values are None if not found.
+    Values are None if not found; the first valid occurrence of each wins.
     """
-    s = str(path)
-    out: Dict[str, Any] = {"subject": None, "session": None, "task": None, "run": None}
-    for key, pat in _ENTITY_PATTERNS.items():
-        m = pat.search(s)
-        if not m:
-            continue
-        val = m.group(1)
-        if key == "run":
-            try:
-                out[key] = int(val)
-            except ValueError:
-                out[key] = None
-        else:
-            out[key] = val
-    return out
+    return dict(zip(_ENTITY_KEYS, _parse_entities(str(path))))
 
 
 def match_filters(
@@ -53,11 +65,84 @@ def match_filters(
         t = entities.get("task")
         if t is None or t not in task_filters:
             return False
-    if run_filters is not None and len(run_filters) > 0:
-        r = entities.get("run")
-        want_no_run = any(x is None for x in run_filters)
-        want_numeric = [x for x in run_filters if x is not None]
-        if r is None:
-            return want_no_run
-        return r in want_numeric
+    if run_filters:
+        # A None entry selects files without a run label; one membership test
+        # covers both cases without rebuilding the filter lists per file.
+        return entities.get("run") in run_filters
     return True
+
+
+def list_session_dirs(subject_dir: Union[str, Path]) -> List[str]:
+    """Return the sorted ``ses-*`` directory paths of one subject directory.
+
+    Raises FileNotFoundError / NotADirectoryError if subject_dir is missing.
+    """
+    with os.scandir(subject_dir) as it:
+        return sorted(e.path for e in it if e.name.startswith("ses-") and e.is_dir())
+
+
+def iter_session_dirs(input_directory: Union[str, Path]) -> Iterator[str]:
+    """Yield every ``sub-*/ses-*`` directory path under input_directory, sorted.
+
+    One ``os.scandir`` per level instead of a ``glob`` sweep; entry types come
+    from the directory listing.
+    """
+    with os.scandir(input_directory) as it:
+        subject_paths = sorted(e.path for e in it if e.name.startswith("sub-") and e.is_dir())
+    for subject_path in subject_paths:
+        yield from list_session_dirs(subject_path)
+
+
+class BidsFile(NamedTuple):
+    """A NIfTI file found under ``sub-*/[ses-*/]<datatype>/`` in a BIDS tree."""
+
+    path: str
+    subject: str
+    session: Optional[str]
+    datatype: str
+
+
+def _scan_datatype_dir(entry: os.DirEntry, subject: str, session: Optional[str], out: List[BidsFile]) -> None:
+    with os.scandir(entry.path) as it:
+        for f in it:
+            if f.name.endswith(".nii.gz") and f.is_file():
+                out.append(BidsFile(f.path, subject, session, entry.name))
+
+
+def discover_bids_files(
+    input_directory: Union[str, Path],
+    subjects: Optional[Iterable[str]] = None,
+) -> Tuple[BidsFile, ...]:
+    """Index every NIfTI file of the requested subjects in a single pass.
+
+    Supports both ``sub-*/ses-*/<datatype>/`` and session-less
+    ``sub-*/<datatype>/`` layouts. Uses ``os.scandir`` so directory checks reuse
+    the cached entry type instead of issuing a ``stat`` per entry.
+    Returns the files sorted by path; a missing input directory yields ``()``.
+    """
+    wanted = set(subjects) if subjects else None
+    out: List[BidsFile] = []
+    try:
+        with os.scandir(input_directory) as it:
+            subject_entries = [
+                e for e in it
+                if e.name.startswith("sub-") and (wanted is None or e.name in wanted) and e.is_dir()
+            ]
+    except FileNotFoundError:
+        return ()
+
+    for sub_entry in subject_entries:
+        with os.scandir(sub_entry.path) as it:
+            for child in it:
+                if not child.is_dir():
+                    continue
+                if child.name.startswith("ses-"):
+                    with os.scandir(child.path) as ses_it:
+                        for dt_entry in ses_it:
+                            if dt_entry.is_dir():
+                                _scan_datatype_dir(dt_entry, sub_entry.name, child.name, out)
+                else:
+                    _scan_datatype_dir(child, sub_entry.name, None, out)
+
+    out.sort(key=lambda f: f.path)
+    return tuple(out)
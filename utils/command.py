@@ -1,10 +1,55 @@
 from __future__ import annotations
 
+import atexit
+import collections
+import io
 import os
+import shlex
+import shutil
 import subprocess
-from datetime import datetime
+import threading
+import time
 from pathlib import Path
-from typing import Optional, Sequence, Union
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence, Set, TextIO, Union
+
+
+# Subjects may be processed concurrently; serialize writes to the shared run log.
+_LOG_LOCK = threading.Lock()
+
+# Line-buffered append handles for path log targets, most recently used last.
+# Bounded so long runs over many log files do not hold descriptors open.
+_LOG_HANDLES: "OrderedDict[str, TextIO]" = OrderedDict()
+_LOG_HANDLES_MAX = 8
+
+# A log destination is either a file path or a callable taking one line (e.g. LogBuffer).
+LogTarget = Union[str, Path, Callable[[str], None]]
+
+# Lines of a streamed tool's output kept for the log if the tool fails.
+_STREAM_TAIL_LINES = 200
+
+
+def process_pool_context():
+    """Multiprocessing context for worker-process pools.
+
+    forkserver avoids forking a process that may already be running threads;
+    falls back to the platform default where it is unavailable.
+    """
+    import multiprocessing  # only needed by callers that start worker processes
+
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else None)
+
+
+def available_cpus() -> int:
+    """Number of CPUs this process may run on.
+
+    Honours the affinity mask (e.g. a SLURM or taskset allocation) where the
+    platform exposes it; ``os.cpu_count()`` reports every CPU on the node.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
 
 def ensure_parent_dir(path: Union[str, Path]) -> None:
@@ -12,52 +57,192 @@ def ensure_parent_dir(path: Union[str, Path]) -> None:
     (p.parent if p.parent else Path('.')).mkdir(parents=True, exist_ok=True)
 
 
-def append_log(log_file: Optional[Union[str, Path]], line: str) -> None:
+def ensure_dir(path: Union[str, Path], created: Optional[Set[str]] = None) -> None:
+    """Create directory ``path`` (and parents), skipping it if already in ``created``.
+
+    ``created`` is a caller-owned set, typically scoped to one batch of writes,
+    so each directory is made once per batch rather than once per file.
+    """
+    key = str(path)
+    if created is not None and key in created:
+        return
+    os.makedirs(key, exist_ok=True)
+    if created is not None:
+        created.add(key)
+
+
+def _format_log_line(line: str) -> str:
+    # Same text as datetime.now().isoformat(timespec="seconds"), without building a datetime.
+    ts = time.strftime("%Y-%m-%dT%H:%M:%S")
+    return f"[{ts}] {line.rstrip()}\n"
+
+
+def _get_log_handle(log_file: Union[str, Path]) -> TextIO:
+    """Return an open append handle for log_file. Call with ``_LOG_LOCK`` held."""
+    key = os.fspath(log_file)
+    handle = _LOG_HANDLES.get(key)
+    if handle is not None and not handle.closed:
+        _LOG_HANDLES.move_to_end(key)
+        return handle
+    ensure_parent_dir(key)
+    handle = _LOG_HANDLES[key] = open(key, "a", encoding="utf-8", buffering=1)
+    if len(_LOG_HANDLES) > _LOG_HANDLES_MAX:
+        _LOG_HANDLES.popitem(last=False)[1].close()
+    return handle
+
+
+@atexit.register
+def _close_log_handles() -> None:
+    with _LOG_LOCK:
+        while _LOG_HANDLES:
+            _LOG_HANDLES.popitem()[1].close()
+
+
+def append_log(log_file: Optional[LogTarget], line: str) -> None:
     if not log_file:
         return
-    ensure_parent_dir(log_file)
-    ts = datetime.now().isoformat(timespec="seconds")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"[{ts}] {line.rstrip()}\n")
+    if callable(log_file):
+        log_file(line)
+        return
+    # The handle is line-buffered, so each line reaches the file as one O_APPEND write.
+    text = _format_log_line(line)
+    with _LOG_LOCK:
+        _get_log_handle(log_file).write(text)
+
+
+class LogBuffer:
+    """Collect log lines in memory and append them to ``log_file`` in blocks.
+
+    Pass the buffer wherever a ``log_file`` is accepted; ``append_log`` calls it
+    with each line. Lines are written out when ``flush()`` is called (e.g. at a
+    step boundary), once more than ``flush_bytes`` are pending, and on exit, so
+    one subject's lines stay together in the shared run log while a crash loses
+    at most the last unflushed block.
+    """
+
+    def __init__(self, log_file: Union[str, Path], flush_bytes: int = 64 * 1024):
+        self.log_file = log_file
+        self.flush_bytes = flush_bytes
+        self._buf = io.StringIO()
+        self._lock = threading.Lock()
+        # Serializes flushes so blocks reach the file in the order they were buffered.
+        self._flush_lock = threading.Lock()
+        self._fh = None
+
+    def write(self, line: str) -> None:
+        with self._lock:
+            self._buf.write(_format_log_line(line))
+            full = self._buf.tell() >= self.flush_bytes
+        if full:
+            self.flush()
+
+    __call__ = write
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                data = self._buf.getvalue()
+                self._buf = io.StringIO()
+            if not data:
+                return
+            fh = self._fh
+            if fh is None:
+                ensure_parent_dir(self.log_file)
+                fh = open(self.log_file, "ab", buffering=0)
+            try:
+                # Unbuffered append: the block goes out in a single O_APPEND write, so it
+                # stays contiguous even when subjects run in separate worker processes.
+                with _LOG_LOCK:
+                    fh.write(data.encode("utf-8"))
+                # Other subjects' writes need not wait for this one to reach the disk.
+                os.fsync(fh.fileno())
+            finally:
+                if fh is not self._fh:
+                    fh.close()
+
+    def __enter__(self) -> "LogBuffer":
+        ensure_parent_dir(self.log_file)
+        self._fh = open(self.log_file, "ab", buffering=0)
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        try:
+            self.flush()
+        finally:
+            self._fh.close()
+            self._fh = None
+        return False
 
 
 def create_instance_log_file(output_directory: Union[str, Path], *, prefix: str = "pipeline") -> str:
     """Create a unique log file path for this pipeline invocation."""
 
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    file_name = f"{prefix}_{ts}_{os.getpid()}.log"
-    log_file = Path(output_directory) / "logs" / file_name
-    ensure_parent_dir(log_file)
-    log_file.touch(exist_ok=True)
-    return str(log_file)
+    ts = time.strftime("%Y%m%d_%H%M%S")
+    log_file = os.path.join(output_directory, "logs", f"{prefix}_{ts}_{os.getpid()}.log")
+    # Opening the cached append handle creates the file, and append_log reuses it.
+    with _LOG_LOCK:
+        _get_log_handle(log_file)
+    return log_file
 
 
 def run_cmd(
     cmd: Sequence[str],
     *,
-    log_file: Optional[Union[str, Path]] = None,
+    log_file: Optional[LogTarget] = None,
     dry_run: bool = False,
     check: bool = True,
     cwd: Optional[Union[str, Path]] = None,
     env: Optional[dict] = None,
+    stream: bool = False,
 ) -> subprocess.CompletedProcess:
-    """Run a command safely (no shell), with optional logging and dry-run."""
+    """Run a command safely (no shell), with optional logging and dry-run.
 
-    cmd_str = " ".join([_shell_quote(x) for x in cmd])
-    append_log(log_file, f"$ {cmd_str}")
+    No shell and no ``preexec_fn`` are used, so CPython launches the child with
+    posix_spawn/vfork rather than a full fork of this (possibly large) process.
+    The child's stdin is ``/dev/null``, so a tool run from a worker thread
+    never reads from the terminal.
+
+    With ``stream=True`` the tool's combined stdout/stderr is read line by line
+    and only its last ``_STREAM_TAIL_LINES`` lines are kept, so memory stays
+    bounded however much the tool prints. As with captured output, they are
+    logged only if the tool fails; the returned process carries no output.
+    Use it for long-running tools (FEAT, SynthStrip, motion outliers).
+    """
+
+    if log_file:
+        append_log(log_file, f"$ {shlex.join(cmd)}")
     if dry_run:
         # Mimic a successful process object
         return subprocess.CompletedProcess(args=list(cmd), returncode=0)
 
+    popen_kwargs = dict(
+        executable=_resolve_executable(cmd[0], (env or os.environ).get("PATH")),
+        # Python-opened descriptors are non-inheritable (PEP 446), so the
+        # close-all pass is unnecessary; skipping it (with no cwd) lets
+        # CPython use posix_spawn.
+        close_fds=False,
+        stdin=subprocess.DEVNULL,
+        cwd=str(cwd) if cwd is not None else None,
+        env=env,
+        text=True,
+    )
+    if stream:
+        with subprocess.Popen(
+            list(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, **popen_kwargs
+        ) as proc:
+            tail = collections.deque(proc.stdout, maxlen=_STREAM_TAIL_LINES)
+            returncode = proc.wait()
+        if check and returncode:
+            # Log the end of the output on failure, as for captured output.
+            if tail:
+                append_log(log_file, f"output (last {len(tail)} lines):")
+                for line in tail:
+                    append_log(log_file, line)
+            raise subprocess.CalledProcessError(returncode, list(cmd))
+        return subprocess.CompletedProcess(args=list(cmd), returncode=returncode)
+
     try:
-        return subprocess.run(
-            list(cmd),
-            check=check,
-            cwd=str(cwd) if cwd is not None else None,
-            env=env,
-            text=True,
-            capture_output=True,
-        )
+        return subprocess.run(list(cmd), check=check, capture_output=True, **popen_kwargs)
     except subprocess.CalledProcessError as e:
         # Always log stdout/stderr on failure.
         if e.stdout:
@@ -67,10 +252,12 @@ def run_cmd(
         raise
 
 
-def _shell_quote(s: str) -> str:
-    # Simple quoting for logs only.
-    if not s:
-        return "''"
-    if any(ch.isspace() or ch in "\\\"'`$" for ch in s):
-        return "'" + s.replace("'", "'\\''") + "'"
-    return s
+def _resolve_executable(name: str, path: Optional[str]) -> Optional[str]:
+    """Resolve a bare command name on PATH here, instead of in the child.
+
+    Not cached: a tool installed, removed or replaced on PATH mid-run is found
+    as the child's own PATH search would find it.
+    """
+    if os.sep in name:
+        return None
+    return shutil.which(name, path=path)
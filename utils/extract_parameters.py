@@ -2,117 +2,179 @@
 
 import os
 import argparse
+import concurrent.futures
+import functools
 
-# nibabel is required for reading NIfTI headers (TR, frame count). We keep this
-# import resilient so tests (and lightweight tooling) can monkeypatch `nib.load`
-# even in environments where nibabel is not installed.
-try:
-    import nibabel as nib  # type: ignore
-except ModuleNotFoundError:
-    class _NibabelStub:
-        def load(self, *_args, **_kwargs):
-            raise ModuleNotFoundError(
-                "nibabel is required to read NIfTI headers for TR and frame count. "
-                "Install with: pip install nibabel"
-            )
-
-    nib = _NibabelStub()  # type: ignore
+from .lazy_nibabel import nib  # nibabel reads NIfTI headers (TR, frame count)
 from .find_dummy import load_config, get_dummy_scans
 from .bids import parse_bids_entities, match_filters
+from .command import ensure_dir
 from .subjects import parse_subjects_arg
 
-def extract_and_write_scan_info(base_dir, output_dir, subjects_filter=None, task_filters=None, run_filters=None):
+def _sorted_subdirs(path):
+    # DirEntry.is_dir() reuses the d_type from the listing, so no stat per entry.
+    with os.scandir(path) as it:
+        return sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
+
+
+def _iter_subjects(base_dir, subjects_filter=None):
+    """Yield subject directory entries under base_dir, sorted, limited to subjects_filter if given."""
+    wanted = set(subjects_filter) if subjects_filter else None
+    for entry in _sorted_subdirs(base_dir):
+        if wanted is None or entry.name in wanted:
+            yield entry
+
+
+def _iter_func_files(base_dir, subjects_filter=None):
+    """Yield (subject, session, file_name, file_path) for files under sub-*/ses-*/func."""
+    # One listing of base_dir; requested subjects that do not exist are simply not yielded.
+    for subject_entry in _iter_subjects(base_dir, subjects_filter):
+        for session_entry in _sorted_subdirs(subject_entry.path):
+            func_path = os.path.join(session_entry.path, 'func')
+            try:
+                with os.scandir(func_path) as it:
+                    files = sorted((e.name, e.path) for e in it if e.is_file())
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+            for file, file_path in files:
+                yield subject_entry.name, session_entry.name, file, file_path
+
+
+def _read_tr_frames(file_path):
+    """Return ``(tr, frames)`` from a NIfTI header, ``'N/A'`` where unavailable."""
+    # Header fields only: nothing here touches the (possibly gzipped) image data.
+    header = nib.load(file_path).header
+    zooms = header.get_zooms()
+    shape = header.get_data_shape()
+
+    # Get TR and frame count (if available)
+    tr = zooms[3] if len(zooms) > 3 else 'N/A'
+    frames = shape[3] if len(shape) > 3 else 'N/A'
+    return tr, frames
+
+
+def _write_configuration(scan, config, created_dirs):
+    """Read one scan's header and write its configuration.
+
+    Returns the exception instead of raising it, so one bad file does not stop
+    the batch.
+    """
+    file_path, scan_name, subject_output_dir, config_filepath = scan
+    try:
+        tr, frames = _read_tr_frames(file_path)
+
+        # Create subject-specific output directory under the fmri configurations folder
+        ensure_dir(subject_output_dir, created_dirs)
+
+        # Determine the number of dummy scans using the config
+        if isinstance(frames, int):
+            discard_frames = get_dummy_scans(frames, config)
+        else:
+            discard_frames = config.get("default_dummy", 2)
+
+        # Build the configuration content
+        config_content = (
+            f"# {scan_name}_configuration.md\n\n"
+            f"TOTAL_REPETITION_TIME = {tr}\n"
+            f"TOTAL_FRAMES = {frames}\n"
+            f"DISCARD_FRAMES = {discard_frames}\n"
+            "CRITICAL_Z = 2.3\n"
+            "SMOOTHING_KERNEL = 4\n" ##CHANGED TO 10 06/09/25 FOR DF ANALYSIS 
+            "PROB_THRESHOLD = 0.05\n"
+            "Z_THRESHOLD = 3.1\n"
+            "Z_MINIMUM = 3.1\n"
+        )
+
+        # Write to the subject-specific "configurations" directory only
+        with open(config_filepath, "w") as config_file:
+            config_file.write(config_content)
+        return None
+    except Exception as e:
+        return e
+
+
+def extract_and_write_scan_info(base_dir, output_dir, subjects_filter=None, task_filters=None, run_filters=None, file_index=None, max_workers=8):
+    """Write a configuration file for every matching BOLD scan.
+
+    Returns the configuration paths of all matched scans, including those that
+    already existed and were skipped.
+    """
+    pending = []
+    config_paths = []
     errors = []
+    created_dirs = set()
+    session_output_dirs = {}
     # Load configuration once at the start
     config = load_config()
     
     # Prepare the output directory for fsl_feat_v6.0.7.4 configurations
     fmri_manager_dir = os.path.join(output_dir, "fsl_feat_v6.0.7.4", "configurations")
     os.makedirs(fmri_manager_dir, exist_ok=True)
-    
-    # Determine which subjects to process
-    if subjects_filter:
-        # Only include subjects that exist as directories in base_dir
-        subjects = [s for s in subjects_filter if os.path.isdir(os.path.join(base_dir, s))]
+
+    if file_index is not None:
+        # Reuse the caller's pre-discovered BIDS index instead of listing the tree again.
+        func_files = (
+            (f.subject, f.session, os.path.basename(f.path), f.path)
+            for f in file_index
+            if f.datatype == "func"
+            and f.session is not None
+            and (not subjects_filter or f.subject in subjects_filter)
+        )
     else:
-        subjects = sorted(os.listdir(base_dir))
-    
-    for subject in subjects:
-        subject_path = os.path.join(base_dir, subject)
-        if not os.path.isdir(subject_path):
+        func_files = _iter_func_files(base_dir, subjects_filter)
+
+    for subject, session, file, file_path in func_files:
+        # Cheap suffix test first: sidecars and derivatives never reach the entity parser.
+        if not file.endswith("_bold.nii.gz"):
             continue
 
-        sessions = sorted(os.listdir(subject_path))
-        for session in sessions:
-            session_path = os.path.join(subject_path, session)
-            if not os.path.isdir(session_path):
-                continue
+        ents = parse_bids_entities(file)
+        if not match_filters(ents, task_filters=task_filters, run_filters=run_filters):
+            continue
 
-            func_path = os.path.join(session_path, 'func')
-            if not os.path.exists(func_path):
-                continue
+        scan_name = file.replace("_bold.nii.gz", "")
+        config_filename = f"{scan_name}_configuration.md"
+        
+        # Every file of a session shares one output directory; join it once per session.
+        subject_output_dir = session_output_dirs.get((subject, session))
+        if subject_output_dir is None:
+            subject_output_dir = session_output_dirs[subject, session] = os.path.join(fmri_manager_dir, subject, session)
+        config_filepath = os.path.join(subject_output_dir, config_filename)
+        config_paths.append(config_filepath)
+
+        # Checked before creating anything, so re-runs cost one stat per scan.
+        if os.path.exists(config_filepath):
+            print(f"Configuration already exists, skipping: {config_filepath}")
+            continue
+
+        pending.append((file_path, scan_name, subject_output_dir, config_filepath))
+
+    # Header reads and writes are file I/O, so scans overlap on threads;
+    # messages are still printed in scan order.
+    write = functools.partial(_write_configuration, config=config, created_dirs=created_dirs)
+    if len(pending) > 1 and max_workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(pending))) as ex:
+            results = list(ex.map(write, pending))
+    else:
+        results = [write(scan) for scan in pending]
 
-            for file in sorted(os.listdir(func_path)):
-                ents = parse_bids_entities(file)
-                if not match_filters(ents, task_filters=task_filters, run_filters=run_filters):
-                    continue
-
-                if file.endswith("_bold.nii.gz"):
-                    file_path = os.path.join(func_path, file)
-                    scan_name = file.replace("_bold.nii.gz", "")
-                    config_filename = f"{scan_name}_configuration.md"
-                    
-                    # Create subject-specific output directory under the fmri configurations folder
-                    subject_output_dir = os.path.join(fmri_manager_dir, subject, session)
-                    os.makedirs(subject_output_dir, exist_ok=True)
-                    config_filepath = os.path.join(subject_output_dir, config_filename)
-
-                    if os.path.exists(config_filepath):
-                        print(f"Configuration already exists, skipping: {config_filepath}")
-                        continue
-
-                    try:
-                        nifti_img = nib.load(file_path)
-                        header = nifti_img.header
-
-                        # Get TR and frame count (if available)
-                        tr = header.get_zooms()[3] if len(header.get_zooms()) > 3 else 'N/A'
-                        frames = nifti_img.shape[3] if len(nifti_img.shape) > 3 else 'N/A'
-                        
-                        # Determine the number of dummy scans using the config
-                        if isinstance(frames, int):
-                            discard_frames = get_dummy_scans(frames, config)
-                        else:
-                            discard_frames = config.get("default_dummy", 2)
-
-                        # Build the configuration content
-                        config_content = (
-                            f"# {scan_name}_configuration.md\n\n"
-                            f"TOTAL_REPETITION_TIME = {tr}\n"
-                            f"TOTAL_FRAMES = {frames}\n"
-                            f"DISCARD_FRAMES = {discard_frames}\n"
-                            "CRITICAL_Z = 2.3\n"
-                            "SMOOTHING_KERNEL = 4\n" ##CHANGED TO 10 06/09/25 FOR DF ANALYSIS 
-                            "PROB_THRESHOLD = 0.05\n"
-                            "Z_THRESHOLD = 3.1\n"
-                            "Z_MINIMUM = 3.1\n"
-                        )
-
-                        # Write to the subject-specific "configurations" directory only
-                        with open(config_filepath, "w") as config_file:
-                            config_file.write(config_content)
-
-                        print(f"Configuration written to: {config_filepath}")
-                    except Exception as e:
-                        print(f"Error processing file {file_path}: {e}")
-                        errors.append((file_path, str(e)))
+    for (file_path, _, _, config_filepath), error in zip(pending, results):
+        if error is None:
+            print(f"Configuration written to: {config_filepath}")
+        else:
+            print(f"Error processing file {file_path}: {error}")
+            errors.append((file_path, str(error)))
 
     if errors:
         raise RuntimeError(f"Failed processing {len(errors)} functional file(s)")
+    return config_paths
 
-def main(base_dir, output_dir, subjects_input=None, task_filters=None, run_filters=None):
+def main(base_dir, output_dir, subjects_input=None, task_filters=None, run_filters=None, *, file_index=None, max_workers=8):
     subjects_filter = parse_subjects_arg(subjects_input)
-    extract_and_write_scan_info(base_dir, output_dir, subjects_filter, task_filters, run_filters)
+    return extract_and_write_scan_info(
+        base_dir, output_dir, subjects_filter, task_filters, run_filters, file_index=file_index, max_workers=max_workers
+    )
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Extract scan information and write configuration files.")
@@ -129,6 +191,7 @@ if __name__ == "__main__":
             "or '--run 1 2' will match 'run-01' and 'run-02'. Use '--run none' to match files with no run label."
         ),
     )
+    parser.add_argument("--max_workers", type=int, default=8, help="Maximum number of NIfTI headers read concurrently.")
     args = parser.parse_args()
 
     run_filters = None
@@ -147,4 +210,5 @@ if __name__ == "__main__":
         args.subjects,
         task_filters=args.task,
         run_filters=run_filters,
+        max_workers=args.max_workers,
     )
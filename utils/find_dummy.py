@@ -1,10 +1,50 @@
+import functools
 import os
-import json
 
+try:
+    # Optional C-accelerated parser; the standard library is the fallback.
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+def _try_load(path):
+    """Return the parsed JSON at path, or None if the file does not exist."""
+    # Open directly rather than stat first: one syscall fewer per lookup.
+    # Both parsers take raw bytes, so skip the text-mode decode layer.
+    try:
+        with open(path, "rb") as f:
+            return _loads(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def _index_rules(cfg):
+    """Map frame count -> dummy scans, keeping the first rule for each count."""
+    default = cfg.get("default_dummy", 2)
+    index = {}
+    for rule in cfg.get("dummy_scan_rules", []):
+        index.setdefault(rule.get("frames"), rule.get("dummy", default))
+    return index
+
+
+def config_paths():
+    """Return the (preferred, legacy) dummy-scan settings paths, whether or not they exist."""
+    template_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configuration_templates")
+    return (
+        os.path.join(template_dir, "dummy_scan_settings.json"),
+        os.path.join(template_dir, "motion_outlier_settings.json"),
+    )
+
+
+@functools.lru_cache(maxsize=1)
 def load_config():
     """
     Load dummy-scan rules used to compute DISCARD_FRAMES.
 
+    The settings are read once per process and the same dict is returned to
+    every caller (motion outliers and extract_parameters, for each subject),
+    so treat it as read-only.
+
     Preferred path:
       configuration_templates/dummy_scan_settings.json
 
@@ -12,30 +52,25 @@ def load_config():
       configuration_templates/motion_outlier_settings.json
       (if it contains dummy_scan_rules/default_dummy)
     """
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    template_dir = os.path.join(script_dir, "..", "configuration_templates")
-
-    preferred = os.path.join(template_dir, "dummy_scan_settings.json")
-    legacy = os.path.join(template_dir, "motion_outlier_settings.json")
+    preferred, legacy = config_paths()
 
-    default_cfg = {"dummy_scan_rules": [], "default_dummy": 2}
+    default_cfg = {"dummy_scan_rules": [], "default_dummy": 2, "_rule_index": {}}
 
-    if os.path.exists(preferred):
-        with open(preferred, "r") as f:
-            cfg = json.load(f)
+    cfg = _try_load(preferred)
+    if cfg is not None:
         # Ensure required keys exist.
         cfg.setdefault("dummy_scan_rules", [])
         cfg.setdefault("default_dummy", 2)
+        cfg["_rule_index"] = _index_rules(cfg)
         return cfg
 
-    if os.path.exists(legacy):
-        with open(legacy, "r") as f:
-            cfg = json.load(f)
-        # Some legacy configs are motion-outlier-only; only use dummy keys if present.
-        if "dummy_scan_rules" in cfg or "default_dummy" in cfg:
-            cfg.setdefault("dummy_scan_rules", [])
-            cfg.setdefault("default_dummy", 2)
-            return cfg
+    cfg = _try_load(legacy)
+    # Some legacy configs are motion-outlier-only; only use dummy keys if present.
+    if cfg is not None and ("dummy_scan_rules" in cfg or "default_dummy" in cfg):
+        cfg.setdefault("dummy_scan_rules", [])
+        cfg.setdefault("default_dummy", 2)
+        cfg["_rule_index"] = _index_rules(cfg)
+        return cfg
 
     print(
         f"Dummy scan configuration not found. Looked for: {preferred} and {legacy}. Using defaults."
@@ -46,8 +81,9 @@ def get_dummy_scans(num_frames, config):
     """
     Determine the number of dummy scans based on the number of frames.
     Looks for an exact match in the dummy_scan_rules; if none is found, returns default_dummy.
+    Configs from load_config carry a prebuilt frames index; others are indexed here.
     """
-    for rule in config.get("dummy_scan_rules", []):
-        if rule.get("frames") == num_frames:
-            return rule.get("dummy", config.get("default_dummy", 2))
-    return config.get("default_dummy", 2)
+    index = config.get("_rule_index")
+    if index is None:
+        index = _index_rules(config)
+    return index.get(num_frames, config.get("default_dummy", 2))
@@ -1,28 +1,44 @@
 import argparse
+import functools
 import os
-import glob
-from typing import List, Optional
-
-from jinja2 import Environment, FileSystemLoader
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, Optional, Set
 
+from . import step_cache
+from .bids import iter_session_dirs, list_session_dirs
+from .command import available_cpus, ensure_dir, process_pool_context
 from .subjects import parse_subjects_arg
+from .templates import dump_render, load_template
 
 
 def parse_config_file(config_path):
-    """Parses the configuration file and extracts relevant parameters."""
-    params = {}
+    """Parses the configuration file and extracts relevant parameters.
+
+    Results are cached per (path, mtime), so a config re-read within one run is
+    parsed once; a rewritten config is parsed again.
+    """
+    return dict(_parse_config_cached(config_path, os.stat(config_path).st_mtime_ns))
+
+
+# "KEY = VALUE" lines: the key is everything before the first "=", and both
+# sides are stripped of surrounding whitespace (the value may contain "=").
+_KV_RE = re.compile(r"^[^\S\n]*([^=\n]*?)[^\S\n]*=[^\S\n]*(.*?)\s*$", re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_config_cached(config_path, mtime_ns):
     with open(config_path, 'r') as file:
-        for line in file:
-            if '=' in line:
-                key, value = line.strip().split('=', 1)
-                params[key.strip()] = value.strip()
-    return params
+        return dict(_KV_RE.findall(file.read()))
 
 
-def check_file_exists(path_pattern):
-    """Checks if a file matching the given pattern exists."""
-    files = glob.glob(path_pattern)
-    return files[0] if files else None
+def _list_names(directory):
+    """Return the entry names in directory, or an empty set if it does not exist."""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
 
 
 def parse_subjects(subjects, input_base_dir):
@@ -33,27 +49,86 @@ def parse_subjects(subjects, input_base_dir):
     if subjects_list:
         for sub in subjects_list:
             subject_path = os.path.join(input_base_dir, sub)
-            if os.path.exists(subject_path) and os.path.isdir(subject_path):
-                session_dirs = glob.glob(os.path.join(subject_path, "ses-*"))
-                if session_dirs:
-                    subject_dirs.extend(session_dirs)
-                else:
-                    print(f"Warning: No session directories found in {subject_path}")
-            else:
+            try:
+                session_dirs = list_session_dirs(subject_path)
+            except (FileNotFoundError, NotADirectoryError):
                 print(f"Warning: Subject directory not found: {subject_path}")
+                continue
+            if session_dirs:
+                subject_dirs.extend(session_dirs)
+            else:
+                print(f"Warning: No session directories found in {subject_path}")
     else:
-        subject_dirs = sorted(glob.glob(os.path.join(input_base_dir, "sub-*", "ses-*")))
+        subject_dirs = list(iter_session_dirs(input_base_dir))
 
     return subject_dirs
 
 
+# The first path component starting with "sub-" / "ses-".
+_SEPS = re.escape(os.sep + (os.altsep or ""))
+_SUBJECT_COMPONENT_RE = re.compile(rf"(?:^|[{_SEPS}])(sub-[^{_SEPS}]*)")
+_SESSION_COMPONENT_RE = re.compile(rf"(?:^|[{_SEPS}])(ses-[^{_SEPS}]*)")
+
+
 def extract_subject_session_from_path(path):
     """Extracts the subject ID and session ID from a given path."""
     # Robustly search the full path for BIDS-like entities.
-    parts = os.path.normpath(str(path)).split(os.sep)
-    subject_id = next((p for p in parts if p.startswith("sub-")), None)
-    session_id = next((p for p in parts if p.startswith("ses-")), None)
-    return subject_id, session_id
+    path = str(path)
+    subject = _SUBJECT_COMPONENT_RE.search(path)
+    session = _SESSION_COMPONENT_RE.search(path)
+    return (subject.group(1) if subject else None), (session.group(1) if session else None)
+
+
+def _bold_basename(sub: str, ses: str, t: str, r: Optional[int]) -> str:
+    if r is None:
+        return f"{sub}_{ses}_task-{t}_bold.nii.gz"
+    return f"{sub}_{ses}_task-{t}_run-{r:02d}_bold.nii.gz"
+
+
+def _fsf_names(stem: str, blocks: List[str]) -> List[str]:
+    """FSF file names for one scan: ``<stem>.fsf`` for "standard", ``<stem>_<block>.fsf`` otherwise."""
+    return [f"{stem}.fsf" if block == "standard" else f"{stem}_{block}.fsf" for block in blocks]
+
+
+def _scan_stem(sub: str, ses: str, t: str, r: Optional[int]) -> str:
+    if r is None:
+        return f"{sub}_{ses}_task-{t}"
+    return f"{sub}_{ses}_task-{t}_run-{r:02d}"
+
+
+# Per-session path parts; only the scan stem / BOLD name varies between runs.
+_STRUCTURAL_FMT = "{synthstrip_root}/{sub}/{ses}/anat/{sub}_{ses}_T1w_synthstrip.nii.gz"
+_SESSION_FUNC_FMT = "{root}/{sub}/{ses}/func/"
+_FEAT_TAIL_FMT = "{sub}/{ses}/{stem}"
+
+
+@functools.lru_cache(maxsize=1024)
+def _session_paths(output_directory: str, input_directory: str, sub: str, ses: str):
+    """Return (structural path, input func dir, synthstrip func dir, motion func dir) for a session.
+
+    Cached, so every run of a session reuses the same joined strings.
+    """
+    synthstrip_root = os.path.join(output_directory, "freesurfer_synthstrip_v8.1.0")
+    motion_root = os.path.join(output_directory, "fsl_motion-outliers_v6.0.7.4")
+    return (
+        _STRUCTURAL_FMT.format(synthstrip_root=synthstrip_root, sub=sub, ses=ses),
+        os.path.join(input_directory, sub, ses, "func", ""),
+        _SESSION_FUNC_FMT.format(root=synthstrip_root, sub=sub, ses=ses),
+        _SESSION_FUNC_FMT.format(root=motion_root, sub=sub, ses=ses),
+    )
+
+
+def _resolve_custom_design_files(block_dir: str, blocks: List[str]) -> Dict[str, str]:
+    """Map each block to ``<block_dir>/<block>.txt``, or ``""`` if that file is missing."""
+    resolved = {}
+    for block in blocks:
+        custom_design_file = os.path.join(block_dir, f"{block}.txt")
+        if os.path.exists(custom_design_file):
+            resolved[block] = custom_design_file
+        else:
+            print(f"Warning: Custom design file not found: {custom_design_file}")
+            resolved[block] = ""
+    return resolved
 
 
 def generate_fsf(
@@ -67,32 +142,27 @@ def generate_fsf(
     run_number: Optional[int],
     subject: str,
     session: str,
+    fsf_template_src: Optional[str] = None,
+    created_dirs: Optional[Set[str]] = None,
+    confound_names: Optional[FrozenSet[str]] = None,
+    custom_design_files: Optional[Dict[str, str]] = None,
 ) -> List[str]:
-    def _bold_basename(sub: str, ses: str, t: str, r: Optional[int]) -> str:
-        if r is None:
-            return f"{sub}_{ses}_task-{t}_bold.nii.gz"
-        return f"{sub}_{ses}_task-{t}_run-{r:02d}_bold.nii.gz"
-
-    def _scan_stem(sub: str, ses: str, t: str, r: Optional[int]) -> str:
-        if r is None:
-            return f"{sub}_{ses}_task-{t}"
-        return f"{sub}_{ses}_task-{t}_run-{r:02d}"
-
     """Generate one or more FSF files (standard + optional custom blocks).
 
+    ``confound_names`` is an optional listing of the scan's motion-outlier
+    func directory; without it that directory is listed here.
+    ``custom_design_files`` maps each block to its custom design file (or
+    ``""`` if missing), as resolved by ``_resolve_custom_design_files``.
+
     Returns a list of paths to generated FSF files.
     """
     generated: List[str] = []
 
-    subject_design_output = os.path.join(
-        output_directory,
-        "fsl_feat_v6.0.7.4",
-        "subject_designs",
-    )
-    os.makedirs(subject_design_output, exist_ok=True)
+    feat_root = os.path.join(output_directory, "fsl_feat_v6.0.7.4")
+    subject_design_output = os.path.join(feat_root, "subject_designs")
+    ensure_dir(subject_design_output, created_dirs)
 
     subject_id, session_id = extract_subject_session_from_path(config)
-    block_dir = os.path.dirname(fsf_template)
 
     if not subject_id or not session_id:
         print(f"Error: Could not extract subject and session from path: {config}")
@@ -100,88 +170,75 @@ def generate_fsf(
 
     config_params = parse_config_file(config)
 
-    structural_path = (
-        f"{output_directory}/freesurfer_synthstrip_v8.1.0/{subject_id}/{session_id}/anat/"
-        f"{subject_id}_{session_id}_T1w_synthstrip.nii.gz"
-    )
-    functional_path = os.path.join(
-        input_directory,
-        subject_id,
-        session_id,
-        "func",
-        _bold_basename(subject_id, session_id, task, run_number),
-    )
-    func_reg_image = os.path.join(
-        output_directory,
-        "freesurfer_synthstrip_v8.1.0",
-        subject_id,
-        session_id,
-        "func",
-        _bold_basename(subject_id, session_id, task, run_number).replace("_bold.nii.gz", "_bold_first_frame.nii.gz"),
-    )
+    bold = _bold_basename(subject_id, session_id, task, run_number)
+    stem = _scan_stem(subject_id, session_id, task, run_number)
 
-    confound_path = os.path.join(
-        output_directory,
-        "fsl_motion-outliers_v6.0.7.4",
-        subject_id,
-        session_id,
-        "func",
-        f"{_scan_stem(subject_id, session_id, task, run_number)}_confounds.txt",
+    structural_path, func_dir, synthstrip_func_dir, motion_func_dir = _session_paths(
+        output_directory, input_directory, subject_id, session_id
     )
-    full_confound_path = check_file_exists(confound_path)
+    functional_path = func_dir + bold
+    func_reg_image = synthstrip_func_dir + bold.replace("_bold.nii.gz", "_bold_first_frame.nii.gz")
+    confound_path = f"{motion_func_dir}{stem}_confounds.txt"
+    if confound_names is None:
+        confound_names = _list_names(os.path.dirname(confound_path))
+    full_confound_path = confound_path if os.path.basename(confound_path) in confound_names else None
     fmri_confoundevs = "1" if full_confound_path else "0"
 
     if not custom_block:
         custom_block = ["standard"]
+    if custom_design_files is None:
+        custom_design_files = _resolve_custom_design_files(os.path.dirname(fsf_template), custom_block)
+
+    # Every block renders the same template; per block, only the block name
+    # is spliced into the FEAT directory and the FSF name.
+    template = load_template(fsf_template, fsf_template_src)
+    feat_tail = _FEAT_TAIL_FMT.format(sub=subject, ses=session, stem=_scan_stem(subject, session, task, run_number))
+    fsf_names = _fsf_names(stem, custom_block)
+    # Only OUTPUT_DIRECTORY and CUSTOM_DESIGN_FILE differ between blocks.
+    common_render_kwargs = dict(
+        config_params,
+        FULL_STRUCTURAL_PATH=structural_path,
+        FULL_FUNCTIONAL_PATH=functional_path,
+        FUNC_REG_IMAGE=func_reg_image,
+        fmri_confoundevs=fmri_confoundevs,
+        FULL_CONFOUND_PATH=full_confound_path,
+        FUNCTIONAL_TASK_NAME=task,
+    )
 
-    for block in custom_block:
-        analysis = block
-        feat_directory = os.path.join(
-            output_directory,
-            "fsl_feat_v6.0.7.4",
-            analysis,
-            subject,
-            session,
-            _scan_stem(subject, session, task, run_number),
-        )
+    for block, fsf_name in zip(custom_block, fsf_names):
+        feat_directory = f"{feat_root}/{block}/{feat_tail}"
+        output_fsf_path = os.path.join(subject_design_output, fsf_name)
 
-        custom_design_file = os.path.join(block_dir, f"{block}.txt")
-        if not os.path.exists(custom_design_file):
-            print(f"Warning: Custom design file not found: {custom_design_file}")
-            custom_design_file_str = ""
-        else:
-            custom_design_file_str = custom_design_file
-
-        env = Environment(loader=FileSystemLoader(os.path.dirname(fsf_template)))
-        template = env.get_template(os.path.basename(fsf_template))
-
-        rendered_fsf = template.render(
-            OUTPUT_DIRECTORY=feat_directory,
-            FULL_STRUCTURAL_PATH=structural_path,
-            FULL_FUNCTIONAL_PATH=functional_path,
-            FUNC_REG_IMAGE=func_reg_image,
-            CUSTOM_DESIGN_FILE=custom_design_file_str,
-            fmri_confoundevs=fmri_confoundevs,
-            FULL_CONFOUND_PATH=full_confound_path,
-            FUNCTIONAL_TASK_NAME=task,
-            **config_params,
+        dump_render(
+            template,
+            output_fsf_path,
+            dict(common_render_kwargs, OUTPUT_DIRECTORY=feat_directory, CUSTOM_DESIGN_FILE=custom_design_files[block]),
         )
 
-        output_fsf_filename = _scan_stem(subject_id, session_id, task, run_number)
-        if block != "standard":
-            output_fsf_filename += f"_{block}"
-        output_fsf_filename += ".fsf"
-        output_fsf_path = os.path.join(subject_design_output, output_fsf_filename)
-
-        with open(output_fsf_path, 'w') as fsf_file:
-            fsf_file.write(rendered_fsf)
-
         print(f"FSF file generated: {output_fsf_path}")
         generated.append(output_fsf_path)
 
     return generated
 
 
+# Below this many scans a thread pool is cheaper than starting worker processes.
+_PROCESS_POOL_MIN_SCANS = 50
+
+
+# Directories made by this worker process; reset when each pool worker starts,
+# so workers skip makedirs for directories they already made.
+_worker_created_dirs: Set[str] = set()
+
+
+def _init_render_worker():
+    _worker_created_dirs.clear()
+
+
+def _render_scan(job):
+    # Module-level so it can be sent to worker processes.
+    return generate_fsf(**job, created_dirs=_worker_created_dirs)
+
+
 def main(
     *,
     fsf_template: str,
@@ -191,48 +248,76 @@ def main(
     custom_block: List[str],
     subjects: Optional[str],
     runs: List[Optional[int]],
+    file_index=None,
+    fsf_template_src: Optional[str] = None,
+    max_workers: int = 10,
+    force: bool = False,
 ) -> List[str]:
     """Generate FSF files for multiple subjects, sessions, and runs.
 
-    Returns a flat list of generated FSF paths.
-    """
-    all_generated: List[str] = []
+    If ``file_index`` (see ``utils.bids.discover_bids_files``) is given, the
+    subject/session directories are taken from it instead of listing the input directory.
+    ``fsf_template_src`` is the already-read contents of ``fsf_template``, so
+    callers generating many designs read the template only once.
+
+    Scans are rendered and written on up to ``max_workers`` threads to overlap
+    file I/O, or on worker processes for batches of ``_PROCESS_POOL_MIN_SCANS``
+    or more, where rendering itself dominates.
 
-    subject_dirs = parse_subjects(subjects, input_directory)
+    Each rendered scan gets a ``utils.step_cache`` manifest fingerprinting its
+    configuration, confounds, template and custom design files together with
+    the input and output directories. A scan whose FSFs all exist and whose
+    fingerprint is unchanged is not re-rendered (unless ``force``); its
+    existing FSF paths are returned as if generated.
+
+    Returns a flat list of generated FSF paths, in subject/session/run order.
+    """
+    scans = []
+    created_dirs: Set[str] = set()
+    # Configuration directory -> names in it, listed once instead of a stat per run.
+    config_names = {}
+    motion_root = os.path.join(output_directory, "fsl_motion-outliers_v6.0.7.4")
+    design_dir = os.path.join(output_directory, "fsl_feat_v6.0.7.4", "subject_designs")
+    # One listing of the design directory rules out re-render checks for new scans.
+    design_names = set() if force else _list_names(design_dir)
+
+    if file_index is not None:
+        subjects_list = parse_subjects_arg(subjects)
+        subject_dirs = sorted(
+            {
+                os.path.join(input_directory, f.subject, f.session)
+                for f in file_index
+                if f.session is not None and (not subjects_list or f.subject in subjects_list)
+            }
+        )
+    else:
+        subject_dirs = parse_subjects(subjects, input_directory)
 
     for subject_dir in subject_dirs:
         subject_id, session_id = extract_subject_session_from_path(subject_dir)
 
         if subject_id and session_id:
+            # One listing answers the confound lookup for every run of this session.
+            confound_names = frozenset(_list_names(os.path.join(motion_root, subject_id, session_id, "func")))
             for run_number in runs:
                 if run_number is None:
                     config_name = f"{subject_id}_{session_id}_task-{task}_configuration.md"
                 else:
                     config_name = f"{subject_id}_{session_id}_task-{task}_run-{run_number:02d}_configuration.md"
 
-                config_file = os.path.join(
+                config_dir = os.path.join(
                     output_directory,
                     "fsl_feat_v6.0.7.4",
                     "configurations",
                     subject_id,
                     session_id,
-                    config_name,
                 )
+                config_file = os.path.join(config_dir, config_name)
+                if config_dir not in config_names:
+                    config_names[config_dir] = _list_names(config_dir)
 
-                if os.path.exists(config_file):
-                    all_generated.extend(
-                        generate_fsf(
-                            config=config_file,
-                            fsf_template=fsf_template,
-                            output_directory=output_directory,
-                            input_directory=input_directory,
-                            task=task,
-                            custom_block=custom_block,
-                            run_number=run_number,
-                            subject=subject_id,
-                            session=session_id,
-                        )
-                    )
+                if config_name in config_names[config_dir]:
+                    scans.append((config_file, run_number, subject_id, session_id, confound_names))
                 else:
                     print(
                         f"Warning: Configuration file not found for {subject_id} {session_id} "
@@ -241,6 +326,80 @@ def main(
         else:
             print(f"Skipping invalid directory: {subject_dir}")
 
+    # Custom design files sit next to the template; check them once, not per scan.
+    blocks = custom_block or ["standard"]
+    custom_design_files = (
+        _resolve_custom_design_files(os.path.dirname(fsf_template), blocks) if scans else {}
+    )
+
+    # A confound file that appears or disappears changes the fingerprint too,
+    # since the fingerprint covers the input paths, not just their mtimes.
+    shared_inputs = [fsf_template, *filter(None, custom_design_files.values())]
+    stems, fingerprints = [], []
+    for config_file, run_number, subject_id, session_id, confound_names in scans:
+        stem = _scan_stem(subject_id, session_id, task, run_number)
+        inputs = [*shared_inputs, config_file]
+        if f"{stem}_confounds.txt" in confound_names:
+            inputs.append(os.path.join(motion_root, subject_id, session_id, "func", f"{stem}_confounds.txt"))
+        stems.append(stem)
+        fingerprints.append(
+            step_cache.fingerprint_inputs(inputs, extra=(input_directory, output_directory, task, tuple(blocks)))
+        )
+
+    skipped = {}
+    for i, (config_file, run_number, subject_id, session_id, confound_names) in enumerate(scans):
+        if not all(name in design_names for name in _fsf_names(stems[i], blocks)):
+            continue
+        if step_cache.is_done(output_directory, subject_id, f"design_files_{stems[i]}", fingerprints[i]):
+            print(f"FSF files up to date, skipping: {stems[i]}")
+            skipped[i] = [os.path.join(design_dir, name) for name in _fsf_names(stems[i], blocks)]
+
+    common = dict(
+        fsf_template=fsf_template,
+        output_directory=output_directory,
+        input_directory=input_directory,
+        task=task,
+        custom_block=blocks,
+        fsf_template_src=fsf_template_src,
+        custom_design_files=custom_design_files,
+    )
+    jobs = [
+        dict(
+            common,
+            config=config_file,
+            run_number=run_number,
+            subject=subject_id,
+            session=session_id,
+            confound_names=confound_names,
+        )
+        for i, (config_file, run_number, subject_id, session_id, confound_names) in enumerate(scans)
+        if i not in skipped
+    ]
+
+    if len(jobs) >= _PROCESS_POOL_MIN_SCANS and max_workers > 1:
+        # Rendering is pure-Python (GIL-bound); for large batches, worker
+        # processes beat threads once their start-up cost is amortized.
+        # Rendering is CPU-bound, so more processes than cores only adds start-up cost.
+        processes = min(max_workers, available_cpus())
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=process_pool_context(), initializer=_init_render_worker
+        ) as ex:
+            results = list(ex.map(_render_scan, jobs, chunksize=max(1, len(jobs) // (processes * 4))))
+    elif len(jobs) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as ex:
+            results = list(ex.map(lambda job: generate_fsf(**job, created_dirs=created_dirs), jobs))
+    else:
+        results = [generate_fsf(**job, created_dirs=created_dirs) for job in jobs]
+
+    all_generated: List[str] = []
+    rendered = iter(results)
+    for i, scan in enumerate(scans):
+        if i in skipped:
+            all_generated.extend(skipped[i])
+            continue
+        fsfs = next(rendered)
+        step_cache.mark_done(output_directory, scan[2], f"design_files_{stems[i]}", fingerprints[i], fsfs)
+        all_generated.extend(fsfs)
     return all_generated
 
 
@@ -264,6 +423,7 @@ if __name__ == "__main__":
             "Run numbers to process (e.g., --run 1 2). Use '--run none' when the BOLD filename does not contain a run label."
         ),
     )
+    parser.add_argument("--force", action="store_true", help="Re-render FSF files even if they are up to date.")
 
     args = parser.parse_args()
 
@@ -283,4 +443,5 @@ if __name__ == "__main__":
         custom_block=args.custom_block,
         subjects=args.subjects,
         runs=runs,
+        force=args.force,
     )
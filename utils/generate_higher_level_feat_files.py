@@ -1,8 +1,11 @@
 import argparse
+import collections
 import logging
 import os
 import re
-from jinja2 import Template
+
+from .command import ensure_dir
+from .templates import dump_render, load_template
 
 logging.basicConfig(
     level=logging.INFO,
@@ -13,17 +16,17 @@ FEAT_DIR_PATTERN = re.compile(
     r"^(?P<subject>sub-[^_]+)_(?P<session>ses-[^_]+)_task-(?P<task>[^_]+)_run-(?P<run>\d+)"
 )
 
+# Per-pair path suffix, formatted from the pair dict returned by pair_runs.
+_PAIR_PATH_FMT = "{subject}/{session}/{subject}_{session}_task-{task}_runs-{run_a:02d}-{run_b:02d}"
+
 
 def parse_feat_dir_name(directory_name):
     match = FEAT_DIR_PATTERN.match(directory_name)
     if not match:
         return None
-    return {
-        "subject": match.group("subject"),
-        "session": match.group("session"),
-        "task": match.group("task"),
-        "run": int(match.group("run")),
-    }
+    info = match.groupdict()
+    info["run"] = int(info["run"])
+    return info
 
 
 def _normalize_subjects(subjects):
@@ -36,69 +39,83 @@ def _normalize_subjects(subjects):
     return set(subjects)
 
 
+def _sorted_subdirs(directory, prefix=""):
+    """Names of directories in directory starting with prefix, sorted; [] if unreadable."""
+    try:
+        with os.scandir(directory) as it:
+            return sorted(e.name for e in it if e.name.startswith(prefix) and e.is_dir())
+    except OSError:
+        return []
+
+
 def collect_feat_dirs(input_directory, *, subjects=None, task_filters=None):
+    """Find first-level FEAT directories under input_directory.
+
+    FEAT directories sit at ``<input>/sub-*/ses-*/<feat dir>``, so only those
+    three levels are listed (one ``os.scandir`` each); excluded subjects and
+    the contents of FEAT directories are never read.
+    """
     entries = []
     if not os.path.isdir(input_directory):
         logging.warning("Input directory not found: %s", input_directory)
         return entries
 
-    for root, dirs, _ in os.walk(input_directory):
-        for directory in dirs:
-            info = parse_feat_dir_name(directory)
-            if not info:
-                continue
-            subject_set = _normalize_subjects(subjects)
-            if subject_set is not None and info.get('subject') not in subject_set:
-                continue
-            if task_filters and info.get('task') not in set(task_filters):
-                continue
-            entries.append(
-                {
-                    "path": os.path.join(root, directory),
-                    **info,
-                }
-            )
+    subject_set = _normalize_subjects(subjects)
+    task_set = set(task_filters) if task_filters else None
+    for subject in _sorted_subdirs(input_directory, "sub-"):
+        if subject_set is not None and subject not in subject_set:
+            continue
+        subject_dir = os.path.join(input_directory, subject)
+        for session in _sorted_subdirs(subject_dir, "ses-"):
+            session_dir = os.path.join(subject_dir, session)
+            for name in _sorted_subdirs(session_dir):
+                info = parse_feat_dir_name(name)
+                if not info:
+                    continue
+                if subject_set is not None and info["subject"] not in subject_set:
+                    continue
+                if task_set is not None and info["task"] not in task_set:
+                    continue
+                entries.append({"path": os.path.join(session_dir, name), **info})
     return entries
 
 
 def pair_runs(entries, run_pair):
-    grouped = {}
+    grouped = collections.defaultdict(dict)
     for entry in entries:
-        key = (entry["subject"], entry["session"], entry["task"])
-        grouped.setdefault(key, {})[entry["run"]] = entry["path"]
+        grouped[entry["subject"], entry["session"], entry["task"]][entry["run"]] = entry["path"]
 
     pairs = []
     run_a, run_b = run_pair
-    for key, runs in grouped.items():
-        if run_a in runs and run_b in runs:
+    for (subject, session, task), runs in grouped.items():
+        path_a = runs.get(run_a)
+        path_b = runs.get(run_b)
+        if path_a is not None and path_b is not None:
             pairs.append(
                 {
-                    "subject": key[0],
-                    "session": key[1],
-                    "task": key[2],
+                    "subject": subject,
+                    "session": session,
+                    "task": task,
                     "run_a": run_a,
                     "run_b": run_b,
-                    "path_a": runs[run_a],
-                    "path_b": runs[run_b],
+                    "path_a": path_a,
+                    "path_b": path_b,
                 }
             )
         else:
             missing = [str(r) for r in (run_a, run_b) if r not in runs]
             logging.info(
                 "Skipping pair for %s %s task-%s, missing runs: %s",
-                key[0],
-                key[1],
-                key[2],
+                subject,
+                session,
+                task,
                 ", ".join(missing),
             )
     return pairs
 
 
-def render_fsf(template_file, output_directory, feat_dir_a, feat_dir_b):
-    with open(template_file, "r") as template:
-        template_content = template.read()
-
-    jinja_template = Template(template_content)
+def render_fsf(template_file, output_directory, feat_dir_a, feat_dir_b, *, template_src=None):
+    jinja_template = load_template(template_file, template_src)
     return jinja_template.render(
         OUTPUT_DIRECTORY=output_directory,
         FEAT_DIRECTORY_RUN_1=feat_dir_a,
@@ -106,19 +123,38 @@ def render_fsf(template_file, output_directory, feat_dir_a, feat_dir_b):
     )
 
 
-def write_fsf(output_fsf, rendered_content):
-    os.makedirs(os.path.dirname(output_fsf), exist_ok=True)
-    with open(output_fsf, "w") as output:
-        output.write(rendered_content)
+def stream_fsf(output_fsf, template_file, output_directory, feat_dir_a, feat_dir_b, *, template_src=None, created_dirs=None, template=None):
+    """Render the higher-level template straight into output_fsf.
+
+    ``template``, if given, is the already-loaded template for ``template_file``.
+    """
+    ensure_dir(os.path.dirname(output_fsf), created_dirs)
+    if template is None:
+        template = load_template(template_file, template_src)
+    dump_render(
+        template,
+        output_fsf,
+        {
+            "OUTPUT_DIRECTORY": output_directory,
+            "FEAT_DIRECTORY_RUN_1": feat_dir_a,
+            "FEAT_DIRECTORY_RUN_2": feat_dir_b,
+        },
+    )
 
 
-def main(input_directory, template_file, design_output_dir, feat_output_dir, run_pair=(1, 2), *, subjects=None, task_filters=None):
+def main(input_directory, template_file, design_output_dir, feat_output_dir, run_pair=(1, 2), *, subjects=None, task_filters=None, template_src=None, entries=None):
     """Generate higher-level FSF files.
 
+    ``template_src``, if given, is the already-read contents of ``template_file``.
+    ``entries``, if given, are FEAT directories already found by
+    ``collect_feat_dirs`` and are used instead of scanning ``input_directory``.
+
     Returns a list of generated FSF paths (existing FSFs are not included).
     """
     generated_fsfs = []
-    entries = collect_feat_dirs(input_directory, subjects=subjects, task_filters=task_filters)
+    created_dirs = set()
+    if entries is None:
+        entries = collect_feat_dirs(input_directory, subjects=subjects, task_filters=task_filters)
     if not entries:
         logging.info("No FEAT directories found. Exiting.")
         return generated_fsfs
@@ -128,29 +164,28 @@ def main(input_directory, template_file, design_output_dir, feat_output_dir, run
         logging.info("No run pairs found to process. Exiting.")
         return generated_fsfs
 
+    # Load the template and join the roots once; each pair only formats its relative path.
+    template = load_template(template_file, template_src)
+    feat_root = os.path.join(feat_output_dir, "")
+    design_root = os.path.join(design_output_dir, "")
     for pair in pairs:
-        output_base = (
-            f"{pair['subject']}_{pair['session']}_task-{pair['task']}"
-            f"_runs-{pair['run_a']:02d}-{pair['run_b']:02d}"
-        )
-        output_feat_dir = os.path.join(
-            feat_output_dir, pair["subject"], pair["session"], output_base
-        )
-        output_fsf = os.path.join(
-            design_output_dir, pair["subject"], pair["session"], f"{output_base}.fsf"
-        )
+        pair_path = _PAIR_PATH_FMT.format_map(pair)
+        output_feat_dir = feat_root + pair_path
+        output_fsf = f"{design_root}{pair_path}.fsf"
 
         if os.path.exists(output_fsf):
             logging.info("FSF already exists, skipping: %s", output_fsf)
             continue
 
-        rendered_content = render_fsf(
+        stream_fsf(
+            output_fsf,
             template_file=template_file,
             output_directory=output_feat_dir,
             feat_dir_a=pair["path_a"],
             feat_dir_b=pair["path_b"],
+            created_dirs=created_dirs,
+            template=template,
         )
-        write_fsf(output_fsf, rendered_content)
         logging.info("Generated higher-level FSF: %s", output_fsf)
         generated_fsfs.append(output_fsf)
 
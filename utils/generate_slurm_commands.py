@@ -2,6 +2,16 @@
 import os
 import argparse
 
+# Template command with a placeholder for subject id
+COMMAND_TEMPLATE = (
+    "python /autofs/space/nicc_003/users/holly/git/FSL-TaskPipeline/run_pipeline.py --input_directory /autofs/space/nicc_005/users/holly/false_positive "
+    "--output_directory /autofs/space/nicc_005/users/holly/false_positive/derivatives "
+    "--fsf_template /autofs/space/nicc_003/users/holly/git/FSL-TaskPipeline/design_templates/standard_template.fsf "
+    "--task rest --run 1 --subjects {}"
+)
+# Split once around the placeholder so each command is a plain concatenation.
+_COMMAND_PREFIX, _COMMAND_SUFFIX = COMMAND_TEMPLATE.split("{}")
+
 def main():
     parser = argparse.ArgumentParser(description="Generate SLURM commands for subject IDs.")
     parser.add_argument("--subject_file", required=True, help="File containing subject IDs (one per line).")
@@ -22,28 +32,18 @@ def main():
     else:
         output_file = output_file_name
 
-    # Read subject IDs from the input file (ignoring empty lines)
+    # Read subject IDs from the input file in one go (blank lines and padding drop out)
     try:
         with open(input_file, "r") as f:
-            subject_ids = [line.strip() for line in f if line.strip()]
+            subject_ids = f.read().split()
     except Exception as e:
         print(f"Error reading {input_file}: {e}")
         exit(1)
 
-    # Template command with a placeholder for subject id
-    command_template = (
-        "python /autofs/space/nicc_003/users/holly/git/FSL-TaskPipeline/run_pipeline.py --input_directory /autofs/space/nicc_005/users/holly/false_positive "
-        "--output_directory /autofs/space/nicc_005/users/holly/false_positive/derivatives "
-        "--fsf_template /autofs/space/nicc_003/users/holly/git/FSL-TaskPipeline/design_templates/standard_template.fsf "
-        "--task rest --run 1 --subjects {}"
-    )
-
     # Write each command (one per subject id) to the output file
     try:
         with open(output_file, "w") as f_out:
-            for subject_id in subject_ids:
-                command = command_template.format(subject_id)
-                f_out.write(command + "\n")
+            f_out.write("".join(f"{_COMMAND_PREFIX}{subject_id}{_COMMAND_SUFFIX}\n" for subject_id in subject_ids))
         print(f"Commands written to {output_file}")
     except Exception as e:
         print(f"Error writing to {output_file}: {e}")
@@ -0,0 +1,49 @@
+"""Deferred nibabel import shared by the steps that read NIfTI headers.
+
+Importing nibabel pulls in numpy, which dominates start-up time for short
+invocations such as ``run_pipeline.py --help``. ``nib`` imports it on first
+attribute access instead. When nibabel is not installed, attributes resolve to
+callables that raise ModuleNotFoundError, so callers (and tests that patch
+``nib.load``) behave the same with or without it.
+"""
+
+from __future__ import annotations
+
+import importlib
+from typing import Any
+
+
+class LazyNibabel:
+    """Module proxy that imports nibabel the first time an attribute is read."""
+
+    def __init__(self) -> None:
+        self._module: Any = None
+
+    def _load(self) -> Any:
+        if self._module is None:
+            try:
+                self._module = importlib.import_module("nibabel")
+            except ModuleNotFoundError:
+                self._module = False
+        return self._module
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__"):
+            raise AttributeError(name)
+        module = self._load()
+        if module is False:
+            return _missing(name)
+        return getattr(module, name)
+
+
+def _missing(name: str):
+    def _raise(*_args, **_kwargs):
+        raise ModuleNotFoundError(
+            f"nibabel is required for nib.{name} (reading NIfTI headers). "
+            "Install with: pip install nibabel"
+        )
+
+    return _raise
+
+
+nib = LazyNibabel()
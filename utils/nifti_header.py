@@ -0,0 +1,53 @@
+"""Read NIfTI-1 image dimensions straight from the file header.
+
+Steps that only need a volume's shape (e.g. the number of frames) do not have
+to go through nibabel: the dimensions sit in the first 56 bytes of the
+348-byte NIfTI-1 header, so only the start of the (possibly gzipped) file is
+read. Anything that is not a NIfTI-1 header raises ValueError, so callers can
+fall back to nibabel for other formats.
+"""
+
+from __future__ import annotations
+
+import functools
+import gzip
+import os
+import struct
+from typing import Tuple
+
+_NIFTI1_HEADER_SIZE = 348
+_GZIP_MAGIC = b"\x1f\x8b"
+# sizeof_hdr (int32) at offset 0 ... dim (8 x int16) at offset 40.
+_DIM_END = 56
+
+
+def read_nifti1_shape(path: str) -> Tuple[int, ...]:
+    """Return the image shape recorded in path's NIfTI-1 header.
+
+    Results are cached per (path, mtime, size), so steps reading the same
+    BOLD series share one header read.
+    """
+    st = os.stat(path)
+    return _read_shape_cached(path, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _read_shape_cached(path: str, mtime_ns: int, size: int) -> Tuple[int, ...]:
+    with open(path, "rb") as raw:
+        if raw.read(2) == _GZIP_MAGIC:
+            raw.seek(0)
+            with gzip.GzipFile(fileobj=raw) as f:
+                header = f.read(_DIM_END)
+        else:
+            raw.seek(0)
+            header = raw.read(_DIM_END)
+    if len(header) < _DIM_END:
+        raise ValueError(f"{path}: file too short for a NIfTI-1 header")
+
+    for endian in ("<", ">"):
+        if struct.unpack_from(f"{endian}i", header)[0] == _NIFTI1_HEADER_SIZE:
+            dim = struct.unpack_from(f"{endian}8h", header, 40)
+            if not 1 <= dim[0] <= 7:
+                raise ValueError(f"{path}: invalid NIfTI-1 dim[0] = {dim[0]}")
+            return tuple(dim[1:dim[0] + 1])
+    raise ValueError(f"{path}: not a NIfTI-1 header")
@@ -1,57 +1,63 @@
 import argparse
+import contextlib
 import os
 import re
 import subprocess
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
 from typing import Iterable, List, Optional
 
 
 from .command import run_cmd
 
 
-_OUTPUTDIR_RE = re.compile(r"^\s*set\s+fmri\(outputdir\)\s+\"?([^\"\n]+)\"?\s*$")
+# Matched against the whole file; [ \t] keeps each match on one line.
+_OUTPUTDIR_RE = re.compile(rb'^[ \t]*set[ \t]+fmri\(outputdir\)[ \t]+"?([^"\r\n]+)"?[ \t]*\r?$', re.MULTILINE)
 
 
 def feat_outputdir_from_fsf(fsf_path: str) -> str | None:
     try:
-        with open(fsf_path, "r", encoding="utf-8", errors="ignore") as f:
-            for line in f:
-                m = _OUTPUTDIR_RE.match(line)
-                if m:
-                    return m.group(1)
+        with open(fsf_path, "rb") as f:
+            data = f.read()
     except FileNotFoundError:
         return None
-    return None
+    # One regex scan over the file instead of a Python loop over its lines.
+    m = _OUTPUTDIR_RE.search(data)
+    return m.group(1).decode("utf-8", "ignore") if m else None
 
 
 def feat_is_complete(outputdir: str) -> bool:
-    p = Path(outputdir)
-    if not p.exists() or not p.is_dir():
+    # One directory listing answers every marker check (instead of a stat each).
+    try:
+        with os.scandir(outputdir) as it:
+            names = {e.name for e in it}
+    except (FileNotFoundError, NotADirectoryError):
         return False
     # Heuristic: a completed FEAT directory typically has these.
-    if not (p / "design.fsf").exists():
-        return False
-    if not (p / "stats").exists():
+    if "design.fsf" not in names or "stats" not in names:
         return False
-    # filtered_func_data.nii.gz is created for standard first-level analyses
-    if (p / "filtered_func_data.nii.gz").exists():
-        return True
-    # Some analyses may not create filtered_func_data; fallback to report
-    return (p / "report.html").exists()
-
-
-def _run_single_feat(
-    fsf_path: str,
-    *,
-    log_file=None,
-    dry_run: bool = False,
-    force: bool = False,
-) -> None:
-    outdir = feat_outputdir_from_fsf(fsf_path)
-    if outdir and feat_is_complete(outdir) and not force:
-        return
-    run_cmd(["feat", fsf_path], log_file=log_file, dry_run=dry_run, check=True)
+    # filtered_func_data.nii.gz is created for standard first-level analyses;
+    # some analyses may not create it, so fall back to the report.
+    return "filtered_func_data.nii.gz" in names or "report.html" in names
+
+
+def _feat_jobs(fsf_paths: Iterable[str], *, force: bool = False) -> List[str]:
+    """Return the FSFs that still need FEAT, one per output directory.
+
+    FSFs whose output directory already looks complete are dropped (unless
+    ``force``), as are later FSFs targeting an output directory already queued.
+    """
+    jobs = []
+    seen_outdirs = set()
+    for fsf_path in fsf_paths:
+        if not fsf_path:
+            continue
+        outdir = feat_outputdir_from_fsf(fsf_path)
+        if outdir:
+            if outdir in seen_outdirs or (not force and feat_is_complete(outdir)):
+                continue
+            seen_outdirs.add(outdir)
+        jobs.append(fsf_path)
+    return jobs
 
 
 def run_feat(
@@ -61,15 +67,28 @@ def run_feat(
     log_file: str | None = None,
     dry_run: bool = False,
     force: bool = False,
+    executor: Optional[Executor] = None,
 ) -> None:
-    """Run FSL FEAT for each FSF in fsf_paths in parallel."""
-    fsf_list = [p for p in fsf_paths if p]
+    """Run FSL FEAT for each FSF in fsf_paths in parallel.
+
+    If ``executor`` is given, jobs are submitted to it (and it is left running)
+    instead of creating a private pool of ``max_workers`` threads.
+    """
+    fsf_list = _feat_jobs(fsf_paths, force=force)
     if not fsf_list:
         return
 
     # ThreadPool is appropriate: each task is an external process.
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {ex.submit(_run_single_feat, p, log_file=log_file, dry_run=dry_run, force=force): p for p in fsf_list}
+    # A private pool is sized to the batch, so small batches do not start idle threads.
+    if executor is None:
+        pool = ThreadPoolExecutor(max_workers=min(max_workers, len(fsf_list)))
+    else:
+        pool = contextlib.nullcontext(executor)
+    with pool as ex:
+        futures = {
+            ex.submit(run_cmd, ["feat", p], log_file=log_file, dry_run=dry_run, check=True, stream=True): p
+            for p in fsf_list
+        }
         for fut in as_completed(futures):
             fsf = futures[fut]
             try:
@@ -82,13 +101,35 @@ def write_feat_commands(
     fsf_paths: Iterable[str],
     *,
     output_file: str,
+    append: bool = True,
 ) -> None:
-    """Append 'feat <fsf>' commands to output_file."""
+    """Append (or, with append=False, write) 'feat <fsf>' commands to output_file."""
     os.makedirs(os.path.dirname(os.path.abspath(output_file)) or ".", exist_ok=True)
-    with open(output_file, "a") as f:
-        for p in fsf_paths:
-            if p:
-                f.write(f"feat {p}\n")
+    content = "".join(f"feat {p}\n" for p in fsf_paths if p)
+    with open(output_file, "a" if append else "w") as f:
+        f.write(content)
+
+
+def write_slurm_array_script(
+    commands_file: str,
+    script_file: str,
+    n_commands: int,
+    *,
+    max_parallel: int = 20,
+    job_name: str = "feat",
+) -> None:
+    """Write a SLURM array job that runs line ``$SLURM_ARRAY_TASK_ID`` of commands_file."""
+    commands_file = os.path.abspath(commands_file)
+    os.makedirs(os.path.dirname(os.path.abspath(script_file)) or ".", exist_ok=True)
+    with open(script_file, "w") as f:
+        f.write(
+            "#!/bin/bash\n"
+            f"#SBATCH --job-name={job_name}\n"
+            f"#SBATCH --array=1-{n_commands}%{max_parallel}\n"
+            "\n"
+            f'sed -n "${{SLURM_ARRAY_TASK_ID}}p" "{commands_file}" | bash\n'
+        )
+    os.chmod(script_file, 0o755)
 
 
 def main(
@@ -99,11 +140,19 @@ def main(
     log_file: Optional[str] = None,
     dry_run: bool = False,
     force: bool = False,
+    executor: Optional[Executor] = None,
 ) -> None:
     if write_commands:
         write_feat_commands(fsf_paths, output_file=write_commands)
     else:
-        run_feat(fsf_paths, max_workers=max_workers, log_file=log_file, dry_run=dry_run, force=force)
+        run_feat(
+            fsf_paths,
+            max_workers=max_workers,
+            log_file=log_file,
+            dry_run=dry_run,
+            force=force,
+            executor=executor,
+        )
 
 
 if __name__ == "__main__":
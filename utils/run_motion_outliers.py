@@ -1,45 +1,78 @@
 #!/usr/bin/env python3
 
+import contextlib
 import os
-import glob
 import subprocess
 import argparse
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-try:
-    import nibabel as nib  # type: ignore
-except ImportError:  # pragma: no cover
-    nib = None
 from functools import partial
 from .find_dummy import load_config, get_dummy_scans
 from .bids import parse_bids_entities, match_filters
 from .command import run_cmd
+from .lazy_nibabel import nib
+from .nifti_header import read_nifti1_shape
 from .subjects import parse_subjects_arg
 
-def process_file(input_path, output_path, config, *, log_file=None, dry_run=False, force=False):
+def _iter_func_files(subject_dirs):
+    """Yield files under each subject directory whose directory path contains 'func'.
+
+    Uses an explicit os.scandir stack, streaming paths to the caller instead of
+    materializing os.walk listings. Outside func trees only ``ses-*`` and
+    ``*func*`` directories are entered, so anat/, dwi/, fmap/ are never listed.
+    """
+    for sub_dir in subject_dirs:
+        stack = [sub_dir]
+        while stack:
+            directory = stack.pop()
+            in_func = "func" in directory
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            # Like os.walk, do not descend into symlinked directories.
+                            if not entry.is_symlink() and (
+                                in_func or "func" in entry.name or entry.name.startswith("ses-")
+                            ):
+                                stack.append(entry.path)
+                        elif in_func:
+                            yield entry.path
+            except OSError as e:
+                # A missing subject directory shows up as its first scandir failing.
+                if directory == sub_dir and isinstance(e, (FileNotFoundError, NotADirectoryError)):
+                    print(f"Warning: subject directory {sub_dir} does not exist. Skipping.")
+                continue
+
+def process_file(input_path, output_path, config, *, log_file=None, dry_run=False, force=False, existing_outputs=None):
     """
     Process a single NIfTI file: determine the number of frames,
     update the fsl_motion_outliers command with the appropriate --dummy value,
     and run the command.
+
+    ``existing_outputs`` is an optional set of output paths already known to
+    exist (from one directory listing); without it the output is stat'ed.
     """
-    if os.path.exists(output_path) and not force:
+    exists = output_path in existing_outputs if existing_outputs is not None else os.path.exists(output_path)
+    if exists and not force:
         print(f"Output file already exists, skipping: {output_path}")
         return
 
     # Determine number of frames in the bold sequence
+    num_frames = None
     try:
-        if nib is None:
-            raise ImportError("nibabel not installed")
-
-        img = nib.load(input_path)
-        if len(img.shape) < 4:
-            print(f"File {input_path} does not have 4 dimensions, cannot determine number of frames. Using default dummy scans.")
-            num_frames = None
-        else:
-            num_frames = img.shape[3]
+        try:
+            shape = read_nifti1_shape(input_path)  # reads only the header's first bytes
+        except ValueError:
+            # Not a NIfTI-1 header (e.g. NIfTI-2). A preview does not pull in
+            # nibabel/numpy for it; a real run lets nibabel parse it.
+            shape = None if dry_run else nib.load(input_path).header.get_data_shape()
+        if shape is not None:
+            if len(shape) < 4:
+                print(f"File {input_path} does not have 4 dimensions, cannot determine number of frames. Using default dummy scans.")
+            else:
+                num_frames = shape[3]
     except Exception as e:
         print(f"Error loading {input_path} to determine number of frames: {e}. Using default dummy scans.")
-        num_frames = None
 
     # Determine dummy scans using config settings
     if num_frames is not None:
@@ -59,10 +92,33 @@ def process_file(input_path, output_path, config, *, log_file=None, dry_run=Fals
         "--dvars",
     ]
     try:
-        run_cmd(cmd, log_file=log_file, dry_run=dry_run, check=True)
+        run_cmd(cmd, log_file=log_file, dry_run=dry_run, check=True, stream=True)
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"fsl_motion_outliers failed for {input_path}: {e}") from e
 
+def process_batch(tasks, config, *, log_file=None, dry_run=False, force=False, existing_outputs=None):
+    """Run process_file for each (input_path, output_path) pair in tasks.
+
+    Every file in the batch is attempted; the first failure is re-raised at the end.
+    """
+    error = None
+    for input_path, output_path in tasks:
+        try:
+            process_file(
+                input_path,
+                output_path,
+                config,
+                log_file=log_file,
+                dry_run=dry_run,
+                force=force,
+                existing_outputs=existing_outputs,
+            )
+        except Exception as e:
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
+
 def main(
     input_base_dir,
     output_base_dir,
@@ -74,55 +130,94 @@ def main(
     log_file=None,
     dry_run=False,
     force=False,
+    file_index=None,
+    executor=None,
 ):
     tasks = []
+    # Output directory -> names already in it, listed once per directory.
+    existing_names = {}
     
     # Load configuration settings for motion outlier detection.
     config = load_config()
     
+    # Filters are tested once per candidate file; hash lookups instead of list scans.
+    task_filters = frozenset(task_filters) if task_filters else None
+    run_filters = frozenset(run_filters) if run_filters else None
+
     # Determine which subject directories to process:
     subjects_list = parse_subjects_arg(subjects)
-    if subjects_list:
-        subject_dirs = [os.path.join(input_base_dir, sub) for sub in subjects_list]
+    if file_index is not None:
+        # Reuse the caller's pre-discovered BIDS index instead of walking the tree again.
+        candidates = [
+            f.path for f in file_index
+            if f.datatype == "func" and (not subjects_list or f.subject in subjects_list)
+        ]
     else:
-        subject_dirs = sorted(glob.glob(os.path.join(input_base_dir, "sub-*")))
-    
-    # Loop through each subject directory.
-    for sub_dir in subject_dirs:
-        if not os.path.isdir(sub_dir):
-            print(f"Warning: subject directory {sub_dir} does not exist. Skipping.")
-            continue
-        
-        # Walk the subject directory to find functional data.
-        for root, dirs, files in os.walk(sub_dir):
-            if "func" in root:
-                for file in files:
-                    if file.endswith(".nii.gz") and "bold" in file:
-                        ents = parse_bids_entities(file)
-                        if not match_filters(ents, task_filters=task_filters, run_filters=run_filters):
-                            continue
-                        input_path = os.path.join(root, file)
-                        # Compute the relative path from the input_base_dir.
-                        relative_path = os.path.relpath(root, input_base_dir)
-                        # Include the additional directory for outputs.
-                        output_dir = os.path.join(output_base_dir, "fsl_motion-outliers_v6.0.7.4", relative_path)
-                        # Create the directory if it doesn't exist.
-                        os.makedirs(output_dir, exist_ok=True)
-                        
-                        base_name = os.path.splitext(os.path.splitext(file)[0])[0]
-                        output_file = f"{base_name}_confounds.txt"
-                        output_path = os.path.join(output_dir, output_file)
-                        
-                        tasks.append((input_path, output_path))
+        if subjects_list:
+            subject_dirs = [os.path.join(input_base_dir, sub) for sub in subjects_list]
+        else:
+            with os.scandir(input_base_dir) as it:
+                subject_dirs = sorted(e.path for e in it if e.name.startswith("sub-") and e.is_dir())
+
+        if len(subject_dirs) > 1:
+            # Subject trees are independent; list them concurrently so directory
+            # reads on network filesystems overlap instead of running back to back.
+            with ThreadPoolExecutor(max_workers=min(32, len(subject_dirs))) as lister:
+                candidates = [
+                    path
+                    for paths in lister.map(lambda d: list(_iter_func_files([d])), subject_dirs)
+                    for path in paths
+                ]
+        else:
+            candidates = _iter_func_files(subject_dirs)
+
+    out_root = os.path.join(output_base_dir, "fsl_motion-outliers_v6.0.7.4")
+    # Input directory -> output directory, so paths are derived once per directory.
+    output_dirs = {}
+    for input_path in candidates:
+        input_dir, file = os.path.split(input_path)
+        if file.endswith(".nii.gz") and "bold" in file:
+            ents = parse_bids_entities(file)
+            if not match_filters(ents, task_filters=task_filters, run_filters=run_filters):
+                continue
+            output_dir = output_dirs.get(input_dir)
+            if output_dir is None:
+                # Mirror the input layout under the tool's output directory.
+                output_dir = os.path.join(out_root, os.path.relpath(input_dir, input_base_dir))
+                output_dirs[input_dir] = output_dir
+                # Create the directory if it doesn't exist, and list it once.
+                os.makedirs(output_dir, exist_ok=True)
+                with os.scandir(output_dir) as it:
+                    existing_names[output_dir] = {entry.name for entry in it}
+
+            # Strip '.nii.gz' and name the confounds file after the scan.
+            tasks.append((input_path, f"{output_dir}/{file[:-7]}_confounds.txt"))
     
     # Process files in parallel, passing the configuration to each worker.
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        func = partial(process_file, config=config, log_file=log_file, dry_run=dry_run, force=force)
-        futures = [executor.submit(func, *task) for task in tasks]
+    # A caller-provided executor is shared across steps and left running.
+    pool = ThreadPoolExecutor(max_workers=max_workers) if executor is None else contextlib.nullcontext(executor)
+    with pool as ex:
+        # fsl_motion_outliers takes one input per call, so batch the executor
+        # tasks instead: a few chunks per worker keeps the queue short while
+        # still balancing uneven run lengths.
+        chunksize = max(1, len(tasks) // (max_workers * 4))
+        existing_outputs = frozenset(
+            path for _, path in tasks if os.path.basename(path) in existing_names[os.path.dirname(path)]
+        )
+        func = partial(
+            process_batch,
+            config=config,
+            log_file=log_file,
+            dry_run=dry_run,
+            force=force,
+            existing_outputs=existing_outputs,
+        )
+        futures = [ex.submit(func, tasks[i:i + chunksize]) for i in range(0, len(tasks), chunksize)]
         for future in as_completed(futures):
             future.result()
     
     print("Motion outlier detection complete!")
+    return [output_path for _, output_path in tasks]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
+import contextlib
 import os
-import glob
+import functools
 import subprocess
 import concurrent.futures
 import logging
@@ -9,15 +10,11 @@ import shutil
 import sys
 import argparse
 # Local helpers
-from .bids import parse_bids_entities, match_filters
-from .command import run_cmd
-try:
-    import nibabel as nib  # type: ignore
-except ImportError:  # pragma: no cover
-    # Provide a minimal stub so unit tests can monkeypatch nib.load/save.
-    from types import SimpleNamespace
-
-    nib = SimpleNamespace(load=None, save=None, Nifti1Image=None)
+from .bids import discover_bids_files, parse_bids_entities, match_filters
+from .command import ensure_dir, run_cmd
+from .lazy_nibabel import nib
+from .nifti_header import read_nifti1_shape
+from .subjects import parse_subjects_arg
 
 # Configure logging
 logging.basicConfig(
@@ -33,50 +30,69 @@ def _synthstrip_cmd(in_path: str, out_path: str) -> list[str]:
 def parse_subjects(subjects_input):
     """
     Parse the subjects input.
-    If subjects_input is a path to a file, read its contents and split by commas or newlines.
+    If subjects_input is a path to a file, read it whole and split on commas or whitespace.
     Otherwise, treat it as a comma-separated list.
     """
-    if isinstance(subjects_input, (list, tuple, set)):
-        return [str(s).strip() for s in subjects_input if str(s).strip()]
-    if os.path.exists(subjects_input) and os.path.isfile(subjects_input):
-        with open(subjects_input, 'r') as f:
-            content = f.read().strip()
-        if ',' in content:
-            subjects_list = [s.strip() for s in content.split(',') if s.strip()]
-        else:
-            subjects_list = [line.strip() for line in content.splitlines() if line.strip()]
-    else:
-        subjects_list = [s.strip() for s in subjects_input.split(',') if s.strip()]
-    return subjects_list
+    return parse_subjects_arg(subjects_input) or []
 
+@functools.lru_cache(maxsize=1)
 def check_dependencies():
+    # Only a successful check is cached (a raise is not), so the PATH is
+    # scanned once per process rather than once per pipeline step.
     if not shutil.which("mri_synthstrip"):
         raise RuntimeError("mri_synthstrip is not installed or not found in PATH.")
 
-def process_file(file_path, input_base_dir, output_base_dir, *, log_file=None, dry_run=False, force=False):
+def process_file(
+    file_path,
+    input_base_dir,
+    output_base_dir,
+    *,
+    log_file=None,
+    dry_run=False,
+    force=False,
+    existing_outputs=None,
+    created_dirs=None,
+    output_path=None,
+):
+    """Skull-strip one NIfTI file (the first frame, for 4D images).
+
+    ``output_path`` is the already-resolved output file (as built by ``main``);
+    without it the path is derived from the input and output base directories.
+    ``existing_outputs`` is an optional set of output paths already known to
+    exist (from one listing per output directory); without it the output is stat'ed.
+    ``created_dirs`` is an optional shared set of output directories known to
+    exist (see ``utils.command.ensure_dir``).
+    """
     try:
         if not file_path.endswith(".nii.gz"):
-            logging.warning(f"Skipping non-NIfTI file: {file_path}")
+            logging.warning("Skipping non-NIfTI file: %s", file_path)
             return
 
-        # Determine the output directory. Include the additional subdirectory.
-        relative_dir = os.path.relpath(os.path.dirname(file_path), input_base_dir)
-        output_dir = os.path.join(output_base_dir, "freesurfer_synthstrip_v8.1.0", relative_dir)
-        os.makedirs(output_dir, exist_ok=True)
-
         base_name = os.path.basename(file_path)[:-7]  # Remove '.nii.gz'
-        output_file = f"{base_name}_synthstrip.nii.gz"
-        output_path = os.path.join(output_dir, output_file)
+        if output_path is None:
+            # Determine the output directory. Include the additional subdirectory.
+            relative_dir = os.path.relpath(os.path.dirname(file_path), input_base_dir)
+            output_dir = os.path.join(output_base_dir, "freesurfer_synthstrip_v8.1.0", relative_dir)
+            output_path = os.path.join(output_dir, f"{base_name}_synthstrip.nii.gz")
+        else:
+            output_dir = os.path.dirname(output_path)
+        ensure_dir(output_dir, created_dirs)
 
-        if os.path.exists(output_path) and not force:
-            logging.info(f"Output file already exists, skipping: {output_path}")
+        exists = output_path in existing_outputs if existing_outputs is not None else os.path.exists(output_path)
+        if exists and not force:
+            logging.info("Output file already exists, skipping: %s", output_path)
             return
 
-        # Load the image to check dimensions.
-        img = nib.load(file_path)
+        # Check dimensions from the header alone; only 4D inputs need nibabel.
+        try:
+            shape = read_nifti1_shape(file_path)
+        except ValueError:
+            # Not a NIfTI-1 header (e.g. NIfTI-2); let nibabel parse it.
+            shape = nib.load(file_path).shape
         # If the image is 4D with more than one frame, extract the first frame.
-        if len(img.shape) == 4 and img.shape[3] > 1:
-            logging.info(f"File {file_path} is 4D. Extracting the first frame.")
+        if len(shape) == 4 and shape[3] > 1:
+            logging.info("File %s is 4D. Extracting the first frame.", file_path)
+            img = nib.load(file_path)
             first_frame_data = img.dataobj[..., 0]
             # Create a new NIfTI image using the first frame.
             first_frame_img = nib.Nifti1Image(first_frame_data, img.affine, img.header)
@@ -89,49 +105,56 @@ def process_file(file_path, input_base_dir, output_base_dir, *, log_file=None, d
 
         # Format and run the synthstrip command.
         cmd = _synthstrip_cmd(in_path, output_path)
-        run_cmd(cmd, log_file=log_file, dry_run=dry_run, check=True)
-        logging.info(f"Completed: {output_path}")
+        run_cmd(cmd, log_file=log_file, dry_run=dry_run, check=True, stream=True)
+        logging.info("Completed: %s", output_path)
 
     except subprocess.CalledProcessError as e:
         raise RuntimeError(f"mri_synthstrip failed for {file_path}: {e}") from e
     except Exception as e:
-        logging.error(f"Unexpected error with file: {file_path}\n{e}")
+        logging.error("Unexpected error with file: %s\n%s", file_path, e)
 
-def gather_nifti_files(input_dir, subjects=None, task_filters=None, run_filters=None):
+def gather_nifti_files(input_dir, subjects=None, task_filters=None, run_filters=None, file_index=None):
     """
     Gather NIfTI files from the input directory.
     If a list of subjects is provided, limit the search to those subject directories.
-    Otherwise, use the default glob pattern.
+    Otherwise, every subject's session directories are scanned.
+    If a pre-discovered file_index (see utils.bids.discover_bids_files) is given,
+    it is filtered instead of scanning the input directory again.
     Files that are anatomical (in an "anat" directory and with "T1w" in the filename)
     are always included regardless of task or run filters.
     """
-    files = []
-    
-    # Define a helper that applies the filters.
     def file_matches_filters(f):
-        parts = os.path.normpath(f).split(os.sep)
-        basename = os.path.basename(f)
+        basename = os.path.basename(f.path)
         # Always include anatomical T1w images.
-        if "anat" in parts and "T1w" in basename:
+        if f.datatype == "anat" and "T1w" in basename:
             return True
-        ents = parse_bids_entities(basename)
-        return match_filters(ents, task_filters=task_filters, run_filters=run_filters)
+        if not (task_filters or run_filters):
+            return True
+        # Entity parses are cached per filename in utils.bids.
+        return match_filters(parse_bids_entities(basename), task_filters=task_filters, run_filters=run_filters)
 
-    if subjects:
-        # subjects is expected to be a list of subject identifiers, e.g., ["sub-001", "sub-002"]
-        for sub in subjects:
-            subject_dir = os.path.join(input_dir, sub)
-            if os.path.isdir(subject_dir):
-                pattern = os.path.join(subject_dir, "ses-*", "*", "*.nii.gz")
-                sub_files = glob.glob(pattern, recursive=True)
-                sub_files = [f for f in sub_files if file_matches_filters(f)]
-                files.extend(sub_files)
-            else:
-                logging.warning(f"Subject directory not found: {subject_dir}")
-    else:
-        pattern = os.path.join(input_dir, "sub-*", "ses-*", "*", "*.nii.gz")
-        all_files = glob.glob(pattern, recursive=True)
-        files = [f for f in all_files if file_matches_filters(f)]
+    if file_index is None:
+        # One scandir walk of the requested subjects instead of a glob sweep.
+        if subjects:
+            # One listing of the input directory answers every subject's existence check.
+            try:
+                with os.scandir(input_dir) as it:
+                    present = {e.name for e in it if e.is_dir()}
+            except FileNotFoundError:
+                present = set()
+            for sub in subjects:
+                if sub not in present:
+                    logging.warning("Subject directory not found: %s", os.path.join(input_dir, sub))
+        file_index = discover_bids_files(input_dir, subjects)
+
+    wanted = frozenset(subjects) if subjects else None
+    # Only the sub-*/ses-*/<datatype>/*.nii.gz layout is processed.
+    files = [
+        f.path for f in file_index
+        if f.session is not None
+        and (wanted is None or f.subject in wanted)
+        and file_matches_filters(f)
+    ]
     return sorted(files)
 
 def main(
@@ -145,6 +168,8 @@ def main(
     log_file=None,
     dry_run=False,
     force=False,
+    file_index=None,
+    executor=None,
 ):
     check_dependencies()
     
@@ -152,32 +177,65 @@ def main(
     subjects_list = None
     if subjects:
         subjects_list = parse_subjects(subjects)
-        logging.info(f"Processing subjects: {subjects_list}")
+        logging.info("Processing subjects: %s", subjects_list)
     
-    files_to_process = gather_nifti_files(input_base_dir, subjects_list, task_filters, run_filters)
-    logging.info(f"Found {len(files_to_process)} NIfTI files to process.")
+    files_to_process = gather_nifti_files(
+        input_base_dir, subjects_list, task_filters, run_filters, file_index=file_index
+    )
+    logging.info("Found %d NIfTI files to process.", len(files_to_process))
 
 
     # De-duplicate by intended output path so the same T1w (or any file) is never processed twice
     # even if it appears multiple times in the gathered file list.
     unique = {}
+    # Output directory -> names already in it, listed once per directory.
+    existing_names = {}
+    # Output directories known to exist (listed above, or made by a worker).
+    created_dirs = set()
+    out_root = os.path.join(output_base_dir, "freesurfer_synthstrip_v8.1.0")
+    # Input directory -> output directory, so paths are derived once per directory.
+    output_dirs = {}
     for fp in files_to_process:
-        relative_dir = os.path.relpath(os.path.dirname(fp), input_base_dir)
-        output_dir = os.path.join(output_base_dir, "freesurfer_synthstrip_v8.1.0", relative_dir)
-        base_name = os.path.basename(fp)[:-7]
-        out_fp = os.path.join(output_dir, f"{base_name}_synthstrip.nii.gz")
-        unique.setdefault(out_fp, fp)
+        input_dir, file = os.path.split(fp)
+        output_dir = output_dirs.get(input_dir)
+        if output_dir is None:
+            output_dir = os.path.join(out_root, os.path.relpath(input_dir, input_base_dir))
+            output_dirs[input_dir] = output_dir
+            try:
+                with os.scandir(output_dir) as it:
+                    existing_names[output_dir] = {entry.name for entry in it}
+                created_dirs.add(output_dir)
+            except FileNotFoundError:
+                existing_names[output_dir] = set()
+        unique.setdefault(os.path.join(output_dir, f"{file[:-7]}_synthstrip.nii.gz"), fp)
+    existing_outputs = frozenset(
+        out_fp for out_fp in unique if os.path.basename(out_fp) in existing_names[os.path.dirname(out_fp)]
+    )
+    if not force:
+        # Drop finished files before submission so worker slots go to real work.
+        for out_fp in sorted(existing_outputs):
+            logging.info("Output file already exists, skipping: %s", out_fp)
+            del unique[out_fp]
     files_to_process = list(unique.values())
-    logging.info(f"After de-duplication: {len(files_to_process)} NIfTI files to process.")
+    logging.info("After de-duplication: %d NIfTI files to process.", len(files_to_process))
+    # Make the missing output directories here, once each, rather than racing in workers.
+    for out_fp in unique:
+        ensure_dir(os.path.dirname(out_fp), created_dirs)
 
 
     if not files_to_process:
         logging.info("No NIfTI files found. Exiting.")
         return
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # A caller-provided executor is shared across steps and left running.
+    if executor is None:
+        # Threads suffice: mri_synthstrip runs as a child process, so no GIL contention.
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(files_to_process)))
+    else:
+        pool = contextlib.nullcontext(executor)
+    with pool as ex:
         futures = {
-            executor.submit(
+            ex.submit(
                 process_file,
                 fp,
                 input_base_dir,
@@ -185,15 +243,20 @@ def main(
                 log_file=log_file,
                 dry_run=dry_run,
                 force=force,
+                existing_outputs=existing_outputs,
+                created_dirs=created_dirs,
+                output_path=out_fp,
             ): fp
-            for fp in files_to_process
+            for out_fp, fp in unique.items()
         }
-        for future in concurrent.futures.as_completed(futures):
+        total = len(futures)
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
             fp = futures[future]
             try:
                 future.result()
             except Exception as e:
-                logging.error(f"Unhandled exception for file {fp}: {e}")
+                logging.error("Unhandled exception for file %s: %s", fp, e)
+            logging.info("SynthStrip progress: %d/%d files", done, total)
 
     logging.info("Skull-stripping complete!")
 
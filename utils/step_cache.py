@@ -0,0 +1,69 @@
+"""Per-subject step completion manifests.
+
+A manifest records a fingerprint of a step's inputs (path, size and mtime of
+each file) and the output paths the step produced, once the step finishes.
+On a re-run, a step is skipped only if its inputs are unchanged and every
+recorded output still exists.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Sequence, Union
+
+from .command import ensure_parent_dir
+
+
+def manifest_path(output_directory: Union[str, Path], subject: str, step: str) -> str:
+    return os.path.join(str(output_directory), ".cache", subject, f"{step}.json")
+
+
+def fingerprint_inputs(paths: Iterable[str], *, extra: Sequence[object] = ()) -> str:
+    """Hash (path, size, mtime_ns) of every input plus any extra parameters.
+
+    Only file metadata is read, never file contents.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for p in sorted(paths):
+        st = os.stat(p)
+        h.update(f"{p}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    for item in extra:
+        h.update(repr(item).encode())
+    return h.hexdigest()
+
+
+def is_done(output_directory: Union[str, Path], subject: str, step: str, inputs_fingerprint: str) -> bool:
+    try:
+        with open(manifest_path(output_directory, subject, step), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if manifest.get("inputs") != inputs_fingerprint:
+        return False
+    # A deleted output means the step has to run again to recreate it.
+    root = str(output_directory)
+    return all(os.path.exists(os.path.join(root, p)) for p in manifest.get("outputs", ()))
+
+
+def mark_done(
+    output_directory: Union[str, Path],
+    subject: str,
+    step: str,
+    inputs_fingerprint: str,
+    outputs: Sequence[str] = (),
+) -> None:
+    path = manifest_path(output_directory, subject, step)
+    ensure_parent_dir(path)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        # Outputs are stored relative to output_directory, so the manifest stays
+        # valid when the tree is written elsewhere first and copied over.
+        json.dump(
+            {"inputs": inputs_fingerprint, "outputs": [os.path.relpath(p, output_directory) for p in outputs]},
+            f,
+        )
+    # Atomic replace so an interrupted write never leaves a truncated manifest.
+    os.replace(tmp, path)
@@ -2,9 +2,21 @@ from __future__ import annotations
 
 import os
 import re
+import stat
 from typing import Iterable
 
 
+# Subject files may separate IDs with commas, newlines or other whitespace.
+_SUBJECT_SEP_RE = re.compile(r"[\s,]+")
+
+
+def _is_regular_file(path: str) -> bool:
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
 def parse_subjects_arg(subjects_arg: str | Iterable[str] | None) -> list[str] | None:
     """Normalize subject input into a flat subject-id list.
 
@@ -12,7 +24,9 @@ def parse_subjects_arg(subjects_arg: str | Iterable[str] | None) -> list[str] |
     - ``None`` -> ``None`` (caller can interpret as "all subjects")
     - a list/tuple/set of tokens
     - a comma-separated string
-    - a path to a file containing comma/newline-separated subjects
+    - a path to a file containing comma/whitespace-separated subjects
+
+    Repeated IDs are dropped (first occurrence kept), so no subject is processed twice.
     """
     if not subjects_arg:
         return None
@@ -22,13 +36,14 @@ def parse_subjects_arg(subjects_arg: str | Iterable[str] | None) -> list[str] |
     else:
         tokens = [str(s).strip() for s in subjects_arg if str(s).strip()]
 
-    if len(tokens) == 1 and os.path.isfile(tokens[0]):
-        with open(tokens[0], "r", encoding="utf-8") as f:
-            raw = f.read().strip()
-        subs = [s.strip() for s in re.split(r"[\n,]+", raw) if s.strip()]
+    # An existing file always wins, even if its name looks like an ID or an ID list.
+    if len(tokens) == 1 and _is_regular_file(tokens[0]):
+        with open(tokens[0], "rb") as f:
+            raw = f.read().decode("utf-8", "replace")
+        subs = list(dict.fromkeys(filter(None, _SUBJECT_SEP_RE.split(raw))))
         return subs or None
 
     subs: list[str] = []
     for t in tokens:
         subs.extend([s.strip() for s in t.split(",") if s.strip()])
-    return subs or None
+    return list(dict.fromkeys(subs)) or None
@@ -0,0 +1,105 @@
+"""Shared Jinja2 environments for the first- and higher-level FSF templates.
+
+One Environment per template directory serves every template in it, so Jinja's
+in-memory template cache is shared by all design generators; each loader only
+sees that directory. If ``$FSL_PIPELINE_JINJA_CACHE`` is set, a
+``FileSystemBytecodeCache`` there also lets later runs skip parsing; without
+it, or if that directory cannot be created, templates are just compiled in
+memory.
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+from typing import Optional
+
+# FSFs are tens of KB; one 64 KiB buffer flushes most of them in a single write().
+WRITE_BUFFER_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=None)
+def _bytecode_cache():
+    from jinja2 import FileSystemBytecodeCache
+
+    directory = os.environ.get("FSL_PIPELINE_JINJA_CACHE")
+    if not directory:
+        return None
+    directory = os.path.expanduser(directory)
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory=directory)
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment(template_dir: str):
+    """Return the process-wide Jinja2 environment for templates in template_dir.
+
+    jinja2 is imported on first use.
+    """
+    from jinja2 import Environment, FileSystemLoader
+
+    return Environment(
+        loader=FileSystemLoader(template_dir),
+        bytecode_cache=_bytecode_cache(),
+        auto_reload=False,
+        cache_size=400,
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def load_template(template_path: str, template_src: Optional[str] = None):
+    """Return the compiled template for template_path, compiling it at most once.
+
+    ``template_src`` is the template's already-read source; when given, the
+    file is not read again.
+    """
+    filename = os.path.abspath(template_path)
+    template_dir, name = os.path.split(filename)
+    env = get_environment(template_dir)
+    if template_src is None:
+        return env.get_template(name)
+    # Same steps as jinja2.BaseLoader.load, so source handed over by the caller
+    # also goes through the bytecode cache (env.from_string would bypass it).
+    bcc = env.bytecode_cache
+    bucket = bcc.get_bucket(env, name, filename, template_src) if bcc is not None else None
+    code = bucket.code if bucket is not None else None
+    if code is None:
+        code = env.compile(template_src, name, filename)
+        if bucket is not None:
+            bucket.code = code
+            bcc.set_bucket(bucket)
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
+
+def dump_render(template, output_path: str, variables: dict) -> None:
+    """Render template with variables to output_path as UTF-8.
+
+    The whole FSF is rendered before the file is opened, so a template error
+    never leaves a partial file, and it is written in one call (skipped if the
+    file already has that content; see ``write_if_changed``).
+    """
+    content = template.render(variables)
+    write_if_changed(output_path, content.encode("utf-8"))
+
+
+def write_if_changed(output_path: str, data: bytes) -> bool:
+    """Write data to output_path unless the file already holds exactly data.
+
+    An unchanged file is only touched, so its mtime still shows it is up to
+    date. Returns True if the file was (re)written.
+    """
+    try:
+        with open(output_path, "rb") as existing:
+            # One byte past len(data) tells a longer file apart from an equal one.
+            unchanged = existing.read(len(data) + 1) == data
+    except FileNotFoundError:
+        unchanged = False
+    if unchanged:
+        os.utime(output_path)
+        return False
+    with open(output_path, "wb", buffering=WRITE_BUFFER_SIZE) as output:
+        output.write(data)
+    return True